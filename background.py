@@ -0,0 +1,370 @@
+"""Publishing from a background thread, spilling to a disk spool when the broker can't keep up.
+   
+   Publishers with publish_in_background set hand their (encoded) messages to a
+   BackgroundPublisher and return straight away. Messages wait in a bounded in-memory ring
+   until the publisher's thread sends them, batch_size at a time, each batch in a single AMQP
+   transaction (so a batch is only taken off the ring once the broker has it).
+   
+   If the ring is full, or the broker can't be reached, messages are appended to a Spool, a
+   memory-mapped file on local disk, and are sent from there (in order) once the broker is
+   back. The spool lives at HARE_SPOOL_PATH (by default, a file named after the process id in
+   the temporary directory); with a fixed path, messages still spooled when a process exits
+   are sent by the next process to use the path. Whilst another process has the spool at a
+   fixed path open, messages are spooled to a file of this process's own next to it. Note
+   that mandatory and immediate can't be used with background publishing, since nothing is
+   waiting to hear about returned messages."""
+from __future__ import with_statement
+
+import atexit
+import collections
+import cPickle
+import errno
+import fcntl
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+from amqplib import client_0_8 as amqp
+
+from django.conf import settings
+
+from .utils.log import logger
+from .pool import ConnectionPool, PoolTimeout
+from . import claimcheck, metrics
+
+# Errors which mean the broker can't be reached (as opposed to refusing a message)
+CONNECTION_ERRORS = (IOError, socket.error, amqp.AMQPConnectionException, PoolTimeout)
+
+class Spool(object):
+    """An append-only queue of records, kept in a memory-mapped file. The file starts with the
+       offsets of the first unread record and of the end of the last record; each record is a
+       4-byte length followed by the data. Only one process can open a spool at once."""
+    header = struct.Struct('>QQ')
+    length = struct.Struct('>I')
+    
+    def __init__(self, path, chunk_size=1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(self._fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise IOError(e.errno, 'spool %s is in use by another process' % path)
+            raise
+        size = os.fstat(self._fd).st_size
+        if size < self.header.size:
+            size = chunk_size
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            self._set_offsets(self.header.size, self.header.size)
+        else:
+            self._map = mmap.mmap(self._fd, size)
+            self.head, self.tail = self.header.unpack_from(self._map, 0)
+        return super(Spool, self).__init__()
+    
+    def _set_offsets(self, head, tail):
+        self.head, self.tail = head, tail
+        self.header.pack_into(self._map, 0, head, tail)
+    
+    def __nonzero__(self):
+        return self.head < self.tail
+    
+    def append(self, data):
+        end = self.tail + self.length.size + len(data)
+        if end > len(self._map):
+            # Grow the file (at least doubling it, so that appends stay cheap)
+            size = max(end, 2 * len(self._map))
+            size += -size % self.chunk_size
+            self._map.resize(size) # (which resizes the file, too)
+        self.length.pack_into(self._map, self.tail, len(data))
+        self._map[self.tail + self.length.size:end] = data
+        self._set_offsets(self.head, end)
+    
+    def read(self, count):
+        """Returns up to count of the oldest unread records, plus the offset to advance() to
+           once they've been dealt with."""
+        records = []
+        offset = self.head
+        while offset < self.tail and len(records) < count:
+            size = self.length.unpack_from(self._map, offset)[0]
+            offset += self.length.size
+            records.append(self._map[offset:offset + size])
+            offset += size
+        return records, offset
+    
+    def advance(self, offset):
+        """Marks the records before offset as read. Once everything has been read, the spool
+           is emptied (and shrunk back to its initial size)."""
+        if offset < self.tail:
+            self._set_offsets(offset, self.tail)
+            return
+        if len(self._map) > self.chunk_size:
+            self._map.resize(self.chunk_size)
+        self._set_offsets(self.header.size, self.header.size)
+    
+    def close(self, remove_if_empty=True):
+        self._map.flush()
+        self._map.close()
+        if remove_if_empty and not self:
+            os.unlink(self.path)
+        os.close(self._fd)
+
+class BackgroundPublisher(threading.Thread):
+    """Background thread which publishes messages submitted to it, over a connection checked
+       out of the ConnectionPool for the connection signature."""
+    def __init__(self, signature, maxsize=None, batch_size=100, retry_interval=1, spool_path=None):
+        super(BackgroundPublisher, self).__init__(name='hare-publisher')
+        self.daemon = True
+        self.maxsize = (maxsize if maxsize is not None else getattr(settings, 'HARE_BACKGROUND_QUEUE_SIZE', 10000))
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.spool_path = (spool_path or getattr(settings, 'HARE_SPOOL_PATH', None) or
+                           os.path.join(tempfile.gettempdir(), 'hare-%d.spool' % os.getpid()))
+        self.pool = ConnectionPool.for_signature(signature)
+        self.pid = os.getpid()
+        self._condition = threading.Condition()
+        self._ring = collections.deque()
+        self._spool = None
+        self._stopping = False
+        self._closed = False
+        self._in_flight = None # the batch taken off the ring which is being published
+        self._undeclared = {} # exchange -> exchange_declare kwargs (see declare())
+        self._connection = None
+        self._channel = None
+        # Replay whatever an earlier process left in the spool (unless another process
+        # sharing the path is already doing so)
+        if os.path.exists(self.spool_path):
+            try:
+                self._spool = Spool(self.spool_path)
+            except IOError, e:
+                logger.warning('not replaying spool: %s', e)
+    
+    def declare(self, exchange, kwargs):
+        """Has the thread declare an exchange (with the keyword arguments for exchange_declare)
+           before it next publishes anything."""
+        with self._condition:
+            self._undeclared[exchange] = kwargs
+    
+    def submit(self, exchange, routing_key, body, properties):
+        """Queues a message to be published, starting the thread if need be."""
+        if self.ident is None:
+            with _lock:
+                if self.ident is None:
+                    self.start()
+                    atexit.register(self.close)
+        record = (exchange, routing_key, body, properties)
+        with self._condition:
+            # Whilst anything is spooled, everything newer has to be spooled behind it (or it
+            # would be published first)
+            if len(self._ring) < self.maxsize and not self._spool:
+                self._ring.append(record)
+            else:
+                self._spill([record])
+            self._condition.notify()
+    
+    def close(self, timeout=5):
+        """Publishes whatever is still queued (waiting up to timeout seconds), spooling
+           anything which can't be published in time, and stops the thread."""
+        if self.pid != os.getpid():
+            # Inherited across a fork; the messages are the parent process's to publish
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.isAlive():
+            self.join(timeout)
+        with self._condition:
+            # If the thread is still stuck publishing, it leaves everything alone from now on,
+            # and the batch it has in hand is spooled too (so may end up published twice)
+            self._closed = True
+            unsent = list(self._in_flight or ()) + list(self._ring)
+            if unsent:
+                # Anything still on the ring is older than whatever is spooled, so has to go
+                # in front of it
+                spooled = []
+                if self._spool:
+                    spooled, offset = self._spool.read(self._spool.tail)
+                    self._spool.advance(offset)
+                self._spill(unsent)
+                if self._spool is not None:
+                    for record in spooled:
+                        self._spool.append(record)
+                self._ring.clear()
+            if self._spool is not None:
+                if self._spool:
+                    logger.warning('%d bytes of messages left spooled in %s', self._spool.tail - self._spool.head, self.spool_path)
+                self._spool.close()
+                self._spool = None
+    
+    def _spill(self, records):
+        """Appends records to the spool (the lock must be held). Records which can't be
+           spooled (e.g. the disk is full) are logged and dropped."""
+        spooled = 0
+        try:
+            if self._spool is None:
+                self._spool = self._open_spool()
+            for record in records:
+                self._spool.append(cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL))
+                spooled += 1
+        except EnvironmentError, e:
+            logger.error('dropping %d messages which could not be spooled to %s (%s)',
+                         len(records) - spooled, self.spool_path, e)
+            for exchange, routing_key, body, properties in records[spooled:]:
+                _release(properties)
+        if metrics.enabled and spooled:
+            metrics.incr('spooled', self.spool_path, spooled)
+    
+    def _open_spool(self):
+        try:
+            return Spool(self.spool_path)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        # Another process sharing the path has it open, so use a spool of this process's own
+        path = '%s.%d' % (self.spool_path, os.getpid())
+        logger.warning('spool %s is in use by another process; spooling to %s instead', self.spool_path, path)
+        self.spool_path = path
+        return Spool(path)
+    
+    def run(self):
+        while True:
+            with self._condition:
+                while not (self._ring or self._spool) and not self._stopping:
+                    self._condition.wait()
+                if not (self._ring or self._spool):
+                    break
+                if self._ring:
+                    batch = [self._ring.popleft() for i in xrange(min(self.batch_size, len(self._ring)))]
+                    self._in_flight = batch
+                    offset = None
+                else:
+                    records, offset = self._spool.read(self.batch_size)
+                    batch = [cPickle.loads(record) for record in records]
+            size = len(batch)
+            try:
+                self._publish(batch)
+            except CONNECTION_ERRORS, e:
+                logger.warning('background publishing failed (%s); retrying in %ss', e, self.retry_interval)
+                self._disconnect()
+                with self._condition:
+                    self._in_flight = None
+                    if self._closed:
+                        # close() gave up waiting, and has spooled the batch
+                        break
+                    if offset is not None:
+                        # Batch now only holds the records which weren't published, so skip
+                        # over those which were
+                        published = records[:size - len(batch)]
+                        if published:
+                            self._spool.advance(self._spool.head + sum(Spool.length.size + len(record) for record in published))
+                    else:
+                        if self._spool:
+                            # The spool holds newer messages, so these go back on the ring
+                            self._ring.extendleft(reversed(batch))
+                        else:
+                            # Move everything to disk while the broker is away
+                            self._spill(batch + list(self._ring))
+                            self._ring.clear()
+                    if self._stopping:
+                        break
+                    self._condition.wait(self.retry_interval)
+                continue
+            with self._condition:
+                self._in_flight = None
+                if self._closed:
+                    break
+                if offset is not None:
+                    self._spool.advance(offset)
+        self._disconnect()
+    
+    def _publish(self, batch):
+        """Publishes a batch of records in a transaction. If the broker refuses the batch
+           (e.g. an exchange doesn't exist), its messages are retried one at a time, and those
+           which are still refused are dropped. Records are removed from the batch as they're
+           dealt with, so if the connection fails part way, the batch is left holding the
+           records which still need publishing."""
+        if self._channel is None:
+            self._connection = self.pool.checkout()
+            self._channel = self._connection.channel()
+            self._channel.tx_select()
+        if self._undeclared:
+            self._declare()
+        try:
+            for exchange, routing_key, body, properties in batch:
+                self._channel.basic_publish(amqp.Message(body, **properties), exchange=exchange, routing_key=routing_key)
+            self._channel.tx_commit()
+        except amqp.AMQPChannelException, e:
+            self._disconnect()
+            if len(batch) == 1:
+                logger.error('dropping message refused by the broker (%s)', e)
+                _release(batch[0][3])
+                del batch[:]
+                return
+            while batch:
+                self._publish(batch[:1])
+                del batch[0]
+            return
+        if metrics.enabled:
+            for exchange, routing_key, body, properties in batch:
+                metrics.incr('published', exchange)
+        del batch[:]
+    
+    def _declare(self):
+        """Declares the exchanges passed to declare(), each on a channel of its own (since the
+           transactional channel would be closed by a refused declaration). Exchanges which
+           can't be declared are logged and forgotten; their messages are refused in turn if
+           they don't exist."""
+        while True:
+            with self._condition:
+                if not self._undeclared:
+                    return
+                exchange, kwargs = self._undeclared.popitem()
+            try:
+                channel = self._connection.channel()
+                logger.debug('declaring exchange -> channel.exchange_declare(exchange=%r, %r)', exchange, kwargs)
+                channel.exchange_declare(exchange=exchange, **kwargs)
+                channel.close()
+            except amqp.AMQPChannelException, e:
+                logger.error('could not declare exchange %r (%s)', exchange, e)
+            except:
+                with self._condition:
+                    self._undeclared.setdefault(exchange, kwargs)
+                raise
+    
+    def _disconnect(self):
+        """Closes the transactional channel and returns the connection to the pool (which
+           discards it if it has died)."""
+        if self._channel is not None:
+            try:
+                self._channel.close()
+            except CONNECTION_ERRORS + (amqp.AMQPException,):
+                pass
+        if self._connection is not None:
+            self.pool.checkin(self._connection)
+        self._connection = self._channel = None
+
+def _release(properties):
+    """Releases the claim-check references of a message which is being dropped (which mustn't
+       raise, since the background thread has to carry on)."""
+    try:
+        claimcheck.release_unpublished(properties)
+    except EnvironmentError, e:
+        logger.error('could not release claim-check references of dropped message (%s)', e)
+
+_lock = threading.Lock()
+_publishers = {} # connection signature -> BackgroundPublisher
+
+def get_publisher(signature):
+    """Returns the BackgroundPublisher for a connection signature (see AMQPConnection),
+       creating it if need be. New ones are created in forked child processes, which don't
+       inherit the threads."""
+    with _lock:
+        publisher = _publishers.get(signature)
+        if publisher is None or publisher.pid != os.getpid():
+            publisher = BackgroundPublisher(signature)
+            _publishers[signature] = publisher
+        return publisher
@@ -0,0 +1,42 @@
+"""Measures publishing throughput with Publisher.publish_many at various batch sizes.
+   
+   Needs a running broker and ENABLE_MQ = True in the settings module; run with something like:
+   
+       DJANGO_SETTINGS_MODULE=myproject.settings python -m hare.benchmarks.publishing"""
+import time
+
+from ..consumer import Consumer
+from ..publisher import Publisher
+
+EXCHANGE = '_hare_bench'
+QUEUE = '_hare_bench_queue'
+
+def run(batch_sizes=(1, 10, 100, 1000), count=10000, payload_size=256, transactional=False):
+    """Publishes count messages at each of batch_sizes, returning a list of
+       (batch_size, messages per second) tuples."""
+    publisher = Publisher(exchange=EXCHANGE, routing_key='bench')
+    consumer = Consumer(exchange=EXCHANGE, queue=QUEUE, routing_key='bench')
+    body = 'x' * payload_size
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            batch = [body] * batch_size
+            started = time.time()
+            for i in xrange(count // batch_size):
+                publisher.publish_many(batch, transactional=transactional)
+            elapsed = time.time() - started
+            results.append((batch_size, (count // batch_size) * batch_size / elapsed))
+            consumer.channel.queue_purge(QUEUE)
+    finally:
+        consumer.destroy_queue()
+        publisher.destroy_exchange()
+    return results
+
+def main():
+    for transactional in (False, True):
+        print 'transactional=%r' % transactional
+        for batch_size, rate in run(transactional=transactional):
+            print '  batch size %5d: %10.1f msgs/sec' % (batch_size, rate)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""Throughput and latency benchmarks for publishing and consuming.
+   
+   By default the benchmarks run against an in-process FakeBroker, so they need neither
+   RabbitMQ nor any settings; pass --broker host:port to run them against a real broker
+   instead. For example:
+       
+       python -m hare.benchmarks.suite --count 5000 --sizes 64,4096,65536
+   
+   Publishing latencies are the time taken by each publish call; consuming latencies are
+   end-to-end, from a message being published (by a separate connection) to it being handed
+   to the consuming code."""
+import optparse
+import os
+import threading
+import time
+
+from django.conf import settings
+
+if not settings.configured and 'DJANGO_SETTINGS_MODULE' not in os.environ:
+    settings.configure(ENABLE_MQ=True)
+
+from ..connection import AMQPConnection
+from ..consumer import Consumer, JSONConsumer
+from ..consumer_process import ConsumerProcess
+from ..publisher import Publisher, JSONPublisher
+from ..utils.broker import FakeBroker
+
+class _Done(Exception):
+    """Raised from a subscribe() callback to stop consuming."""
+    pass
+
+class Benchmark(object):
+    """Sets up a fresh exchange and queue on the broker at host, and tears them down again."""
+    def __init__(self, host, name):
+        self.host = host
+        self.exchange = '_hare_bench_%s' % name
+        self.queue = '_hare_bench_%s_queue' % name
+        self.connection = AMQPConnection(host=host)
+        self.publisher = Publisher(exchange=self.exchange, routing_key='bench', connection=self.connection)
+        self.consumer = Consumer(exchange=self.exchange, queue=self.queue, routing_key='bench',
+                                 connection=self.connection)
+        return super(Benchmark, self).__init__()
+    
+    def close(self):
+        self.consumer.destroy_queue()
+        self.publisher.destroy_exchange()
+        self.connection.close()
+    
+    def produce(self, count, payload_size, json=False):
+        """Publishes count timestamped messages from another thread (and connection)."""
+        def run():
+            # A pooled connection, since the shared one is in use by the consuming thread
+            connection = AMQPConnection(host=self.host, pooled=True)
+            cls = (JSONPublisher if json else Publisher)
+            publisher = cls(exchange=self.exchange, routing_key='bench', connection=connection)
+            payload = 'x' * payload_size
+            for i in xrange(count):
+                if json:
+                    publisher.publish({'sent': time.time(), 'payload': payload})
+                else:
+                    publisher.publish('%.6f|%s' % (time.time(), payload))
+            connection.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+def _sent(message):
+    if isinstance(message.body, dict):
+        return message.body['sent']
+    return float(message.body.split('|', 1)[0])
+
+# --- Benchmarks: each returns an (elapsed seconds, list of latencies) tuple --- #
+
+def bench_publish(bench, count, payload_size, concurrency):
+    body = 'x' * payload_size
+    latencies = []
+    started = time.time()
+    for i in xrange(count):
+        t = time.time()
+        bench.publisher.publish(body)
+        latencies.append(time.time() - t)
+    return time.time() - started, latencies
+
+def bench_json_publish(bench, count, payload_size, concurrency):
+    publisher = JSONPublisher(exchange=bench.exchange, routing_key='bench', connection=bench.connection)
+    body = {'payload': 'x' * payload_size}
+    latencies = []
+    started = time.time()
+    for i in xrange(count):
+        t = time.time()
+        publisher.publish(body)
+        latencies.append(time.time() - t)
+    return time.time() - started, latencies
+
+def bench_pop(bench, count, payload_size, concurrency):
+    bench.publisher.publish_many(['x' * payload_size] * count)
+    latencies = []
+    started = time.time()
+    for i in xrange(count):
+        t = time.time()
+        message = bench.consumer.pop()
+        bench.consumer.acknowledge(message)
+        latencies.append(time.time() - t)
+    return time.time() - started, latencies
+
+def bench_message_iterator(bench, count, payload_size, concurrency):
+    bench.consumer.qos(concurrency)
+    latencies = []
+    started = time.time()
+    producer = bench.produce(count, payload_size)
+    for message in bench.consumer.message_iterator(limit=count):
+        latencies.append(time.time() - _sent(message))
+        bench.consumer.acknowledge(message)
+    producer.join()
+    return time.time() - started, latencies
+
+def bench_batch_iterator(bench, count, payload_size, concurrency):
+    bench.consumer.qos(concurrency)
+    latencies = []
+    started = time.time()
+    producer = bench.produce(count, payload_size)
+    for batch in bench.consumer.batch_iterator(size=concurrency, max_wait=0.05, limit=count):
+        now = time.time()
+        latencies.extend(now - _sent(message) for message in batch)
+        bench.consumer.acknowledge_batch(batch)
+    producer.join()
+    return time.time() - started, latencies
+
+def bench_subscribe(bench, count, payload_size, concurrency):
+    bench.consumer.qos(concurrency)
+    latencies = []
+    def callback(message):
+        latencies.append(time.time() - _sent(message))
+        if len(latencies) >= count:
+            raise _Done
+    started = time.time()
+    producer = bench.produce(count, payload_size)
+    try:
+        bench.consumer.subscribe(callback)
+    except _Done:
+        pass
+    producer.join()
+    return time.time() - started, latencies
+
+def _bench_consumer_process(executor):
+    def bench(bench, count, payload_size, concurrency):
+        latencies = []
+        class Process(ConsumerProcess):
+            queue = bench.queue
+            consumer_class = JSONConsumer
+            consumer_args = {'connection': bench.connection, 'force_no_declare': True}
+            def process_message(self, message):
+                latencies.append(time.time() - message.body['sent'])
+        process = Process()
+        started = time.time()
+        producer = bench.produce(count, payload_size, json=True)
+        process.run(executor=executor, concurrency=concurrency, fault_tolerant=False, limit=count)
+        producer.join()
+        # Handlers running in child processes can't report their latencies back
+        return time.time() - started, latencies
+    return bench
+
+BENCHMARKS = [
+    ('publish', bench_publish),
+    ('json_publish', bench_json_publish),
+    ('pop', bench_pop),
+    ('message_iterator', bench_message_iterator),
+    ('batch_iterator', bench_batch_iterator),
+    ('subscribe', bench_subscribe),
+    ('consumer_process', _bench_consumer_process(None)),
+    ('consumer_process_thread', _bench_consumer_process('thread')),
+    ('consumer_process_process', _bench_consumer_process('process')),
+]
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+def run(host, count=2000, sizes=(64, 4096, 65536), concurrencies=(1, 16), names=None):
+    """Runs the benchmarks against the broker at host, returning a list of result dicts."""
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for payload_size in sizes:
+            for concurrency in concurrencies:
+                bench = Benchmark(host, name)
+                try:
+                    elapsed, latencies = benchmark(bench, count, payload_size, concurrency)
+                finally:
+                    bench.close()
+                latencies.sort()
+                results.append({
+                    'name': name,
+                    'payload_size': payload_size,
+                    'concurrency': concurrency,
+                    'rate': count / elapsed,
+                    'p50': _percentile(latencies, 50),
+                    'p99': _percentile(latencies, 99),
+                })
+    return results
+
+def _ms(seconds):
+    return ('%9.3f' % (seconds * 1000) if seconds is not None else '%9s' % '-')
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--broker', help='host:port of a broker to use instead of a FakeBroker')
+    parser.add_option('--count', type='int', default=2000, help='messages per benchmark')
+    parser.add_option('--sizes', default='64,4096,65536', help='comma-separated payload sizes')
+    parser.add_option('--concurrency', default='1,16', help='comma-separated prefetch/concurrency levels')
+    parser.add_option('--only', help='comma-separated benchmark names')
+    options, args = parser.parse_args()
+    
+    broker = None
+    host = options.broker
+    if host is None:
+        broker = FakeBroker().start()
+        host = broker.address
+    try:
+        results = run(host, options.count,
+                      [int(size) for size in options.sizes.split(',')],
+                      [int(level) for level in options.concurrency.split(',')],
+                      (options.only.split(',') if options.only else None))
+    finally:
+        if broker is not None:
+            broker.stop()
+    print '%-26s %8s %5s %11s %9s %9s' % ('benchmark', 'payload', 'conc', 'msgs/sec', 'p50 ms', 'p99 ms')
+    for result in results:
+        print '%-26s %8d %5d %11.1f %s %s' % (result['name'], result['payload_size'], result['concurrency'],
+                                               result['rate'], _ms(result['p50']), _ms(result['p99']))
+
+if __name__ == '__main__':
+    main()
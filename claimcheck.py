@@ -0,0 +1,202 @@
+"""Claim checks: passing large message bodies through a blob store instead of the broker.
+   
+   A Publisher with a claim_check_threshold writes (encoded) bodies of at least that many
+   bytes to the BlobStore at HARE_CLAIM_CHECK_PATH (a directory, which must be shared by
+   publishers and consumers on different hosts), and publishes an empty body with the
+   x-hare-claim-check header instead, naming the blob. Consumer.decode() maps the blob into
+   memory, so that its pages are only read as they're used, and a consumer without a codec
+   gets the read-only mmap itself as the message body, without the data being copied at all.
+   
+   Blobs are content-addressed, so a body published many times is only stored once. Each
+   reference to a blob is a hard link to it, and the filesystem's link count does the
+   reference counting: a Publisher takes claim_check_references references per message (one
+   for each queue the exchange routes the message to), and acknowledging a message releases
+   one, removing the blob with the last. Messages consumed with no_ack release theirs as soon
+   as they're decoded (the mapping outlives the reference), and messages the RetryPolicy
+   dead-letters carry their body inline again, rather than a reference. The references of a
+   message which fails to be published (or is rolled back, or refused by the broker, or
+   dropped by the background publisher) are released again by the publisher.
+   
+   References are leaked, and their blobs never removed, by:
+     - messages the broker drops, expires or dead-letters itself (rather than the RetryPolicy);
+     - messages acknowledged by a multi-ack they weren't passed to (Consumer.acknowledge_batch
+       releases the references of every message it's passed);
+     - messages consumed by anything other than a Consumer.
+   Sweep the store for old files if any of these can happen.
+   
+   Reference names come from message headers, which anybody who can publish to a queue can
+   set, so anything which isn't a well-formed reference is refused (with InvalidReference).
+   A ConsumerProcess treats a message with an invalid reference, or whose blob has gone
+   (MissingBlob), like any other message which can't be decoded (see ConsumerProcess.run)."""
+from __future__ import with_statement
+
+import errno
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+
+from . import dedup
+
+HEADER = 'x-hare-claim-check' # the space-separated references to a message's blob
+
+# A blob's SHA-1, followed by a message id (see dedup.new_message_id())
+_REFERENCE = re.compile(r'[0-9a-f]{40}\.[0-9a-f]+\.[0-9a-f]+\Z')
+
+class MissingBlob(Exception):
+    """Raised when none of a message's references to its blob exists any more."""
+    pass
+
+class InvalidReference(ValueError):
+    """Raised for a reference which isn't one this module could have made."""
+    pass
+
+class BlobStore(object):
+    """Content-addressed blobs in a directory. Each blob is kept under the SHA-1 of its
+       content, and each reference is a hard link to it, named after the blob and a unique
+       id. Files are spread over subdirectories by the first two characters of their names."""
+    def __init__(self, path):
+        self.path = path
+        return super(BlobStore, self).__init__()
+    
+    def _path(self, name):
+        return os.path.join(self.path, name[:2], name)
+    
+    def _ref_path(self, ref):
+        """Returns the path of a reference, refusing anything else (such as a path which
+           would lead out of the store)."""
+        if not isinstance(ref, basestring) or not _REFERENCE.match(ref):
+            raise InvalidReference('invalid blob reference %r' % (ref,))
+        path = self._path(ref)
+        if not os.path.realpath(path).startswith(os.path.realpath(self.path) + os.sep):
+            raise InvalidReference('blob reference %r is outside %s' % (ref, self.path))
+        return path
+    
+    def put(self, data, references=1):
+        """Stores data (unless it's already stored), returning a list of references to it."""
+        digest = hashlib.sha1(data).hexdigest()
+        content = self._path(digest)
+        refs = []
+        for i in xrange(references):
+            ref = '%s.%s' % (digest, dedup.new_message_id())
+            while True:
+                try:
+                    os.link(content, self._ref_path(ref))
+                    break
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # Not stored yet (or the last reference to it has just been released)
+                    self._write(content, data)
+            refs.append(ref)
+        return refs
+    
+    def _write(self, content, data):
+        directory = os.path.dirname(content)
+        # Written under a temporary name first, so that a blob is never seen half-written
+        while True:
+            try:
+                fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+                break
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            # (the directory doesn't exist, or was just removed by release())
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST: # (made by somebody else in the meantime)
+                    raise
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        os.rename(temporary, content)
+    
+    def open(self, refs):
+        """Returns a read-only mmap of the blob the references refer to (or an empty string,
+           for an empty blob). The mapping stays valid even once the references are released."""
+        for ref in refs:
+            try:
+                fd = os.open(self._ref_path(ref), os.O_RDONLY)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue # (released by another consumer of a shared reference)
+            try:
+                if not os.fstat(fd).st_size:
+                    return ''
+                return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        raise MissingBlob('no blob for %s' % ' '.join(refs))
+    
+    def retain(self, refs):
+        """Takes another reference to the blob the references refer to, returning a list of
+           the new one (e.g. for a copy of a message which is being republished)."""
+        for ref in refs:
+            path = self._ref_path(ref)
+            new = '%s.%s' % (ref.split('.', 1)[0], dedup.new_message_id())
+            try:
+                os.link(path, self._ref_path(new))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            return [new]
+        raise MissingBlob('no blob for %s' % ' '.join(refs))
+    
+    def release(self, refs):
+        """Releases one of the references, removing the blob if it was the last (and its
+           directory, if that leaves it empty)."""
+        for ref in refs:
+            try:
+                os.unlink(self._ref_path(ref))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            content = self._path(ref.split('.', 1)[0])
+            try:
+                # Only the blob's own name is left. (A reference taken in the meantime keeps
+                # the data, though the blob will be written again for the next message.)
+                if os.stat(content).st_nlink == 1:
+                    os.unlink(content)
+                    os.rmdir(os.path.dirname(content))
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+            return
+
+_lock = threading.Lock()
+_stores = {} # path -> BlobStore
+
+def get_store(path=None):
+    """Returns the BlobStore for the path (by default, HARE_CLAIM_CHECK_PATH, or a directory
+       in the temporary directory)."""
+    path = (path or getattr(settings, 'HARE_CLAIM_CHECK_PATH', None) or
+            os.path.join(tempfile.gettempdir(), 'hare-blobs'))
+    with _lock:
+        if path not in _stores:
+            _stores[path] = BlobStore(path)
+        return _stores[path]
+
+def references(message):
+    """Returns the references to a message's blob, or None if it hasn't got one."""
+    headers = message.properties.get('application_headers') or {}
+    refs = headers.get(HEADER)
+    return (refs.split() if refs else None)
+
+def release_unpublished(properties):
+    """Releases every reference named by the properties of a message which was never
+       published after all (if it was claim-checked)."""
+    refs = (properties.get('application_headers') or {}).get(HEADER)
+    if refs:
+        store = get_store()
+        for ref in refs.split():
+            store.release([ref])
@@ -1,30 +1,63 @@
 """Handles connections to the AMQP server."""
+from __future__ import with_statement
+
+import thread
+import threading
 from amqplib import client_0_8 as amqp
 
 from django.conf import settings
 
 from .utils.log import logger
+from . import metrics
+from .pool import ConnectionPool, abandon
 
 class AMQPConnection(object):
     """Handles connections to the AMQP server. Instances of this class follow something like the
-       identity map pattern, where only one connection will be opened per unique set of parameters."""
-    _active_connections = {}
+       identity map pattern, where only one connection will be opened per unique set of parameters
+       on each thread (amqplib connections can't be shared by threads, since they'd all be
+       reading the same socket).
+       
+       Alternatively, if pooled is True (which defaults to the AMQP_POOLED setting), a connection
+       is checked out of the ConnectionPool for the parameters instead, and is used exclusively
+       by this instance until it is closed."""
+    _active_connections = {} # (connection signature, thread id) -> [retain count, connection]
+    _lock = threading.Lock() # guards _active_connections
+    
+    @classmethod
+    def reset_after_fork(cls):
+        """Forgets the shared connections, for use in a freshly forked child process, which
+           must open connections of its own (see pool.abandon())."""
+        for count, connection in cls._active_connections.values():
+            abandon(connection)
+        cls._active_connections = {}
+        cls._lock = threading.Lock()
     
-    def __init__(self, **kwargs):
+    def __init__(self, pooled=None, **kwargs):
         self.connection_signature = self._connection_signature(**kwargs)
+        # (so that the connection is released by close() whichever thread calls it)
+        self._key = (self.connection_signature, thread.get_ident())
+        self.pool = None
+        self._closed = False
         
         # Do nothing if the mq is disabled in the settings
         if getattr(settings, 'ENABLE_MQ', False):
-            if self.connection_signature not in self._active_connections:
-                # Create a new connection, setting its retain count to 1 (this instance)
-                sig = dict(self.connection_signature)
-                logger.debug('creating new amqp connection -> amqp.Connection(%r)' % sig)
-                self._active_connections[self.connection_signature] = [1, amqp.Connection(**sig)]
+            if (pooled if pooled is not None else getattr(settings, 'AMQP_POOLED', False)):
+                self.pool = ConnectionPool.for_signature(self.connection_signature)
+                self.connection = self.pool.checkout()
             else:
-                # A retain count is used for each connection to determine if, when closed,
-                # an AMQPConnection may close the underlying connection, too.
-                self._active_connections[self.connection_signature][0] += 1
-            self.connection = self._active_connections[self.connection_signature][1]
+                with self._lock:
+                    if self._key not in self._active_connections:
+                        # Create a new connection, setting its retain count to 1 (this instance)
+                        sig = dict(self.connection_signature)
+                        logger.debug('creating new amqp connection -> amqp.Connection(host=%r, virtual_host=%r...)', sig['host'], sig['virtual_host'])
+                        self._active_connections[self._key] = [1, amqp.Connection(**sig)]
+                        if metrics.enabled:
+                            metrics.incr('connections_opened', sig['host'])
+                    else:
+                        # A retain count is used for each connection to determine if, when closed,
+                        # an AMQPConnection may close the underlying connection, too.
+                        self._active_connections[self._key][0] += 1
+                    self.connection = self._active_connections[self._key][1]
             self.enabled = True
         else:
             self.connection = None
@@ -44,26 +77,41 @@ class AMQPConnection(object):
     def close(self, *args, **kwargs):
         """Closes any channels and possibly the connection, too. The connection
            will only be closed if there are no other AMQPConnection instances that
-           reference it."""
+           reference it. Pooled connections (and their default channel) are returned
+           to the pool instead."""
+        if self._closed:
+            return
+        self._closed = True
         # Close all channels
         for channel in self._channels:
-            logger.debug('closing channel -> channel.close(%r, %r)' % (args, kwargs))
+            logger.debug('closing channel -> channel.close(%r, %r)', args, kwargs)
             channel.close(*args, **kwargs)
+        if self.pool is not None:
+            # Hand everything back to the pool
+            if hasattr(self, '_channel'):
+                self.pool.checkin_channel(self.connection, self._channel)
+            logger.debug('returning connection to pool -> pool.checkin()')
+            self.pool.checkin(self.connection)
         # If this is the only AMQPConnection using the Connection, close it too
-        if self.enabled:
-            self._active_connections[self.connection_signature][0] -= 1
-            if self._active_connections[self.connection_signature][0] <= 0:
-                logger.debug('closing connection -> connection.close()')
-                self.connection.close()
-                del self._active_connections[self.connection_signature]
+        elif self.enabled:
+            with self._lock:
+                self._active_connections[self._key][0] -= 1
+                if self._active_connections[self._key][0] <= 0:
+                    logger.debug('closing connection -> connection.close()')
+                    self.connection.close()
+                    del self._active_connections[self._key]
+                    if metrics.enabled:
+                        metrics.incr('connections_closed', dict(self.connection_signature)['host'])
     
     def new_channel(self, *args, **kwargs):
         """Creates a new communication Channel bound to this Connection, passing
            the arguments specified to the Channel constructor."""
-        logger.debug('creating channel -> connection.channel(%r, %r)' % (args, kwargs))
+        logger.debug('creating channel -> connection.channel(%r, %r)', args, kwargs)
         if self.enabled:
             channel = self.connection.channel(*args, **kwargs)
             self._channels.append(channel)
+            if metrics.enabled:
+                metrics.incr('channels_opened', dict(self.connection_signature)['host'])
             return channel
         else:
             return None
@@ -74,10 +122,14 @@ class AMQPConnection(object):
            per AMQPConnection instance (note that this is not necessarily the same
            as one Channel per actual connection, but Channels are cheap anyway)."""
         if not hasattr(self, '_channel'):
-            self._channel = self.new_channel()
+            if self.pool is not None:
+                self._channel = self.pool.checkout_channel(self.connection)
+            else:
+                self._channel = self.new_channel()
         return self._channel
     
-    def _connection_signature(self, host=None, user=None, password=None,
+    @staticmethod
+    def _connection_signature(host=None, user=None, password=None,
                               vhost=None, insist=False, **kwargs):
         """Returns a 'connection signature', which is basically 'flattened' dictionary of arguments
            (tuple of 2-tuples) to be passed to the client's constructor. This is just a
@@ -1,25 +1,44 @@
 """Handles consuming messages from the AMQP server."""
 from __future__ import with_statement
 
-import threading
+import collections
+import errno
+import mmap
+import select
+import time
+import traceback
 from amqplib import client_0_8 as amqp
 
-from django.utils import simplejson
-
 from .utils.log import logger
 from .connection import AMQPConnection
+from . import claimcheck, metrics, serialization
 
 class Consumer(object):
+    """A Consumer receives messages from a single queue. Message bodies are decoded with the
+       codec matching their content_type (falling back to the codec named by codec, if the
+       type is missing or unknown) after undoing any compression named by their
+       content_encoding. Codecs which are only safe for trusted data, like pickle, are
+       refused unless trusted is True."""
     _declared_queues = []
+    codec = None
+    trusted = False
     
     def __init__(self, queue, exchange=None, routing_key=None, connection=None,
-                 channel=None, force_no_declare=False, tag=None, **kwargs):
+                 channel=None, force_no_declare=False, tag=None, prefetch_count=None, pooled=None,
+                 codec=None, trusted=None, **kwargs):
         # exchange is not required (but is recommended). Without it, the queue must
         # have already been declared manually.
         self.queue = queue
         self.exchange = exchange
         self.routing_key = routing_key
-        self.connection = (connection if connection is not None else AMQPConnection())
+        if codec is not None:
+            self.codec = codec
+        if trusted is not None:
+            self.trusted = trusted
+        # If no connection is passed, one is created (borrowed from the connection pool if
+        # pooled is True) and owned by this Consumer
+        self._owns_connection = (connection is None)
+        self.connection = (connection if connection is not None else AMQPConnection(pooled=pooled))
         self.channel = (channel if channel is not None else self.connection.channel)
         
         if self.queue not in self._declared_queues:
@@ -36,24 +55,50 @@ class Consumer(object):
                     'arguments': kwargs.pop('queue_arguments', None),
                     'ticket': kwargs.pop('ticket', None),
                 }
-                logger.debug('declaring queue -> channel.queue_declare(%r)' % queue_kwargs)
+                logger.debug('declaring queue -> channel.queue_declare(%r)', queue_kwargs)
                 self.channel.queue_declare(**queue_kwargs)
-                # ...and bind it to the exchange
+                # ...and bind it to the exchange (once for each routing key, if a list of
+                # them was passed)
                 bind_kwargs = {
                     'queue': self.queue,
                     'exchange': self.exchange,
-                    'routing_key': (routing_key if routing_key is not None else ''),
                     'nowait': kwargs.pop('nowait', False),
                     'arguments': kwargs.pop('bind_arguments', None),
                     'ticket': kwargs.pop('ticket', None),
                 }
-                logger.debug('binding queue -> channel.queue_bind(%r)' % bind_kwargs)
-                self.channel.queue_bind(**bind_kwargs)
+                if isinstance(routing_key, (list, tuple)):
+                    routing_keys = routing_key
+                else:
+                    routing_keys = [(routing_key if routing_key is not None else '')]
+                for key in routing_keys:
+                    bind_kwargs['routing_key'] = key
+                    logger.debug('binding queue -> channel.queue_bind(%r)', bind_kwargs)
+                    self.channel.queue_bind(**bind_kwargs)
             # Add to _declared_queues so it only gets declared once
             self._declared_queues.append(self.queue)
         
+        # Limit the number of unacknowledged messages the server will push at once
+        # (only takes effect for basic_consume-based iteration, not pop())
+        self.prefetch_count = prefetch_count
+        if self.prefetch_count is not None:
+            self.qos(self.prefetch_count)
+        # Delivery tags of the messages delivered but not yet acknowledged, whilst metrics are
+        # enabled (so that a multi-ack can be counted as however many messages it covers)
+        self._outstanding = set()
+        # Set by reset_window()
+        self._reset_window = False
+        
         return super(Consumer, self).__init__()
     
+    def close(self):
+        """Closes the connection, if it was created by (rather than passed to) this Consumer.
+           Pooled connections are returned to the pool."""
+        if self._owns_connection:
+            if self.prefetch_count is not None and self.connection.pool is not None:
+                # Channels must go back to the pool in their default state
+                self.qos(0)
+            self.connection.close()
+    
     def destroy_queue(self):
         """Destroys the queue this consumer represents."""
         self.channel.queue_delete(self.queue)
@@ -69,22 +114,98 @@ class Consumer(object):
     def decode(self, message):
         """A hook so that subclasses may decode messages into their own formats. Note that decoders
            should just manipulate the message passed (usually only changing message.body), since the
-           other attributes need to be preserved."""
+           other attributes need to be preserved. The body as it was received is kept as
+           message.raw_body (so that the message can be republished).
+           
+           The body of a claim-checked message is mapped in from the blob store (and the
+           references to the blob kept as message.claim_check, to be released once the
+           message is acknowledged, or straight away if it was consumed with no_ack). Without
+           a codec, the body is left as the read-only mmap."""
+        message.raw_body = message.body
+        properties = message.properties
+        refs = claimcheck.references(message)
+        if refs is not None:
+            message.body = claimcheck.get_store().open(refs)
+            message.claim_check = refs
+        encoding = properties.get('content_encoding')
+        if encoding in serialization.COMPRESSIONS:
+            message.body = serialization.decompress(encoding, message.body)
+        codec = (serialization.get_codec(properties.get('content_type')) or
+                 (serialization.get_codec(self.codec) if self.codec is not None else None))
+        if codec is None:
+            return message
+        if codec.trusted_only and not self.trusted:
+            raise serialization.DecodeError('refusing to decode %s message from an untrusted consumer' % codec.content_type)
+        if isinstance(message.body, mmap.mmap):
+            # Codecs need a string
+            message.body = message.body[:]
+        message.body = codec.decode(message.body)
         return message
     
+    def _decode(self, message, keep_undecodable):
+        """Decodes a message delivered to an iterator. If keep_undecodable is True, a message
+           which can't be decoded is returned as it is, with the exception as its decode_error
+           attribute and the formatted traceback as its decode_traceback, rather than the
+           exception being raised (and ending the iteration)."""
+        if not keep_undecodable:
+            return self.decode(message)
+        try:
+            return self.decode(message)
+        except Exception, e:
+            message.decode_error = e
+            message.decode_traceback = traceback.format_exc()
+            return message
+    
     def pop(self):
         """Pops the next waiting message from the queue, raising IndexError (just
            like the standard Python pop() functions) if none are waiting."""
-        logger.debug('popping message -> channel.basic_get(%r)' % self.queue)
+        logger.debug('popping message -> channel.basic_get(%r)', self.queue)
         message = self.channel.basic_get(self.queue)
         if not message:
             raise IndexError
+        if metrics.enabled:
+            self._delivered(metrics.stamp(message), no_ack=False)
         return self.decode(message)
     
-    def acknowledge(self, message):
-        """Acknowledges delivery of the passed Message instance."""
-        logger.debug('acknowledging message -> channel.basic_ack(delivery_tag=%r)' % message.delivery_tag)
-        self.channel.basic_ack(delivery_tag=message.delivery_tag)
+    def qos(self, prefetch_count, prefetch_size=0):
+        """Sets the prefetch window for this Consumer's channel, i.e. how many messages
+           the server will deliver ahead of them being acknowledged."""
+        logger.debug('setting prefetch window -> channel.basic_qos(prefetch_size=%r, prefetch_count=%r)', prefetch_size, prefetch_count)
+        self.channel.basic_qos(prefetch_size=prefetch_size, prefetch_count=prefetch_count, a_global=False)
+    
+    def reset_window(self):
+        """Gives the prefetch window a fresh start, for when messages are being left
+           unacknowledged for good (until the channel closes), which would otherwise use it up
+           for whatever iterator is running. The iterator cancels its subscription (rejecting
+           any messages it hasn't handed out) and starts a new one, which the server counts
+           unacknowledged messages for afresh."""
+        if self.prefetch_count:
+            self._reset_window = True
+    
+    def acknowledge(self, message, multiple=False):
+        """Acknowledges delivery of the passed Message instance. If multiple is True, every
+           message up to and including this one received on the channel is acknowledged."""
+        logger.debug('acknowledging message -> channel.basic_ack(delivery_tag=%r, multiple=%r)', message.delivery_tag, multiple)
+        self.channel.basic_ack(delivery_tag=message.delivery_tag, multiple=multiple)
+        _release(message)
+        if metrics.enabled:
+            acked = set([message.delivery_tag])
+            if multiple:
+                acked.update(tag for tag in self._outstanding if tag <= message.delivery_tag)
+            self._outstanding.difference_update(acked)
+            metrics.incr('acked', self.queue, len(acked))
+    
+    def acknowledge_batch(self, messages):
+        """Acknowledges every message in the passed batch with a single basic_ack, using
+           the highest delivery tag and the multiple flag. Note that this also acknowledges
+           any earlier messages on the channel which are still outstanding."""
+        if not messages:
+            return
+        last = max(messages, key=lambda message: message.delivery_tag)
+        self.acknowledge(last, multiple=True)
+        for message in messages:
+            if message is not last:
+                _release(message)
     
     def subscribe(self, callback):
         """Calls the callback passed whenever a new message is available. Once invoked, this
@@ -98,85 +219,380 @@ class Consumer(object):
         # (we need the access to this Consumer and the original callback).
         class FakeCallback(object):
             def __new__(self, *args, **kwargs):
+                if metrics.enabled:
+                    self.consumer._delivered(args[0], no_ack=False)
                 args = list(args) # tuples are immutable, so have to convert temporarily to list
                 args[0] = self.consumer.decode(args[0]) # ...decode the message
                 args = tuple(args) # ...and then back to a tuple
                 
                 # Call the callback, acknowledge success of the message if it succeeds, and return
                 # the callback's response.
-                logger.debug('calling message callback -> %r(%r, %r)' % (self.callback, args, kwargs))
+                # (the message itself is kept out of the log, since payloads can be huge)
+                logger.debug('calling message callback -> %r(<msg delivery_tag=%r>)', self.callback, getattr(args[0], 'delivery_tag', None))
                 ret = self.callback(*args, **kwargs)
                 self.consumer.acknowledge(message=args[0])
                 return ret
         FakeCallback.consumer = self
         FakeCallback.callback = staticmethod(callback)
         
-        logger.debug('subscribing to new messages -> channel.basic_consume(queue=%r...)' % self.queue)
+        logger.debug('subscribing to new messages -> channel.basic_consume(queue=%r...)', self.queue)
         consumer_tag = self.channel.basic_consume(queue=self.queue, no_ack=False, callback=FakeCallback)
         try:
             while True:
                 self.connection.channel.wait()
         finally:
-            logger.debug('cancelling message subscription -> channel.basic_cancel(consumer_tag=%r)' % consumer_tag)
+            logger.debug('cancelling message subscription -> channel.basic_cancel(consumer_tag=%r)', consumer_tag)
             self.channel.basic_cancel(consumer_tag=consumer_tag)
     
-    def message_iterator(self, no_ack=False, limit=None):
+    def _wait(self, timeout=None, wakeup=None):
+        return _wait(self.channel, timeout, wakeup)
+    
+    def _delivered(self, message, no_ack):
+        """Counts a message as delivered (and, unless no_ack was set, as outstanding until
+           it's acknowledged)."""
+        metrics.incr('delivered', self.queue)
+        if not no_ack:
+            self._outstanding.add(message.delivery_tag)
+    
+    def _start_consuming(self, no_ack):
+        """Starts a basic_consume subscription whose deliveries are appended to a buffer,
+           returning a (consumer_tag, buffer) tuple. Deliveries are only made whilst the
+           channel is being waited on, so there are no threads involved."""
+        buffer = collections.deque()
+        callback = buffer.append
+        if metrics.enabled:
+            def callback(message):
+                buffer.append(metrics.stamp(message))
+                self._delivered(message, no_ack)
+        logger.debug('subscribing to new messages -> channel.basic_consume(queue=%r, no_ack=%r...)', self.queue, no_ack)
+        tag = self.channel.basic_consume(queue=self.queue, no_ack=no_ack, callback=callback)
+        return tag, buffer
+    
+    def _stop_consuming(self, tag, buffer, no_ack):
+        """Cancels a subscription started with _start_consuming. Any messages which were
+           delivered but never handed out are rejected back onto the queue."""
+        # The consumer must always be cancelled
+        logger.debug('cancelling message subscription -> channel.basic_cancel(consumer_tag=%r)', tag)
+        self.channel.basic_cancel(consumer_tag=tag)
+        if not no_ack:
+            # Deliveries which crossed the cancellation on the wire were queued up on the
+            # channel, and amqplib would drop them (leaving them unacknowledged) now that the
+            # subscription's callback has gone, so they're taken into the buffer, too
+            self.channel.callbacks[tag] = buffer.append
+            try:
+                while self.channel.method_queue:
+                    self.channel.wait()
+            finally:
+                del self.channel.callbacks[tag]
+            while buffer:
+                message = buffer.popleft()
+                logger.debug('requeueing undelivered message -> channel.basic_reject(delivery_tag=%r)', message.delivery_tag)
+                self.channel.basic_reject(delivery_tag=message.delivery_tag, requeue=True)
+                self._outstanding.discard(message.delivery_tag)
+    
+    def _restart_consuming(self, tag, buffer, no_ack):
+        """Replaces a subscription with a new one (see reset_window)."""
+        self._reset_window = False
+        logger.debug('resetting prefetch window.')
+        self._stop_consuming(tag, buffer, no_ack)
+        return self._start_consuming(no_ack)
+    
+    def message_iterator(self, no_ack=False, limit=None, idle_timeout=None, wakeup=None,
+                         keep_undecodable=False):
         """Returns a generator that yields new messages as they are popped off the message queue.
            Will yield messages forever, waiting for new messages to become available if non are already
            in the queue.
            
            Messages will need to be acknowledged manually, through Consumer.acknowledge(), unless
-           no_ack is True."""
-        # --- Locks and events --- #
-        event_lock = threading.Lock()         # acquired with manipulating events
-        message_available = threading.Event() # set when a message is available for processing
-        waiting = threading.Event()           # set when messages are being waited for (to avoid message loss)
-        waiting.set()
-        
-        class FakeCallback(object):
-            def __new__(self, message):
-                logger.debug('message received (routing_key=%r). passing back to main control through event.' % getattr(message, 'routing_key', None))
-                with self.event_lock:
-                    self.waiting.wait()
-                    self.message_available.result = message
-                    self.message_available.set()
-                return None
-        FakeCallback.event_lock = event_lock
-        FakeCallback.message_available = message_available
-        FakeCallback.waiting = waiting
-        
-        # This is a little intense, a lotta coordination :)
-        logger.debug('subscribing to new messages -> channel.basic_consume(queue=%r, no_ack=%r...)' % (self.queue, no_ack))
-        tag = self.channel.basic_consume(queue=self.queue, no_ack=no_ack, callback=FakeCallback)
-        iterations = 0
+           no_ack is True. If idle_timeout is given, None is yielded whenever that many seconds
+           pass without a message arriving, so the caller gets a chance to do other work. None
+           is also yielded whenever wakeup (anything with a fileno()) becomes readable.
+           
+           If a message can't be decoded, the error is raised from the generator, unless
+           keep_undecodable is True, when the message is yielded undecoded, with its
+           decode_error set."""
+        tag, buffer = self._start_consuming(no_ack)
+        yielded = 0
         try:
-            while True:
-                # optionally apply the limit
-                iterations += 1
-                if limit is not None and iterations >= limit:
-                    raise StopIteration
-                # limit passed okay...
-                self.channel.wait() # wait for the next message
-                if message_available.isSet(): # a new message is available to be yielded
-                    logger.debug('retrieving message from event.')
-                    with event_lock:
-                        waiting.clear()
-                        logger.debug('yielding message.')
-                        yield self.decode(message_available.result)
-                        logger.debug('message loop continuing.')
-                        # moving on, garbage the previous message and reset the locks
-                        del message_available.result
-                        message_available.clear()
-                        waiting.set()
-        except StopIteration:
-            return
+            while limit is None or yielded < limit:
+                if self._reset_window:
+                    tag, buffer = self._restart_consuming(tag, buffer, no_ack)
+                while not buffer:
+                    if not self._wait(idle_timeout, wakeup): # wait for the next message
+                        break
+                if not buffer:
+                    yield None
+                    continue
+                yielded += 1
+                message = self._decode(buffer.popleft(), keep_undecodable)
+                if no_ack:
+                    _release(message)
+                yield message
         finally:
-            # The consumer must always be cancelled
-            logger.debug('cancelling message subscription -> channel.basic_cancel(consumer_tag=%r)' % tag)
-            self.channel.basic_cancel(consumer_tag=tag)
+            self._stop_consuming(tag, buffer, no_ack)
+    
+    def batch_iterator(self, size, max_wait=None, no_ack=False, limit=None, idle_timeout=None,
+                       keep_undecodable=False):
+        """Returns a generator that yields lists of up to size messages. Once the first message
+           of a batch has arrived, the batch is yielded when it is full or when max_wait seconds
+           have passed, whichever happens first (a max_wait of None always waits for a full
+           batch). limit caps the total number of messages. Empty batches are only yielded
+           if idle_timeout is given, whenever that many seconds pass without a message
+           arriving.
+           
+           Batches will need to be acknowledged manually, usually through
+           Consumer.acknowledge_batch() (which uses a single multi-ack), unless no_ack is True.
+           It's a good idea to set a prefetch_count of at least size on the Consumer.
+           keep_undecodable is as for message_iterator()."""
+        tag, buffer = self._start_consuming(no_ack)
+        yielded = 0
+        try:
+            while limit is None or yielded < limit:
+                if self._reset_window:
+                    tag, buffer = self._restart_consuming(tag, buffer, no_ack)
+                wanted = (size if limit is None else min(size, limit - yielded))
+                # Block until the batch has at least one message in it...
+                while not buffer:
+                    if not self._wait(idle_timeout):
+                        break
+                if not buffer:
+                    yield []
+                    continue
+                # ...and then fill up the rest of it until the deadline
+                deadline = (time.time() + max_wait if max_wait is not None else None)
+                while len(buffer) < wanted:
+                    timeout = (deadline - time.time() if deadline is not None else None)
+                    if timeout is not None and timeout <= 0:
+                        break
+                    if not self._wait(timeout):
+                        break
+                batch = [self._decode(buffer.popleft(), keep_undecodable) for i in xrange(min(wanted, len(buffer)))]
+                if no_ack:
+                    for message in batch:
+                        _release(message)
+                yielded += len(batch)
+                logger.debug('yielding batch of %d messages.', len(batch))
+                yield batch
+        finally:
+            self._stop_consuming(tag, buffer, no_ack)
+
+def _wait(channel, timeout=None, wakeup=None):
+    """Waits for the next method to arrive on the channel, returning False if timeout
+       seconds pass without one arriving (or True otherwise). A timeout of None
+       blocks forever. If wakeup (anything with a fileno()) becomes readable first, or
+       the wait is interrupted by a signal, False is returned, too.
+       
+       The connection may be shared with other channels, so methods are read off it one at
+       a time (those for other channels being queued up for them, just as amqplib does),
+       until one for this channel arrives or the time is up."""
+    if (timeout is None and wakeup is None) or channel.method_queue:
+        channel.wait()
+        return True
+    deadline = (time.time() + max(timeout, 0) if timeout is not None else None)
+    connection = channel.connection
+    sock = connection.transport.sock
+    while True:
+        if not _buffered(connection):
+            remaining = (max(deadline - time.time(), 0) if deadline is not None else None)
+            try:
+                readable = select.select([sock] + ([wakeup] if wakeup is not None else []), [], [], remaining)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                # Give the caller a chance to act on whatever the signal handler did
+                return False
+            if sock not in readable:
+                return False
+        if _read_method(channel):
+            return True
+
+def _read_method(channel):
+    """Reads the next method off the channel's connection, returning True if it was for the
+       channel (and has been dispatched to it)."""
+    connection = channel.connection
+    channel_id, method_sig, args, content = connection.method_reader.read_method()
+    if channel_id == channel.channel_id:
+        channel.dispatch_method(method_sig, args, content)
+        return True
+    # (the connection itself is channel 0)
+    other = connection.channels[channel_id]
+    if channel_id != 0 and method_sig in amqp.Channel._IMMEDIATE_METHODS:
+        other.dispatch_method(method_sig, args, content)
+        return False
+    other.method_queue.append((method_sig, args, content))
+    if channel_id == 0:
+        # Probably the connection being closed, which is dealt with straight away
+        connection.wait()
+    return False
+
+def _release(message):
+    """Releases a message's reference to its claim-checked body, if it has one (the body
+       stays mapped in)."""
+    if getattr(message, 'claim_check', None):
+        claimcheck.get_store().release(message.claim_check)
+        message.claim_check = None
+
+def _buffered(connection):
+    """Returns True if data has already been read off the connection's socket (in which case
+       the socket won't select as readable even though there's something to read)."""
+    reader = getattr(connection, 'method_reader', None)
+    if reader is not None and not reader.queue.empty():
+        return True
+    transport = connection.transport
+    if getattr(transport, '_read_buffer', None):
+        return True
+    # (SSL transports decrypt whole records, which may hold more than has been read yet)
+    sslobj = getattr(transport, 'sslobj', None)
+    return bool(sslobj is not None and hasattr(sslobj, 'pending') and sslobj.pending())
 
 class JSONConsumer(Consumer):
     """Consumer which handles consuming JSON-encoded messages."""
-    def decode(self, message):
-        message.body = simplejson.loads(message.body)
-        return message
+    codec = 'json'
+
+class _Queue(object):
+    """A queue registered with a MultiConsumer, and its state whilst being consumed from."""
+    def __init__(self, consumer, handler, weight, prefetch_count):
+        self.name = consumer.queue
+        self.consumer = consumer
+        self.handler = handler
+        self.weight = weight
+        self.prefetch_count = prefetch_count
+        self.credit = 0
+        self.tag = None
+        self.buffer = None
+
+class MultiConsumer(object):
+    """Consumes from many queues over a single channel, in a single wait loop. Each queue is
+       read through a Consumer of its own (so is declared, and its messages decoded, just as
+       it would be on its own), and may have its own handler, weight and prefetch_count.
+       
+       When messages are waiting on several queues, they're handed out in proportion to the
+       queues' weights (smooth weighted round robin), so that a busy queue can't starve a
+       quiet one. Per-queue prefetch windows rely on the broker applying basic_qos to each
+       consumer started after it, as RabbitMQ does. All the queues' messages share the
+       channel's delivery tags, so they can't be acknowledged with multi-acks."""
+    def __init__(self, connection=None, channel=None, pooled=None):
+        self._owns_connection = (connection is None)
+        self.connection = (connection if connection is not None else AMQPConnection(pooled=pooled))
+        self.channel = (channel if channel is not None else self.connection.channel)
+        self.prefetch_count = None
+        self.consumers = {} # queue name -> Consumer
+        self._queues = []
+        self._reset_window = False # set by reset_window()
+        return super(MultiConsumer, self).__init__()
+    
+    def add(self, queue, handler=None, weight=1, prefetch_count=None, consumer_class=Consumer, **kwargs):
+        """Registers a queue, creating (and returning) a consumer_class for it on the shared
+           channel; extra keyword arguments are passed to its constructor. handler is called
+           with each of the queue's messages by run()."""
+        assert queue not in self.consumers, 'queue %r is already registered' % queue
+        assert weight > 0, 'weight must be positive'
+        consumer = consumer_class(queue=queue, connection=self.connection, channel=self.channel, **kwargs)
+        self._queues.append(_Queue(consumer, handler, weight, prefetch_count))
+        self.consumers[queue] = consumer
+        return consumer
+    
+    def close(self):
+        """Closes the connection, if it was created by (rather than passed to) this
+           MultiConsumer. Pooled connections are returned to the pool."""
+        if self._owns_connection:
+            if self.connection.pool is not None:
+                # Channels must go back to the pool in their default state
+                self.channel.basic_qos(prefetch_size=0, prefetch_count=0, a_global=False)
+            self.connection.close()
+    
+    def qos(self, prefetch_count):
+        """Sets the prefetch window for queues which weren't given one of their own. It takes
+           effect the next time consuming starts."""
+        self.prefetch_count = prefetch_count
+    
+    def reset_window(self):
+        """Like Consumer.reset_window(), but for every queue's window."""
+        for queue in self._queues:
+            if queue.prefetch_count or self.prefetch_count:
+                self._reset_window = True
+    
+    def acknowledge(self, message):
+        """Acknowledges delivery of a message yielded by message_iterator()."""
+        self.consumers[message.queue].acknowledge(message)
+    
+    def run(self, **kwargs):
+        """Passes each message to its queue's handler, acknowledging it once the handler
+           returns (an exception from a handler leaves its message unacknowledged, and ends
+           the loop). Keyword arguments are passed to message_iterator()."""
+        handlers = dict((queue.name, queue.handler) for queue in self._queues)
+        assert None not in handlers.values(), 'every queue needs a handler'
+        for message in self.message_iterator(**kwargs):
+            if message is None:
+                continue
+            logger.debug('calling message handler -> %r(<msg delivery_tag=%r>)', handlers[message.queue], message.delivery_tag)
+            handlers[message.queue](message)
+            self.acknowledge(message)
+    
+    def message_iterator(self, no_ack=False, limit=None, idle_timeout=None, wakeup=None,
+                         keep_undecodable=False):
+        """Like Consumer.message_iterator(), but yields messages from all the queues. The name
+           of the queue each message came from is set as its queue attribute."""
+        yielded = 0
+        try:
+            self._start_consuming(no_ack)
+            while limit is None or yielded < limit:
+                if self._reset_window:
+                    self._reset_window = False
+                    logger.debug('resetting prefetch windows.')
+                    self._stop_consuming(no_ack)
+                    self._start_consuming(no_ack)
+                while not self._waiting():
+                    if not _wait(self.channel, idle_timeout, wakeup): # wait for the next message
+                        break
+                if not self._waiting():
+                    yield None
+                    continue
+                # Take in whatever else has already arrived, so that every queue with
+                # messages waiting gets its share of the turns
+                while _wait(self.channel, 0):
+                    pass
+                queue = self._next()
+                message = queue.consumer._decode(queue.buffer.popleft(), keep_undecodable)
+                message.queue = queue.name
+                if no_ack:
+                    _release(message)
+                yielded += 1
+                yield message
+        finally:
+            self._stop_consuming(no_ack)
+    
+    def _waiting(self):
+        for queue in self._queues:
+            if queue.buffer:
+                return True
+        return False
+    
+    def _next(self):
+        """Picks the queue to take the next message from: each queue with messages waiting
+           earns credit in proportion to its weight, and the one with the most credit is
+           charged for the turn."""
+        best = None
+        total = 0
+        for queue in self._queues:
+            if queue.buffer:
+                queue.credit += queue.weight
+                total += queue.weight
+                if best is None or queue.credit > best.credit:
+                    best = queue
+        best.credit -= total
+        return best
+    
+    def _start_consuming(self, no_ack):
+        for queue in self._queues:
+            prefetch_count = (queue.prefetch_count if queue.prefetch_count is not None else self.prefetch_count)
+            # (applies to the consumer started next, and to none of the others)
+            queue.consumer.qos(prefetch_count or 0)
+            queue.tag, queue.buffer = queue.consumer._start_consuming(no_ack)
+            queue.credit = 0
+    
+    def _stop_consuming(self, no_ack):
+        for queue in self._queues:
+            if queue.tag is not None:
+                queue.consumer._stop_consuming(queue.tag, queue.buffer, no_ack)
+                queue.tag = None
@@ -1,60 +1,647 @@
 """Convenience stuff for working with long-running message consumer processes."""
 from __future__ import with_statement
+import errno
+import fcntl
+import mmap
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
 import traceback
 
-from django.core.mail import mail_admins
-from django.template.loader import render_to_string
-
+from .utils.db import transaction
+from .utils.fork import after_fork
 from .utils.log import logger
-import .consumer as consumer
+from .connection import AMQPConnection
+from . import consumer, metrics, reporting
+from .retry import ROUTING_KEY_HEADER, RetryPolicy
+from .routing import RoutingTable
+
+class HandlerError(Exception):
+    """Raised in place of an exception from process_message which happened in a child
+       process (where the original exception can't be re-raised). The traceback of the
+       original exception is available as the traceback attribute."""
+    def __init__(self, traceback):
+        self.traceback = traceback
+        return super(HandlerError, self).__init__(traceback)
 
 class ConsumerProcess(object):
     queue = NotImplemented
     consumer_class = consumer.JSONConsumer
     consumer_args = {}
     auto_ack = True
+    # To consume from several queues over a single channel, set queues (instead of queue) to
+    # a dict mapping each queue's name to its options: the consumer_args for its Consumer,
+    # plus optionally 'handler' (the name of the method its messages are passed to, rather
+    # than process_message), 'weight', 'prefetch_count' and 'consumer_class' (see
+    # consumer.MultiConsumer)
+    queues = None
+    # Handlers by routing key: a sequence of (pattern, method name) tuples, where patterns
+    # follow topic exchange rules ('*' matches a word, '#' any number of them; see the
+    # routing module). A message is passed to each method with a matching pattern, or to
+    # process_message (or its queue's handler) if none match. Unless consumer_args gives a
+    # routing_key, the queue is bound with the patterns, so the exchange should be a topic one
+    routes = None
+    # Handler concurrency: executor is None (process messages serially), 'thread' or
+    # 'process', and concurrency is the number of messages allowed in flight at once. The
+    # 'process' executor's children call process_message on an instance whose __init__ has
+    # never run, so handlers mustn't rely on anything it sets
+    executor = None
+    concurrency = 1
+    # How often (in seconds) the consume loop wakes up to acknowledge finished messages
+    # whilst no new messages are arriving
+    poll_interval = 0.1
+    # Where errors are reported; None means the shared reporting.ErrorReporter, which
+    # emails aggregated digests to the site admins
+    error_reporter = None
+    # In fault-tolerant mode, a message which fails is retried after retry_delay seconds
+    # (multiplied by retry_backoff for each further attempt, up to retry_max_delay) until it
+    # has been tried max_attempts times, when it's sent to the dead letter exchange (see the
+    # retry module). If max_attempts is None, failed messages are left unacknowledged.
+    max_attempts = None
+    retry_delay = 1
+    retry_backoff = 2
+    retry_max_delay = 300
+    dead_letter_exchange = None
+    # Transaction batching: if batch_size is set, messages are processed in batches of up to
+    # that many (or however many arrive within batch_max_wait seconds), each batch inside a
+    # single database transaction (see process_batch)
+    batch_size = None
+    batch_max_wait = 0.1
+    # Coalescing: if coalesce_window is set, messages are gathered for up to that many seconds
+    # (or until coalesce_max have arrived) and grouped by coalesce_key, and process_coalesced
+    # is called once for each group
+    coalesce_window = None
+    coalesce_max = 1000
+    # Deduplication: if dedup_cache is set (to one of the dedup module's caches), messages
+    # whose dedup_key has been seen before are acknowledged without being processed again
+    # (even without auto_ack, since no handler ever sees them)
+    dedup_cache = None
+    # Set by stop()
+    _stopped = False
+    # Failed messages which were left unacknowledged; while there are any, acknowledging a
+    # batch with a multi-ack would acknowledge them too
+    _unacked_failures = 0
     
     def __init__(self, **kwargs):
-        assert self.queue is not NotImplemented # not optional
+        assert self.queue is not NotImplemented or self.queues # not optional
         # Create the consumer
-        consumer_args = self.consumer_args.copy()
-        consumer_args['queue'] = self.queue
-        self.consumer = self.consumer_class(**consumer_args)
+        if self.queues:
+            self.consumer = consumer.MultiConsumer()
+            for name, options in sorted(self.queues.items()):
+                options = dict(options)
+                options.pop('handler', None)
+                options.setdefault('consumer_class', self.consumer_class)
+                self.consumer.add(name, **options)
+            consumers = self.consumer.consumers.values()
+        else:
+            consumer_args = self.consumer_args.copy()
+            consumer_args['queue'] = self.queue
+            if self.routes and 'routing_key' not in consumer_args:
+                consumer_args['routing_key'] = self.routing_table().bindings()
+            self.consumer = self.consumer_class(**consumer_args)
+            consumers = [self.consumer]
+        # Each queue retries its failed messages through its own delay queues
+        self.retry_policies = {}
+        if self.max_attempts is not None:
+            for queue_consumer in consumers:
+                self.retry_policies[queue_consumer.queue] = RetryPolicy(
+                    queue_consumer, self.max_attempts, self.retry_delay, self.retry_backoff,
+                    self.retry_max_delay, self.dead_letter_exchange)
         
         return super(ConsumerProcess, self).__init__(**kwargs)
     
+    @property
+    def retry_policy(self):
+        """The RetryPolicy of a process consuming from a single queue (or None if it hasn't
+           got one). Processes with several queues have one per queue, in retry_policies."""
+        return self.retry_policies.get(self.queue)
+    
+    @retry_policy.setter
+    def retry_policy(self, retry_policy):
+        assert not self.queues, 'set retry_policies for a process with several queues'
+        if retry_policy is None:
+            self.retry_policies.pop(self.queue, None)
+        else:
+            self.retry_policies[self.queue] = retry_policy
+    
     def process_message(self, message):
         """Does the 'meat' of the processing work (must be implemented by
            subclasses)."""
         raise NotImplementedError
     
-    def run(self, fault_tolerant=True, **kwargs):
+    def process_batch(self, messages):
+        """Processes a batch of messages, when batch_size is set. It's called inside a database
+           transaction, which is committed (and the messages acknowledged) if it returns. If it
+           raises, the transaction is rolled back and the batch split in two, each half being
+           retried in its own transaction, until the failing message is on its own. Anything
+           done outside the database (other than publishing messages, which waits for the
+           commit) may therefore happen more than once for a message.
+           
+           By default, calls process_message with each message in turn."""
+        for message in messages:
+            self.process_message(message)
+    
+    def coalesce_key(self, message):
+        """Returns the key a message is coalesced on (see coalesce_window), e.g. the id of
+           the entity it's about. Messages whose key is None (as every message's is, unless
+           this is overridden) are never coalesced."""
+        return None
+    
+    def process_coalesced(self, key, messages):
+        """Processes the messages with the same coalesce_key which arrived within a
+           coalescing window (in the order they arrived). By default, only the latest is
+           processed (by process_message, or whichever handler routes choose); override this
+           to merge them instead. Once it returns, the messages are acknowledged (along with
+           the rest of the window's, in a single multi-ack)."""
+        self._dispatch(messages[-1])
+    
+    def dedup_key(self, message):
+        """Returns the key a message is deduplicated on, when there's a dedup_cache: its
+           message_id, unless overridden (to derive a key from the body, say). Messages whose
+           key is None are never taken to be duplicates."""
+        return message.properties.get('message_id')
+    
+    def handle_error(self, message, tb, fault_tolerant):
+        """Called with the formatted traceback when processing a message fails. The error is
+           reported in the background, so this doesn't hold up consuming."""
+        logger.critical(tb)
+        reporter = (self.error_reporter if self.error_reporter is not None else reporting.get_reporter())
+        reporter.report(message, tb, fault_tolerant)
+        if not fault_tolerant:
+            # The worker is about to die, so make sure the report gets out first
+            reporter.flush(timeout=30)
+    
+    def stop(self):
+        """Makes run() return once the message (or batch) in hand has been dealt with. It's
+           safe to call from a signal handler; run() notices as soon as the channel is idle,
+           so should be given an idle_timeout if messages may be slow to arrive."""
+        self._stopped = True
+    
+    def run(self, fault_tolerant=True, executor=None, concurrency=None, **kwargs):
+        """Consumes messages forever (or up to limit messages, if passed), passing each to
+           process_message. Extra keyword arguments are passed to Consumer.message_iterator
+           (or to Consumer.batch_iterator, when batching).
+           
+           Messages which can't be decoded are dealt with as though processing them had
+           failed, except that they're dead-lettered without being retried (there being no
+           point), if max_attempts is set.
+           
+           executor and concurrency override the class attributes of the same names. With
+           an executor, process_message is run on a pool of that many threads or processes
+           while this thread keeps the channel (and acknowledges messages as they finish).
+           If batch_size is set, messages are instead processed in batches by process_batch,
+           and if coalesce_window is set, in groups by process_coalesced."""
+        executor = (executor if executor is not None else self.executor)
+        concurrency = (concurrency if concurrency is not None else self.concurrency)
+        kwargs['keep_undecodable'] = True
+        if self.coalesce_window is not None:
+            assert executor is None, 'coalesce_window cannot be used with an executor'
+            assert self.batch_size is None, 'coalesce_window cannot be used with batch_size'
+            assert not self.queues, 'coalesce_window cannot be used with several queues'
+            return self._run_coalescing(fault_tolerant, **kwargs)
+        if self.batch_size is not None:
+            assert executor is None, 'batch_size cannot be used with an executor'
+            # (nor with several queues, whose messages can't be acknowledged with multi-acks)
+            assert not self.queues, 'batch_size cannot be used with several queues'
+            return self._run_batched(fault_tolerant, **kwargs)
+        if executor is None:
+            return self._run_serial(fault_tolerant, **kwargs)
+        return self._run_concurrent(fault_tolerant, executor, concurrency, **kwargs)
+    
+    @classmethod
+    def routing_table(cls):
+        """Returns the RoutingTable compiled from routes (which is only done once per class)."""
+        table = cls.__dict__.get('_routing_table')
+        if table is None:
+            table = cls._routing_table = RoutingTable(cls.routes or ())
+        return table
+    
+    def _dispatch(self, message):
+        """Passes a message to the handlers whose routes match its routing key or, failing
+           that, to process_message (or the handler of the queue it came from)."""
+        handlers = ()
+        if self.routes:
+            # Retried messages come back from their delay queue under a different routing key
+            headers = message.properties.get('application_headers') or {}
+            routing_key = headers.get(ROUTING_KEY_HEADER, message.delivery_info.get('routing_key', ''))
+            handlers = self.routing_table().match(routing_key)
+        if not handlers:
+            handler = 'process_message'
+            if self.queues:
+                handler = self.queues[message.queue].get('handler', handler)
+            handlers = (handler,)
+        for handler in handlers:
+            getattr(self, handler)(message)
+    
+    def _retry(self, message, tb, retryable=True):
+        """Hands a failed message to the retry policy of the queue it came from, returning
+           False if there isn't one (in which case the message is left unacknowledged)."""
+        retry_policy = self.retry_policies.get(getattr(message, 'queue', self.queue))
+        if retry_policy is None:
+            return False
+        retry_policy.retry(message, tb, retryable)
+        return True
+    
+    def _leave_unacknowledged(self):
+        """Records that a failed message is being left unacknowledged, to be redelivered once
+           the channel closes. Since it'd hold its place in the prefetch window until then,
+           the window is reset (see Consumer.reset_window)."""
+        self._unacked_failures += 1
+        self.consumer.reset_window()
+    
+    def _widen_prefetch(self, prefetch_count):
+        """Sets the consumer's prefetch window, unless it was given one of its own. It's
+           recorded as the consumer's prefetch_count, so that closing the consumer resets it
+           (before a pooled channel goes back to the pool)."""
+        if self.consumer.prefetch_count is None:
+            self.consumer.qos(prefetch_count)
+            self.consumer.prefetch_count = prefetch_count
+    
+    def _skip(self, message, fault_tolerant):
+        """Returns True if the message has been dealt with without being processed, because it
+           couldn't be decoded or has already been processed."""
+        if getattr(message, 'decode_error', None) is None:
+            return self._duplicate(message)
+        if metrics.enabled:
+            metrics.incr('failed', getattr(message, 'queue', self.queue))
+        tb = message.decode_traceback
+        self.handle_error(message, tb, fault_tolerant)
+        if not fault_tolerant:
+            raise message.decode_error
+        if not self._retry(message, tb, retryable=False):
+            self._leave_unacknowledged()
+        return True
+    
+    def _duplicate(self, message):
+        """Returns True (having acknowledged it) if the message has already been processed."""
+        if self.dedup_cache is None:
+            return False
+        key = self.dedup_key(message)
+        if key is None or key not in self.dedup_cache:
+            return False
+        queue = getattr(message, 'queue', self.queue)
+        logger.info('skipping duplicate message %r from %s', key, queue)
+        if metrics.enabled:
+            metrics.incr('duplicates', queue)
+        # (whatever auto_ack says, since no handler gets the chance to)
+        self.consumer.acknowledge(message)
+        return True
+    
+    def _processed(self, message):
+        """Remembers that a message has been processed (before it's acknowledged, so that
+           it's recognised if it's redelivered before the acknowledgement gets through)."""
+        if self.dedup_cache is not None:
+            key = self.dedup_key(message)
+            if key is not None:
+                self.dedup_cache.add(key)
+    
+    def _record(self, message, started, finished, failed):
+        """Records metrics for a message which has been through process_message."""
+        queue = getattr(message, 'queue', self.queue)
+        metrics.observe('delivery_latency', queue, started - getattr(message, 'received_at', started))
+        metrics.observe('handler_time', queue, finished - started)
+        if failed:
+            metrics.incr('failed', queue)
+    
+    def _run_serial(self, fault_tolerant, **kwargs):
         for message in self.consumer.message_iterator(**kwargs):
+            if message is None:
+                # Nothing arrived within the idle_timeout
+                if self._stopped:
+                    break
+                continue
+            if self._skip(message, fault_tolerant):
+                continue
+            timed = metrics.enabled
+            if timed:
+                started = time.time()
             try:
-                self.process_message(message)
+                self._dispatch(message)
             except NotImplementedError:
                 # Subclassing ain't happened
                 raise
             except:
-                # Email the exception details to the site admins
+                if timed:
+                    self._record(message, started, time.time(), failed=True)
                 tb = traceback.format_exc()
-                logger.critical(tb)
-                mail_admins(
-                    fail_silently=False, # there truly is no hope if this fails
-                    subject='Queue worker error',
-                    message=render_to_string('hare/worker_error.txt', {
-                        'traceback': tb,
-                        'message': message,
-                        'fault_tolerant': fault_tolerant,
-                    })
-                )
-                logger.info('Traceback has been emailed with mail_admins()')
+                self.handle_error(message, tb, fault_tolerant)
                 if not fault_tolerant:
                     # Not in fault-tolerant mode, so re-raise (which will likely
                     # cause a termination)
                     raise
+                if not self._retry(message, tb):
+                    self._leave_unacknowledged()
             else:
+                if timed:
+                    self._record(message, started, time.time(), failed=False)
+                self._processed(message)
                 # Processing must have succeeded; auto-acknowledge
                 if self.auto_ack:
                     self.consumer.acknowledge(message)
+            if self._stopped:
+                break
             # rinse and repeat
+    
+    def _run_batched(self, fault_tolerant, **kwargs):
+        # The prefetch window has to have room for a whole batch
+        self._widen_prefetch(self.batch_size)
+        for batch in self.consumer.batch_iterator(self.batch_size, self.batch_max_wait, **kwargs):
+            batch = [message for message in batch if not self._skip(message, fault_tolerant)]
+            if batch:
+                self._commit_batch(batch, fault_tolerant)
+            if self._stopped:
+                break
+    
+    def _commit_batch(self, batch, fault_tolerant):
+        """Processes a batch in a transaction, acknowledging it once committed, and bisecting
+           it if it fails."""
+        started = time.time()
+        try:
+            with transaction():
+                self.process_batch(batch)
+        except NotImplementedError:
+            # Subclassing ain't happened
+            raise
+        except:
+            if len(batch) > 1:
+                logger.info('batch of %d messages failed; bisecting it', len(batch))
+                middle = len(batch) // 2
+                self._commit_batch(batch[:middle], fault_tolerant)
+                self._commit_batch(batch[middle:], fault_tolerant)
+                return
+            message = batch[0]
+            if metrics.enabled:
+                self._record(message, started, time.time(), failed=True)
+            tb = traceback.format_exc()
+            self.handle_error(message, tb, fault_tolerant)
+            if not fault_tolerant:
+                raise
+            if not self._retry(message, tb):
+                self._leave_unacknowledged()
+            return
+        if metrics.enabled:
+            # Each message is taken to have had an equal share of the batch's time
+            finished = started + (time.time() - started) / len(batch)
+            for message in batch:
+                self._record(message, started, finished, failed=False)
+        for message in batch:
+            self._processed(message)
+        if self.auto_ack:
+            self._acknowledge_batch(batch)
+    
+    def _acknowledge_batch(self, messages):
+        """Acknowledges messages with a single multi-ack, unless there are failed messages
+           which were left unacknowledged (which a multi-ack would acknowledge too)."""
+        if self._unacked_failures:
+            for message in messages:
+                self.consumer.acknowledge(message)
+        else:
+            self.consumer.acknowledge_batch(messages)
+    
+    def _run_coalescing(self, fault_tolerant, **kwargs):
+        # The prefetch window has to have room for a whole coalescing window
+        self._widen_prefetch(self.coalesce_max)
+        for window in self.consumer.batch_iterator(self.coalesce_max, self.coalesce_window, **kwargs):
+            window = [message for message in window if not self._skip(message, fault_tolerant)]
+            if window:
+                self._coalesce(window, fault_tolerant)
+            if self._stopped:
+                break
+    
+    def _coalesce(self, window, fault_tolerant):
+        """Processes a window's messages once per coalesce_key, then acknowledges those which
+           were processed."""
+        groups = [] # (key, messages) tuples, in the order the keys first arrived
+        index = {} # key -> position in groups
+        for message in window:
+            key = self.coalesce_key(message)
+            if key is not None and key in index:
+                groups[index[key]][1].append(message)
+                continue
+            if key is not None:
+                index[key] = len(groups)
+            groups.append((key, [message]))
+        done = []
+        try:
+            for key, messages in groups:
+                started = time.time()
+                try:
+                    self.process_coalesced(key, messages)
+                except NotImplementedError:
+                    # Subclassing ain't happened
+                    raise
+                except:
+                    if metrics.enabled:
+                        self._record(messages[-1], started, time.time(), failed=True)
+                    tb = traceback.format_exc()
+                    self.handle_error(messages[-1], tb, fault_tolerant)
+                    if not fault_tolerant:
+                        raise
+                    for message in messages:
+                        if not self._retry(message, tb):
+                            self._leave_unacknowledged()
+                    continue
+                if metrics.enabled:
+                    self._record(messages[-1], started, time.time(), failed=False)
+                    metrics.incr('coalesced', self.queue, len(messages) - 1)
+                for message in messages:
+                    self._processed(message)
+                done.extend(messages)
+        except:
+            # A failure is being re-raised, so the groups which were processed mustn't be
+            # redelivered, but the rest of the window must. A multi-ack would acknowledge the
+            # rest, too, so they're acknowledged one at a time.
+            if self.auto_ack:
+                for message in done:
+                    self.consumer.acknowledge(message)
+            raise
+        if self.auto_ack and done:
+            self._acknowledge_batch(done)
+    
+    def _run_concurrent(self, fault_tolerant, executor, concurrency, **kwargs):
+        # Acknowledgements can only be made from this thread (which owns the channel), so
+        # handlers running elsewhere have no way to acknowledge messages themselves
+        assert self.auto_ack, 'auto_ack is required to process messages concurrently'
+        assert executor in _EXECUTORS, 'executor must be one of %r' % _EXECUTORS.keys()
+        # The prefetch window bounds how many messages can be in flight
+        self._widen_prefetch(concurrency)
+        kwargs.setdefault('idle_timeout', self.poll_interval)
+        pool = _EXECUTORS[executor](self, concurrency)
+        in_flight = {}
+        try:
+            for message in self.consumer.message_iterator(wakeup=pool.results, **kwargs):
+                self._collect(pool, in_flight, fault_tolerant, block=False)
+                if message is not None and not self._skip(message, fault_tolerant):
+                    in_flight[message.delivery_tag] = message
+                    pool.submit(message.delivery_tag, message)
+                    # Once the window is full nothing more will arrive until something is
+                    # acknowledged, so wait on the pool rather than the channel
+                    while len(in_flight) >= concurrency:
+                        self._collect(pool, in_flight, fault_tolerant, block=True)
+                if self._stopped:
+                    break
+            # Let whatever is still in flight finish before returning
+            while in_flight:
+                self._collect(pool, in_flight, fault_tolerant, block=True)
+        finally:
+            pool.shutdown()
+    
+    def _collect(self, pool, in_flight, fault_tolerant, block):
+        """Acknowledges (or reports the failure of) finished messages. If block is True, waits
+           for at least one message to finish."""
+        pool.results.clear_wakeups()
+        while in_flight:
+            try:
+                key, exc_info, tb, started, finished = pool.results.get(block=block)
+            except Queue.Empty:
+                return
+            block = False
+            message = in_flight.pop(key)
+            if metrics.enabled:
+                self._record(message, started, finished, failed=(exc_info is not None))
+            if exc_info is None:
+                self._processed(message)
+                # Processing must have succeeded; auto-acknowledge
+                self.consumer.acknowledge(message)
+                continue
+            if issubclass(exc_info[0], NotImplementedError):
+                # Subclassing ain't happened
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self.handle_error(message, tb, fault_tolerant)
+            if not fault_tolerant:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if not self._retry(message, tb):
+                self._leave_unacknowledged()
+
+def _call(process, key, message):
+    """Runs process_message, returning a (key, exc_info, traceback, started, finished) tuple,
+       where exc_info and traceback are None if it succeeded."""
+    started = time.time()
+    try:
+        process._dispatch(message)
+    except:
+        return key, sys.exc_info(), traceback.format_exc(), started, time.time()
+    return key, None, None, started, time.time()
+
+class _Results(Queue.Queue):
+    """The queue of finished tasks. A pipe becomes readable whenever something is put on it,
+       so that the consume loop can wait on it alongside the channel. Handlers may still be
+       running when it's closed, so anything they put on it after that just goes on the
+       queue (their pipe's file descriptors may well belong to something else by then)."""
+    def __init__(self):
+        Queue.Queue.__init__(self)
+        self._read_fd, self._write_fd = os.pipe()
+        fcntl.fcntl(self._read_fd, fcntl.F_SETFL, fcntl.fcntl(self._read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._closed = False
+        self._pipe_lock = threading.Lock() # guards the pipe against being closed mid-write
+    
+    def fileno(self):
+        return self._read_fd
+    
+    def put(self, item, *args, **kwargs):
+        Queue.Queue.put(self, item, *args, **kwargs)
+        with self._pipe_lock:
+            if not self._closed:
+                os.write(self._write_fd, '.')
+    
+    def clear_wakeups(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def close(self):
+        with self._pipe_lock:
+            self._closed = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+class _ThreadExecutor(object):
+    """Runs process_message on a pool of daemon threads. Shared connections are per thread
+       (see AMQPConnection), so handlers publishing through them never touch the consume
+       loop's socket; each thread holds the default one open, so that they don't reconnect for
+       every message."""
+    def __init__(self, process, concurrency):
+        self.results = _Results()
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in xrange(concurrency):
+            thread = threading.Thread(target=self._work, args=(process,), name='hare-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+    
+    def _work(self, process):
+        connection = AMQPConnection()
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    return
+                self.results.put(_call(process, *task))
+        finally:
+            connection.close()
+    
+    def submit(self, key, message):
+        self._tasks.put((key, message))
+    
+    def shutdown(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        self.results.close()
+
+# The ConsumerProcess used inside a pool's child processes (see _ProcessExecutor)
+_child_process = None
+
+def _init_child(cls):
+    global _child_process
+    # Handlers publishing over the default connection mustn't share the parent's socket
+    after_fork()
+    # Only process_message is ever called in the child, so the consumer (and its
+    # connection) is deliberately never created
+    _child_process = cls.__new__(cls)
+
+def _call_in_child(key, message):
+    key, exc_info, tb, started, finished = _call(_child_process, key, message)
+    if exc_info is not None:
+        # Tracebacks (and often the exceptions themselves) can't be pickled
+        if issubclass(exc_info[0], NotImplementedError):
+            # (which the parent re-raises whatever fault_tolerant is)
+            exc_info = (NotImplementedError, NotImplementedError(tb), None)
+        else:
+            exc_info = (HandlerError, HandlerError(tb), None)
+    return key, exc_info, tb, started, finished
+
+class _ProcessExecutor(object):
+    """Runs process_message on a multiprocessing pool of child processes. Messages are
+       pickled on the way there, so must have been decoded into something picklable."""
+    def __init__(self, process, concurrency):
+        self.results = _Results()
+        self._pool = multiprocessing.Pool(concurrency, _init_child, (type(process),))
+    
+    def submit(self, key, message):
+        # The channel a message arrived on can't (and needn't) be sent to the child
+        stripped = type(message).__new__(type(message))
+        stripped.__dict__.update(message.__dict__)
+        if 'delivery_info' in stripped.__dict__:
+            stripped.delivery_info = dict(message.delivery_info)
+            stripped.delivery_info.pop('channel', None)
+        stripped.__dict__.pop('raw_body', None)
+        if isinstance(stripped.body, mmap.mmap):
+            # (a claim-checked body, which is mapped in from its blob)
+            stripped.body = stripped.body[:]
+        self._pool.apply_async(_call_in_child, (key, stripped), callback=self.results.put)
+    
+    def shutdown(self):
+        self._pool.terminate()
+        self.results.close()
+
+_EXECUTORS = {
+    'thread': _ThreadExecutor,
+    'process': _ProcessExecutor,
+}
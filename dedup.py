@@ -0,0 +1,124 @@
+"""Recognising messages which have already been processed.
+   
+   Messages are only acknowledged once they've been processed, so a worker which crashes (or
+   loses its connection) after processing a message but before acknowledging it gets it
+   redelivered, and processes it again. A ConsumerProcess with a dedup_cache remembers the
+   key of every message it processes (its message_id, by default) and acknowledges messages
+   whose key it has seen before without processing them again.
+   
+   MemoryCache keeps keys in memory, so only recognises messages seen by the same process.
+   To recognise messages seen by other workers, give it a shared backend as well: an
+   SQLiteCache (a database file shared by the workers on a host) or a DjangoCache (for
+   instance, memcached shared by every host). Keys are forgotten after ttl seconds, which
+   should be longer than a message could plausibly take to be redelivered.
+   
+   Publishers with stamp_message_ids set give every message a unique message_id (see
+   new_message_id()), for messages which don't have a natural key."""
+from __future__ import with_statement
+
+import binascii
+import collections
+import hashlib
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from django.core import cache as django_cache
+
+class MemoryCache(object):
+    """An LRU cache of up to max_size keys, held in memory, each of which is forgotten ttl
+       seconds after it was added. If a backend is given, keys are added to it too, and
+       looked up in it when they aren't in memory."""
+    def __init__(self, max_size=100000, ttl=3600, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._keys = collections.OrderedDict() # key -> when it expires, least recently used first
+        self._lock = threading.Lock()
+        return super(MemoryCache, self).__init__()
+    
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._keys.pop(key, None)
+            if expires is not None and expires >= time.time():
+                self._keys[key] = expires # (now the most recently used)
+                return True
+        return (self.backend is not None and key in self.backend)
+    
+    def add(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = time.time() + self.ttl
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        if self.backend is not None:
+            self.backend.add(key)
+
+class SQLiteCache(object):
+    """Keys kept in an SQLite database file, which can be shared by processes on the same
+       host. Expired keys are purged every purge_interval additions."""
+    def __init__(self, path, ttl=3600, purge_interval=1000):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._local = threading.local()
+        self._additions = itertools.count(1)
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS hare_dedup (key TEXT PRIMARY KEY, expires REAL)')
+        return super(SQLiteCache, self).__init__()
+    
+    def _connection(self):
+        """Returns this thread's connection (connections can't be shared by threads, or
+           survive a fork)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            # Readers don't block the writer (and vice versa), and a crash can lose at most
+            # the last few keys, rather than corrupt the file
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+    
+    def __contains__(self, key):
+        cursor = self._connection().execute('SELECT 1 FROM hare_dedup WHERE key = ? AND expires >= ?',
+                                            (key, time.time()))
+        return cursor.fetchone() is not None
+    
+    def add(self, key):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO hare_dedup (key, expires) VALUES (?, ?)',
+                               (key, now + self.ttl))
+            if self._additions.next() % self.purge_interval == 0:
+                connection.execute('DELETE FROM hare_dedup WHERE expires < ?', (now,))
+
+class DjangoCache(object):
+    """Keys kept in a Django cache (the default one, unless the name of another in the
+       CACHES setting is given). Keys are hashed, so that any key is safe for memcached."""
+    def __init__(self, cache=None, ttl=3600, prefix='hare-dedup:'):
+        self.cache = (django_cache.get_cache(cache) if cache is not None else django_cache.cache)
+        self.ttl = ttl
+        self.prefix = prefix
+        return super(DjangoCache, self).__init__()
+    
+    def _key(self, key):
+        return self.prefix + hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else str(key)).hexdigest()
+    
+    def __contains__(self, key):
+        return self.cache.get(self._key(key)) is not None
+    
+    def add(self, key):
+        self.cache.set(self._key(key), 1, self.ttl)
+
+_prefix = _counter = _pid = None
+
+def new_message_id():
+    """Returns a new message id, unique to this process (by way of a random prefix, chosen
+       again after a fork) and to the message (by way of a counter)."""
+    global _prefix, _counter, _pid
+    if _pid != os.getpid():
+        _prefix, _counter, _pid = binascii.hexlify(os.urandom(8)), itertools.count(), os.getpid()
+    return '%s.%x' % (_prefix, _counter.next())
@@ -0,0 +1,215 @@
+"""Cheap in-process metrics for publishing and consuming.
+   
+   Counters and latency histograms are aggregated in memory, keyed by a metric name and an
+   exchange, queue or host, and periodically handed to an exporter (which resets them).
+   Metrics are off by default, in which case instrumented code does nothing more than check
+   metrics.enabled. Set HARE_METRICS = True in the settings to turn them on at startup, with
+   HARE_METRICS_STATSD = 'host:port' to export to statsd (otherwise the aggregates are logged)
+   every HARE_METRICS_INTERVAL seconds; or call enable() and disable() directly.
+   
+   Counters: published (per exchange), delivered, acked, failed, duplicates and coalesced
+   (messages which were collapsed into another, per queue), connections_opened,
+   connections_closed and channels_opened (per host), and spooled (per background
+   publishing spool file).
+   Histograms (in seconds): publish_time (per exchange), and delivery_latency (from a message
+   arriving from the broker to its handler starting) and handler_time (per queue)."""
+from __future__ import with_statement
+
+import bisect
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+from .utils.log import logger
+
+# Upper bounds (in seconds) of the histogram buckets: 100 microseconds, doubling up to ~100s
+BUCKETS = tuple(0.0001 * 2 ** i for i in xrange(21))
+
+class Histogram(object):
+    """Fixed-bucket histogram; percentiles are estimated as the upper bound of the bucket
+       they fall in (so are out by at most a factor of two)."""
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+    
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, value, count=1):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and i < len(BUCKETS):
+                return min(BUCKETS[i], self.max)
+        return self.max
+    
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': (self.total / self.count if self.count else None),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+class Registry(object):
+    """Thread-safe store of counters and histograms, keyed by (name, key) tuples."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        return super(Registry, self).__init__()
+    
+    def incr(self, name, key, count=1):
+        with self._lock:
+            self.counters[(name, key)] = self.counters.get((name, key), 0) + count
+    
+    def observe(self, name, key, value, count=1):
+        with self._lock:
+            histogram = self.histograms.get((name, key))
+            if histogram is None:
+                histogram = self.histograms[(name, key)] = Histogram()
+            histogram.add(value, count)
+    
+    def snapshot(self, reset=False):
+        """Returns a dictionary of counter values and histogram summaries, optionally
+           resetting everything to zero."""
+        with self._lock:
+            counters, histograms = self.counters, self.histograms
+            if reset:
+                self.counters, self.histograms = {}, {}
+            return {
+                'counters': dict(counters),
+                'histograms': dict((k, h.summary()) for k, h in histograms.iteritems()),
+            }
+
+class LogExporter(object):
+    """Writes snapshots to the hare logger."""
+    def export(self, snapshot):
+        for (name, key), value in sorted(snapshot['counters'].iteritems()):
+            logger.info('metric %s[%s] = %d', name, key, value)
+        for (name, key), summary in sorted(snapshot['histograms'].iteritems()):
+            logger.info('metric %s[%s] = %r', name, key, summary)
+
+class StatsdExporter(object):
+    """Sends snapshots to a statsd server over UDP. Counters are sent as counts, and each
+       histogram as a count plus mean, p50, p99 and max timings (in milliseconds)."""
+    max_packet_size = 512
+    
+    def __init__(self, host='localhost', port=8125, prefix='hare'):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return super(StatsdExporter, self).__init__()
+    
+    def _name(self, name, key):
+        return '%s.%s.%s' % (self.prefix, name, str(key).replace('.', '_').replace(':', '_') or '_')
+    
+    def export(self, snapshot):
+        lines = []
+        for (name, key), value in snapshot['counters'].iteritems():
+            lines.append('%s:%d|c' % (self._name(name, key), value))
+        for (name, key), summary in snapshot['histograms'].iteritems():
+            prefix = self._name(name, key)
+            lines.append('%s.count:%d|c' % (prefix, summary['count']))
+            for stat in ('mean', 'p50', 'p99', 'max'):
+                lines.append('%s.%s:%f|ms' % (prefix, stat, summary[stat] * 1000))
+        # Pack as many lines into each datagram as will fit
+        packet = ''
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > self.max_packet_size:
+                self.socket.sendto(packet, self.address)
+                packet = ''
+            packet = (packet + '\n' + line if packet else line)
+        if packet:
+            self.socket.sendto(packet, self.address)
+
+class Reporter(threading.Thread):
+    """Background thread which hands a (resetting) snapshot to the exporter every interval seconds."""
+    def __init__(self, exporter, interval):
+        super(Reporter, self).__init__(name='hare-metrics')
+        self.daemon = True
+        self.exporter = exporter
+        self.interval = interval
+        self._stopped = threading.Event()
+    
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.exporter.export(registry.snapshot(reset=True))
+            except Exception:
+                logger.exception('failed to export metrics')
+    
+    def stop(self):
+        self._stopped.set()
+
+enabled = False
+registry = Registry()
+_reporter = None
+
+def enable(exporter=None, interval=None):
+    """Turns metrics collection on. If an exporter is passed, it is sent a snapshot every
+       interval seconds (HARE_METRICS_INTERVAL, or 10, by default)."""
+    global enabled, _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+    if exporter is not None:
+        interval = (interval if interval is not None else getattr(settings, 'HARE_METRICS_INTERVAL', 10))
+        _reporter = Reporter(exporter, interval)
+        _reporter.start()
+    enabled = True
+
+def disable():
+    """Turns metrics collection (and any exporting) off."""
+    global enabled, _reporter
+    enabled = False
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
+
+def reset_after_fork():
+    """Starts a freshly forked child process off with an empty registry (the counts
+       inherited from the parent are the parent's to export), and restarts exporting, since
+       the reporter thread doesn't survive the fork."""
+    global registry, _reporter
+    registry = Registry()
+    if _reporter is not None:
+        _reporter = Reporter(_reporter.exporter, _reporter.interval)
+        _reporter.start()
+
+def incr(name, key, count=1):
+    registry.incr(name, key, count)
+
+def observe(name, key, value, count=1):
+    registry.observe(name, key, value, count)
+
+def stamp(message):
+    """Records when a message arrived from the broker (for delivery_latency)."""
+    message.received_at = time.time()
+    return message
+
+if getattr(settings, 'HARE_METRICS', False):
+    if getattr(settings, 'HARE_METRICS_STATSD', None):
+        enable(StatsdExporter(*settings.HARE_METRICS_STATSD.split(':')))
+    else:
+        enable(LogExporter())
@@ -0,0 +1,33 @@
+"""Django middleware."""
+from .utils.log import logger
+from . import outbox
+
+class OutboxMiddleware(object):
+    """Buffers messages published whilst handling a request, publishing them once the response
+       is on its way out or dropping them if the view raises an exception (see the outbox
+       module). If Django's TransactionMiddleware is also used, put this before it, so that
+       messages are only published after the request's transaction has committed."""
+    def process_request(self, request):
+        # Nothing should be open on this thread between requests, so anything which is has
+        # leaked from an earlier request whose process_response never ran (and would
+        # otherwise swallow the messages of every later request on the thread)
+        stale = outbox.discard()
+        if stale:
+            logger.warning('discarded %d outboxes left open by an earlier request', stale)
+        request.hare_outbox = outbox.begin()
+    
+    def process_exception(self, request, exception):
+        if self._is_open(request):
+            outbox.rollback()
+        request.hare_outbox = None
+    
+    def process_response(self, request, response):
+        if self._is_open(request):
+            request.hare_outbox = None
+            outbox.commit()
+        return response
+    
+    def _is_open(self, request):
+        # The outbox won't be open if a middleware before this one returned a response early
+        box = getattr(request, 'hare_outbox', None)
+        return (box is not None and box is outbox.current())
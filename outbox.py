@@ -0,0 +1,137 @@
+"""Publish-on-commit buffering.
+   
+   Whilst an outbox is open on the current thread, Publishers don't publish messages straight
+   away; they're buffered in the outbox instead. Outboxes are opened by utils.db.transaction()
+   (and by the hare.middleware.OutboxMiddleware, for the length of a request), and nest:
+   when an outbox is committed, its messages move to the enclosing outbox, or, if there isn't
+   one, are published (in the order they were buffered, with consecutive messages from the
+   same Publisher sent as a single batch). When it's rolled back, its messages are dropped,
+   so messages never go out for changes which never happened.
+   
+   Database transactions don't nest, though: Django commits (or rolls back) the connection
+   whenever any transaction() block ends, however deeply nested, along with everything done
+   since the last commit. So transaction() opens an outbox only in the outermost block, and
+   every block's end publishes (or drops) everything buffered in it so far, rather than
+   leaving it to an enclosing block (or request), which could still fail after the changes
+   had been committed.
+   
+   By the time an outbox is flushed, the changes its messages are about have been committed,
+   so a failure to publish them mustn't look like a failure of the transaction. Each batch is
+   published in an AMQP transaction, and a batch which fails (along with everything after it)
+   is handed to the background publisher instead, which retries until the broker takes it
+   (see the background module).
+   
+   Publishers with publish_on_commit set to False always publish straight away."""
+import threading
+
+from .utils.log import logger
+from . import background
+
+class Outbox(object):
+    """Messages waiting to be published, as (publisher, body, kwargs) tuples. A transactional
+       outbox is one opened by utils.db.transaction()."""
+    def __init__(self, transactional=False):
+        self.entries = []
+        self.transactional = transactional
+        return super(Outbox, self).__init__()
+    
+    def add(self, publisher, body, kwargs):
+        self.entries.append((publisher, body, kwargs))
+    
+    def drop(self):
+        """Drops the buffered messages, returning how many there were."""
+        entries, self.entries = self.entries, []
+        if entries:
+            logger.debug('dropped %d buffered messages.', len(entries))
+        return len(entries)
+    
+    def flush(self):
+        """Publishes the buffered messages, returning how many there were. It never raises;
+           messages which can't be published straight away are handed to the background
+           publisher."""
+        entries, self.entries = self.entries, []
+        # (the outbox may still be open, and the messages mustn't just be buffered again)
+        _local.flushing = True
+        try:
+            self._publish(entries)
+        finally:
+            _local.flushing = False
+        if entries:
+            logger.debug('flushed %d buffered messages.', len(entries))
+        return len(entries)
+    
+    def _publish(self, entries):
+        i = 0
+        while i < len(entries):
+            publisher, body, kwargs = entries[i]
+            j = i + 1
+            while j < len(entries) and entries[j][0] is publisher and entries[j][2] == kwargs:
+                j += 1
+            try:
+                # (in a transaction, so that a batch which fails has had none of its
+                # messages published)
+                publisher.publish_many([entry[1] for entry in entries[i:j]], transactional=True, **kwargs)
+            except Exception:
+                logger.exception('failed to publish %d buffered messages; handing them to the background publisher',
+                                 len(entries) - i)
+                for entry in entries[i:]:
+                    _hand_off(*entry)
+                break
+            i = j
+
+def _hand_off(publisher, body, kwargs):
+    """Submits a buffered message to the background publisher (dropping it, if even that
+       fails)."""
+    prepared = None
+    try:
+        publisher_kwargs, properties = publisher._split_kwargs(kwargs)
+        body, prepared = publisher._prepare(body, properties)
+        background.get_publisher(publisher.connection_signature).submit(publisher_kwargs['exchange'],
+                                                                        publisher_kwargs['routing_key'],
+                                                                        body, prepared)
+    except Exception:
+        logger.exception('dropping buffered message for exchange %r', kwargs.get('exchange', publisher.exchange))
+        if prepared is not None:
+            background._release(prepared)
+
+_local = threading.local()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def current():
+    """Returns the innermost open outbox on this thread, or None if there isn't one (or one is
+       being flushed)."""
+    stack = _stack()
+    return (stack[-1] if stack and not getattr(_local, 'flushing', False) else None)
+
+def begin(transactional=False):
+    """Opens a new (nested) outbox on this thread, and returns it."""
+    outbox = Outbox(transactional)
+    _stack().append(outbox)
+    return outbox
+
+def commit():
+    """Closes the innermost outbox, passing its messages on to the enclosing one or, if it
+       was the outermost, publishing them."""
+    stack = _stack()
+    outbox = stack.pop()
+    if stack:
+        stack[-1].entries.extend(outbox.entries)
+    else:
+        outbox.flush()
+
+def rollback():
+    """Closes the innermost outbox, dropping its messages."""
+    _stack().pop().drop()
+
+def discard():
+    """Closes every outbox open on this thread, dropping their messages. Returns how many
+       outboxes there were."""
+    stack = _stack()
+    count = len(stack)
+    while stack:
+        rollback()
+    return count
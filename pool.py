@@ -0,0 +1,208 @@
+"""Thread-safe pooling of connections (and their channels) to the AMQP server."""
+from __future__ import with_statement
+
+import select
+import socket
+import threading
+import time
+from amqplib import client_0_8 as amqp
+
+from django.conf import settings
+
+from .utils.log import logger
+from . import metrics
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out of a pool before the timeout."""
+    pass
+
+class ConnectionPool(object):
+    """A bounded pool of connections which all share the same connection signature. Unlike the
+       shared connections handed out by AMQPConnection (one per thread), a connection checked
+       out of a pool is used by only one borrower at a time, and can be handed on to another
+       thread once it's checked back in.
+       
+       Connections which have been idle for longer than max_idle_time seconds are closed, and
+       connections are checked for liveness before being handed out. Defaults for the pool's
+       limits come from the AMQP_POOL_MAX_SIZE, AMQP_POOL_MAX_IDLE_TIME and AMQP_POOL_TIMEOUT
+       settings."""
+    _pools = {}
+    _pools_lock = threading.Lock()
+    
+    @classmethod
+    def for_signature(cls, signature):
+        """Returns the pool for the passed connection signature, creating it if needed."""
+        with cls._pools_lock:
+            if signature not in cls._pools:
+                cls._pools[signature] = cls(signature)
+            return cls._pools[signature]
+    
+    @classmethod
+    def reset_after_fork(cls):
+        """Forgets every pool, for use in a freshly forked child process. The parent's idle
+           connections are abandoned (see abandon()) rather than closed."""
+        for pool in cls._pools.values():
+            for connection, checked_in in pool._idle:
+                abandon(connection)
+        cls._pools = {}
+        cls._pools_lock = threading.Lock()
+    
+    def __init__(self, signature, max_size=None, max_idle_time=None, timeout=None):
+        self.signature = signature
+        self.max_size = (max_size if max_size is not None else getattr(settings, 'AMQP_POOL_MAX_SIZE', 10))
+        self.max_idle_time = (max_idle_time if max_idle_time is not None else getattr(settings, 'AMQP_POOL_MAX_IDLE_TIME', 60))
+        self.timeout = (timeout if timeout is not None else getattr(settings, 'AMQP_POOL_TIMEOUT', None))
+        
+        self._condition = threading.Condition()
+        self._idle = []     # (connection, time checked in) tuples, oldest first
+        self._channels = {} # id(connection) -> list of idle channels on that connection
+        self._size = 0      # number of open connections, whether idle or checked out
+        
+        # Statistics (see stats())
+        self.checkouts = 0
+        self.hits = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        
+        return super(ConnectionPool, self).__init__()
+    
+    def checkout(self, timeout=None):
+        """Checks a connection out of the pool, opening a new one if there are no idle
+           connections and the pool isn't full. Otherwise, waits for up to timeout seconds
+           (forever if None) for a connection to be checked in, raising PoolTimeout if none is."""
+        timeout = (timeout if timeout is not None else self.timeout)
+        with self._condition:
+            self.checkouts += 1
+            self._evict()
+            started = None
+            try:
+                while True:
+                    while self._idle:
+                        connection = self._idle.pop()[0]
+                        if _is_alive(connection):
+                            self.hits += 1
+                            return connection
+                        logger.debug('discarding dead pooled connection.')
+                        self._discard(connection, dead=True)
+                    if self._size < self.max_size:
+                        # Reserve a slot; the connection itself is opened outside the lock
+                        self._size += 1
+                        break
+                    # The pool is exhausted, so wait for a connection to be checked in
+                    if started is None:
+                        started = time.time()
+                        self.waits += 1
+                    remaining = (timeout - (time.time() - started) if timeout is not None else None)
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout('no connection available after %r seconds' % timeout)
+                    self._condition.wait(remaining)
+            finally:
+                if started is not None:
+                    self.wait_time += time.time() - started
+        try:
+            sig = dict(self.signature)
+            logger.debug('creating new pooled amqp connection -> amqp.Connection(host=%r, virtual_host=%r...)', sig['host'], sig['virtual_host'])
+            connection = amqp.Connection(**sig)
+            if metrics.enabled:
+                metrics.incr('connections_opened', sig['host'])
+            return connection
+        except:
+            # Give the reserved slot back
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+    
+    def checkin(self, connection):
+        """Returns a connection to the pool."""
+        with self._condition:
+            if _is_alive(connection):
+                self._idle.append((connection, time.time()))
+            else:
+                self._discard(connection, dead=True)
+            self._evict()
+            self._condition.notify()
+    
+    def checkout_channel(self, connection):
+        """Returns an idle channel on the passed (checked out) connection, opening one if
+           there isn't one."""
+        with self._condition:
+            channels = self._channels.setdefault(id(connection), [])
+            while channels:
+                channel = channels.pop()
+                if channel.is_open:
+                    return channel
+        logger.debug('creating pooled channel -> connection.channel()')
+        if metrics.enabled:
+            metrics.incr('channels_opened', dict(self.signature)['host'])
+        return connection.channel()
+    
+    def checkin_channel(self, connection, channel):
+        """Returns a channel to the pool so that it may be reused by the next borrower of
+           its connection. The channel must be left in its default state (no consumers,
+           transactions or QoS settings)."""
+        if not channel.is_open:
+            return
+        with self._condition:
+            self._channels.setdefault(id(connection), []).append(channel)
+    
+    def stats(self):
+        """Returns a dictionary of statistics which are useful for sizing the pool."""
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'hits': self.hits,
+                'hit_rate': (float(self.hits) / self.checkouts if self.checkouts else None),
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'average_wait_time': (self.wait_time / self.waits if self.waits else None),
+            }
+    
+    def _evict(self):
+        """Closes connections which have been idle for too long (the lock must be held)."""
+        if self.max_idle_time is None:
+            return
+        cutoff = time.time() - self.max_idle_time
+        while self._idle and self._idle[0][1] < cutoff:
+            logger.debug('closing idle pooled connection.')
+            self._discard(self._idle.pop(0)[0])
+    
+    def _discard(self, connection, dead=False):
+        """Forgets about a connection and closes it (the lock must be held)."""
+        self._size -= 1
+        self._channels.pop(id(connection), None)
+        if metrics.enabled:
+            metrics.incr('connections_closed', dict(self.signature)['host'])
+        try:
+            if dead:
+                # Don't try the closing handshake over a socket which is known to be bad
+                if connection.transport is not None:
+                    connection.transport.close()
+            else:
+                connection.close()
+        except (IOError, socket.error, amqp.AMQPException):
+            pass
+
+def _is_alive(connection):
+    """Cheaply checks whether an idle connection is still usable. Nothing should arrive on
+       an idle connection, so a readable socket means it has been closed (or the server has
+       sent an error)."""
+    transport = getattr(connection, 'transport', None)
+    if transport is None:
+        return False
+    try:
+        return not select.select([transport.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+
+def abandon(connection):
+    """Lets go of a connection inherited from the parent process across a fork, without
+       disturbing the parent's use of it: only this process's copy of the socket is closed.
+       Closing the connection properly (or letting the transport be garbage collected, which
+       shuts the socket down) would cut the parent off as well."""
+    transport = getattr(connection, 'transport', None)
+    if transport is not None and transport.sock is not None:
+        transport.sock.close()
+        transport.sock = None
@@ -1,72 +1,273 @@
 """Handles publishing messages to the AMQP server."""
+import time
 from amqplib import client_0_8 as amqp
 
-from django.utils import simplejson
+from django.conf import settings
 
 from .utils.log import logger
 from .connection import AMQPConnection
+from . import background, claimcheck, dedup, metrics, outbox, serialization
 
 class Publisher(object):
     """A Publisher is responsible for delivering messages to an AMQP exchange. There
        should be at minimum separate publishers per exchange, and possibly a publisher
-       per event type, setting the default routing key appropriately."""
+       per event type, setting the default routing key appropriately.
+       
+       Message bodies are serialized with the codec named by codec (see the serialization
+       module), or passed through untouched if it is None. If compression is set (e.g. to
+       'deflate'), encoded bodies of at least compression_threshold bytes are compressed.
+       
+       Inside utils.db.transaction() (or a request, with the OutboxMiddleware), messages are
+       buffered and only published once the transaction commits, unless publish_on_commit
+       is False (see the outbox module).
+       
+       If publish_in_background is True, messages are handed to a background thread to be
+       published, so publishing never blocks on the broker (see the background module). Unless
+       a connection is passed, such a Publisher doesn't connect at all (so can be created
+       whilst the broker is down), and its exchange is declared by the background thread;
+       its connection and channel are None, so destroy_exchange can't be used.
+       
+       If stamp_message_ids is True, messages published without a message_id are given a
+       unique one, so that consumers can recognise redeliveries (see the dedup module).
+       
+       If claim_check_threshold is set, encoded bodies of at least that many bytes are put
+       in the blob store, and only a reference to them is published (see the claimcheck
+       module)."""
     _declared_exchanges = []
+    publish_on_commit = True
+    publish_in_background = False
+    codec = None
+    compression = None
+    compression_threshold = 1024
+    stamp_message_ids = False
+    claim_check_threshold = None
+    claim_check_references = 1
     
-    def __init__(self, exchange, connection=None, channel=None, routing_key='', **kwargs):
+    def __init__(self, exchange, connection=None, channel=None, routing_key='', pooled=None,
+                 codec=None, compression=None, compression_threshold=None, force_no_declare=False,
+                 publish_on_commit=None, publish_in_background=None, stamp_message_ids=None,
+                 claim_check_threshold=None, **kwargs):
         self.exchange = exchange # default exchange
-        self.connection = (connection if connection is not None else AMQPConnection())
-        self.channel = (channel if channel is not None else self.connection.channel)
+        if claim_check_threshold is not None:
+            self.claim_check_threshold = claim_check_threshold
+        if stamp_message_ids is not None:
+            self.stamp_message_ids = stamp_message_ids
+        if publish_on_commit is not None:
+            self.publish_on_commit = publish_on_commit
+        if publish_in_background is not None:
+            self.publish_in_background = publish_in_background
+        if codec is not None:
+            self.codec = codec
+        if compression is not None:
+            self.compression = compression
+        if compression_threshold is not None:
+            self.compression_threshold = compression_threshold
         self.routing_key = routing_key # default routing key
+        if self.publish_in_background and connection is None:
+            # Messages only ever go out over the background thread's own (pooled) connection
+            self._owns_connection = False
+            self.connection = self.channel = None
+            self.connection_signature = AMQPConnection._connection_signature()
+            self.enabled = getattr(settings, 'ENABLE_MQ', False)
+        else:
+            # If no connection is passed, one is created (borrowed from the connection pool if
+            # pooled is True) and owned by this Publisher
+            self._owns_connection = (connection is None)
+            self.connection = (connection if connection is not None else AMQPConnection(pooled=pooled))
+            self.channel = (channel if channel is not None else self.connection.channel)
+            self.connection_signature = self.connection.connection_signature
+            self.enabled = (self.channel is not None)
         
         # Now declare the exchange if it hasn't been declared in any other Publisher
         # (if the exchange is declared now, the kwargs passed to this constructor are passed
-        # to the exchange declarer)
-        if (self.channel is not None) and (self.exchange not in self._declared_exchanges):
+        # to the exchange declarer). force_no_declare skips this, e.g. for the default exchange
+        # (''), which can't be declared.
+        if self.enabled and (self.exchange not in self._declared_exchanges) and not force_no_declare:
             # Unless specified otherwise, the exchange is defaulted to being durable
             # and not automatically deleted
             kwargs.setdefault('durable', True)
             kwargs.setdefault('auto_delete', False)
             # exchange type (passed as exchange_type) defaults to direct
             kwargs['type'] = kwargs.pop('exchange_type', 'direct')
-            logger.debug('declaring exchange -> channel.exchange_declare(exchange=%r, %r)' % (exchange, kwargs))
-            self.channel.exchange_declare(exchange=exchange, **kwargs)
-            self._declared_exchanges.append(exchange)
+            if self.publish_in_background:
+                # The background thread declares it before publishing anything else, once it
+                # can reach the broker (so it isn't marked as declared for foreground Publishers)
+                background.get_publisher(self.connection_signature).declare(exchange, kwargs)
+            else:
+                logger.debug('declaring exchange -> channel.exchange_declare(exchange=%r, %r)', exchange, kwargs)
+                self.channel.exchange_declare(exchange=exchange, **kwargs)
+                self._declared_exchanges.append(exchange)
         
         return super(Publisher, self).__init__()
     
+    def close(self):
+        """Closes the connection, if it was created by (rather than passed to) this Publisher.
+           Pooled connections are returned to the pool."""
+        if self._owns_connection:
+            self.connection.close()
+    
     def destroy_exchange(self):
         """Destroys the exchange this Publisher represents."""
         self.channel.exchange_delete(self.exchange)
         self._declared_exchanges.remove(self.exchange)
     
     def encode(self, body):
-        return body
+        """Serializes a message body with this Publisher's codec."""
+        if self.codec is None:
+            return body
+        return serialization.get_codec(self.codec).encode(body)
     
-    def basic_publish(self, body, **kwargs):
-        """Publishes a message to the exchange (a convenience wrapper around
-           `Channel.basic_publish` [hence the same name])."""
-        # Do nothing if the channel is disabled
-        if not self.channel is not None:
-            return
+    def _prepare(self, body, properties):
+        """Encodes (and possibly compresses) a message body, returning a (body, properties)
+           tuple. The properties passed are never modified."""
+        body = self.encode(body)
+        if self.stamp_message_ids and 'message_id' not in properties:
+            properties = dict(properties, message_id=dedup.new_message_id())
+        if (self.compression is not None and isinstance(body, str) and
+            len(body) >= self.compression_threshold and 'content_encoding' not in properties):
+            body = serialization.compress(self.compression, body)
+            properties = dict(properties, content_encoding=self.compression)
+        if (self.claim_check_threshold is not None and isinstance(body, str) and
+            len(body) >= self.claim_check_threshold):
+            refs = claimcheck.get_store().put(body, self.claim_check_references)
+            headers = dict(properties.get('application_headers') or {})
+            headers[claimcheck.HEADER] = ' '.join(refs)
+            body, properties = '', dict(properties, application_headers=headers)
+        return body, properties
+    
+    def _split_kwargs(self, kwargs):
+        """Splits publishing keyword arguments into those destined for Channel.basic_publish
+           and those which are message properties, returning a (publish_kwargs, properties)
+           tuple. Message properties are defaulted to being persistent."""
+        properties = kwargs.copy()
         # Take out the keyword arguments which are to be used as arguments
         # to Channel.basic_publish
         publisher_kwargs = {
-            'exchange': kwargs.pop('exchange', self.exchange),
-            'routing_key': kwargs.pop('routing_key', self.routing_key),
-            'mandatory': kwargs.pop('mandatory', False),
-            'immediate': kwargs.pop('immediate', False),
-            'ticket': kwargs.pop('ticket', None),
+            'exchange': properties.pop('exchange', self.exchange),
+            'routing_key': properties.pop('routing_key', self.routing_key),
+            'mandatory': properties.pop('mandatory', False),
+            'immediate': properties.pop('immediate', False),
+            'ticket': properties.pop('ticket', None),
         }
         # Set the message to default to being persistent
-        kwargs.setdefault('delivery_mode', 2)
+        properties.setdefault('delivery_mode', 2)
+        # Label the message with its codec so that consumers know how to decode it
+        if self.codec is not None:
+            properties.setdefault('content_type', serialization.get_codec(self.codec).content_type)
+        return publisher_kwargs, properties
+    
+    def basic_publish(self, body, **kwargs):
+        """Publishes a message to the exchange (a convenience wrapper around
+           `Channel.basic_publish` [hence the same name])."""
+        # Do nothing if the channel is disabled
+        if not self.enabled:
+            return
+        if self.publish_on_commit and outbox.current() is not None:
+            outbox.current().add(self, body, kwargs)
+            return
+        publisher_kwargs, properties = self._split_kwargs(kwargs)
         # Create the message
-        body = self.encode(body)
-        message = amqp.Message(body=body, **kwargs)
-        logger.debug('publishing message -> channel.basic_publish(<msg hidden>, %r)' % publisher_kwargs)
-        return self.channel.basic_publish(msg=message, **publisher_kwargs)
+        body, properties = self._prepare(body, properties)
+        if self.publish_in_background:
+            background.get_publisher(self.connection_signature).submit(publisher_kwargs['exchange'], publisher_kwargs['routing_key'],
+                                                             body, properties)
+            return
+        message = amqp.Message(body=body, **properties)
+        logger.debug('publishing message -> channel.basic_publish(<msg hidden>, %r)', publisher_kwargs)
+        timed = metrics.enabled
+        if timed:
+            started = time.time()
+        try:
+            ret = self.channel.basic_publish(msg=message, **publisher_kwargs)
+        except:
+            claimcheck.release_unpublished(properties)
+            raise
+        if not timed:
+            return ret
+        metrics.observe('publish_time', publisher_kwargs['exchange'], time.time() - started)
+        metrics.incr('published', publisher_kwargs['exchange'])
+        return ret
     publish = basic_publish # convenient alias
+    
+    @property
+    def tx_channel(self):
+        """Gets a Channel which is in transactional mode, used by publish_many. A separate
+           channel is needed since tx_select can't be undone, and it'd otherwise leave
+           ordinary publishes on the default channel uncommitted."""
+        if not hasattr(self, '_tx_channel'):
+            self._tx_channel = self.connection.new_channel()
+            logger.debug('selecting transactional mode -> channel.tx_select()')
+            self._tx_channel.tx_select()
+        return self._tx_channel
+    
+    def publish_many(self, bodies, transactional=False, batch_size=None, **kwargs):
+        """Publishes every message body in the bodies iterable to the exchange. The keyword
+           arguments are parsed once and shared by the whole batch, and are otherwise the same
+           as those to basic_publish. Returns the number of messages published.
+           
+           If transactional is True, the messages are published on a transactional channel and
+           committed with a single tx_commit per batch_size messages (or once at the end if
+           batch_size is None). If publishing a batch fails, it is rolled back and the
+           exception re-raised; batches which were already committed stay committed."""
+        # Do nothing if the channel is disabled
+        if not self.enabled:
+            return 0
+        if self.publish_on_commit and outbox.current() is not None:
+            # Buffered messages are published together when the outbox is flushed, so
+            # transactional and batch_size don't apply
+            bodies = list(bodies)
+            for body in bodies:
+                outbox.current().add(self, body, kwargs)
+            return len(bodies)
+        publisher_kwargs, properties = self._split_kwargs(kwargs)
+        if self.publish_in_background:
+            # The background thread publishes in (transactional) batches of its own
+            submit = background.get_publisher(self.connection_signature).submit
+            count = 0
+            for body in bodies:
+                body, message_properties = self._prepare(body, properties)
+                submit(publisher_kwargs['exchange'], publisher_kwargs['routing_key'], body, message_properties)
+                count += 1
+            return count
+        channel = (self.tx_channel if transactional else self.channel)
+        basic_publish, prepare, Message = channel.basic_publish, self._prepare, amqp.Message
+        logger.debug('publishing messages -> channel.basic_publish(<msgs hidden>, %r), transactional=%r', publisher_kwargs, transactional)
+        count = pending = 0
+        # The properties of claim-checked messages which aren't safely published yet, whose
+        # references are released if publishing fails
+        claim_checking = (self.claim_check_threshold is not None)
+        unsettled = []
+        started = time.time()
+        try:
+            for body in bodies:
+                body, message_properties = prepare(body, properties)
+                if claim_checking:
+                    unsettled.append(message_properties)
+                basic_publish(msg=Message(body=body, **message_properties), **publisher_kwargs)
+                if claim_checking and not transactional:
+                    del unsettled[:]
+                count += 1
+                pending += 1
+                if transactional and pending == batch_size:
+                    channel.tx_commit()
+                    pending = 0
+                    del unsettled[:]
+            if transactional and pending:
+                channel.tx_commit()
+        except:
+            for message_properties in unsettled:
+                claimcheck.release_unpublished(message_properties)
+            if transactional and pending:
+                logger.debug('rolling back batch -> channel.tx_rollback()')
+                channel.tx_rollback()
+            raise
+        if metrics.enabled and count:
+            # The batch's time is spread evenly across its messages
+            elapsed = time.time() - started
+            metrics.observe('publish_time', publisher_kwargs['exchange'], elapsed / count, count)
+            metrics.incr('published', publisher_kwargs['exchange'], count)
+        return count
 
 class JSONPublisher(Publisher):
     """Publisher that handles pushing JSON-formatted messages."""
-    def encode(self, body):
-        return simplejson.dumps(body)
+    codec = 'json'
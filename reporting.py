@@ -0,0 +1,181 @@
+"""Aggregated, rate-limited error reporting for consumer processes.
+   
+   Failures are handed to an ErrorReporter, which does nothing more on the calling thread than
+   put them on a queue. A background thread groups them by fingerprint (a hash of the stack
+   in the traceback, so that the same bug hit by different messages counts as one error), and
+   once HARE_ERROR_REPORT_WINDOW seconds have passed since a fingerprint was first seen, sends
+   a single digest of it (how many times it happened, plus the first traceback and message)
+   to a sink. After that, further digests for the fingerprint are sent at most once every
+   HARE_ERROR_REPORT_INTERVAL seconds, however often it happens in the meantime.
+   
+   Sinks are objects with a send(digest) method; MailAdminsSink (the default) emails the site
+   admins."""
+from __future__ import with_statement
+
+import atexit
+import datetime
+import hashlib
+import os
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import mail_admins
+from django.template.loader import render_to_string
+
+from .utils.log import logger
+
+def fingerprint(tb):
+    """Returns a fingerprint for a formatted traceback, made from the frames it passes
+       through and the exception's type (but not its message, which often contains data
+       from the message being processed)."""
+    lines = tb.strip().splitlines()
+    frames = [line.strip() for line in lines if line.startswith('  File ')]
+    exception_type = (lines[-1].split(':', 1)[0] if lines else '')
+    return hashlib.md5('\n'.join(frames + [exception_type])).hexdigest()
+
+class Digest(object):
+    """Every occurrence of one error (fingerprint) since its last digest was sent. The
+       traceback, message and fault_tolerant flag are those of the first occurrence."""
+    def __init__(self, fingerprint, message, traceback, fault_tolerant, seen):
+        self.fingerprint = fingerprint
+        self.message = message
+        self.traceback = traceback
+        self.fault_tolerant = fault_tolerant
+        self.count = 0
+        self.first_seen = seen
+        self.last_seen = seen
+        return super(Digest, self).__init__()
+
+class MailAdminsSink(object):
+    """Emails each digest to the site admins with mail_admins()."""
+    def send(self, digest):
+        subject = 'Queue worker error'
+        if digest.count > 1:
+            subject += ' (%d times)' % digest.count
+        mail_admins(
+            fail_silently=False,
+            subject=subject,
+            message=render_to_string('hare/worker_error.txt', {
+                'traceback': digest.traceback,
+                'message': digest.message,
+                'fault_tolerant': digest.fault_tolerant,
+                'count': digest.count,
+                'first_seen': datetime.datetime.fromtimestamp(digest.first_seen),
+                'last_seen': datetime.datetime.fromtimestamp(digest.last_seen),
+            })
+        )
+        logger.info('Traceback (seen %d times) has been emailed with mail_admins()', digest.count)
+
+class ErrorReporter(threading.Thread):
+    """Background thread which aggregates reported errors and sends their digests to the
+       sink. If the queue of reported errors fills up (because the thread can't keep up),
+       errors are dropped rather than blocking the caller; the number dropped is kept in the
+       dropped attribute."""
+    def __init__(self, sink=None, window=None, interval=None, maxsize=10000):
+        super(ErrorReporter, self).__init__(name='hare-error-reporter')
+        self.daemon = True
+        self.sink = (sink if sink is not None else MailAdminsSink())
+        self.window = (window if window is not None else getattr(settings, 'HARE_ERROR_REPORT_WINDOW', 60))
+        self.interval = (interval if interval is not None else getattr(settings, 'HARE_ERROR_REPORT_INTERVAL', 600))
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.pid = os.getpid()
+        self._pending = {} # fingerprint -> Digest
+        self._last_sent = {} # fingerprint -> when its last digest was sent
+    
+    def report(self, message, tb, fault_tolerant):
+        """Queues an error (the message being processed and the formatted traceback) to be
+           reported, starting the thread if need be."""
+        if not self.isAlive():
+            self._start()
+        try:
+            self.queue.put_nowait(('error', (message, tb, fault_tolerant, time.time())))
+        except Queue.Full:
+            self.dropped += 1
+    
+    def flush(self, timeout=None):
+        """Sends digests of every error reported so far, regardless of the rate limit, and
+           waits (for up to timeout seconds) for them to be sent."""
+        if not self.isAlive():
+            return
+        done = threading.Event()
+        self.queue.put(('flush', done))
+        done.wait(timeout)
+    
+    def close(self, timeout=5):
+        """Flushes any pending digests and stops the thread."""
+        if self.isAlive():
+            self.flush(timeout)
+            self.queue.put(None)
+            self.join(timeout)
+    
+    def _start(self):
+        with _lock:
+            if self.ident is None: # not started yet
+                self.start()
+                atexit.register(self.close)
+    
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._timeout())
+            except Queue.Empty:
+                item = (None, None)
+            if item is None:
+                return
+            kind, value = item
+            if kind == 'flush':
+                self._send(self._pending.keys())
+                value.set()
+                continue
+            if kind == 'error':
+                self._add(*value)
+            now = time.time()
+            self._send([key for key in self._pending if self._due(key) <= now])
+    
+    def _add(self, message, tb, fault_tolerant, seen):
+        key = fingerprint(tb)
+        digest = self._pending.get(key)
+        if digest is None:
+            digest = self._pending[key] = Digest(key, message, tb, fault_tolerant, seen)
+        digest.count += 1
+        digest.last_seen = seen
+    
+    def _due(self, key):
+        """When the digest of the pending fingerprint may be sent."""
+        return max(self._pending[key].first_seen + self.window, self._last_sent.get(key, 0) + self.interval)
+    
+    def _timeout(self):
+        """How long to wait for more errors before the next digest is due (or None, to wait
+           indefinitely if nothing is pending)."""
+        if not self._pending:
+            return None
+        return max(0, min(self._due(key) for key in self._pending) - time.time())
+    
+    def _send(self, keys):
+        now = time.time()
+        for key in keys:
+            digest = self._pending.pop(key)
+            self._last_sent[key] = now
+            try:
+                self.sink.send(digest)
+            except Exception:
+                logger.exception('failed to report error %s', key)
+        # Fingerprints whose rate limit has run out needn't be remembered any longer
+        for key, sent in self._last_sent.items():
+            if sent + self.interval <= now and key not in self._pending:
+                del self._last_sent[key]
+
+_lock = threading.Lock()
+_reporter = None
+
+def get_reporter():
+    """Returns the shared ErrorReporter (which uses the default sink), creating it if need be.
+       A new one is created in forked child processes, which don't inherit the thread."""
+    global _reporter
+    with _lock:
+        if _reporter is None or _reporter.pid != os.getpid():
+            _reporter = ErrorReporter()
+        return _reporter
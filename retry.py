@@ -0,0 +1,114 @@
+"""Retrying failed messages after a delay, and dead-lettering them once they've failed too often.
+   
+   A message which fails is republished to a delay queue, and acknowledged. Delay queues have
+   no consumers: each message in them expires after its (per-message) TTL, whereupon the broker
+   dead-letters it straight back onto the original queue via the default exchange. Each delay
+   (which grows exponentially with the number of attempts) gets a queue of its own, since
+   the broker only expires messages from the head of a queue. The number of attempts made so
+   far travels with the message in its x-hare-attempts header; once it reaches max_attempts,
+   the message is published to the dead letter exchange instead.
+   
+   For a queue named 'orders', the names used are:
+       orders.retry          direct exchange the delay queues are bound to
+       orders.retry.<ms>     a delay queue, for a delay of <ms> milliseconds
+       orders.dead           fanout dead letter exchange, and a queue bound to it (unless
+                             another dead letter exchange is given)"""
+from .utils.log import logger
+from .consumer import Consumer
+from .publisher import Publisher
+from . import claimcheck
+
+ATTEMPTS_HEADER = 'x-hare-attempts'
+ROUTING_KEY_HEADER = 'x-hare-routing-key' # the routing key the message was first published with
+ERROR_HEADER = 'x-hare-error' # the last line of the final traceback, for dead-lettered messages
+
+class RetryPolicy(object):
+    """Retries and dead-letters messages which failed to be processed from the consumer's
+       queue, on the consumer's channel."""
+    def __init__(self, consumer, max_attempts, delay=1, backoff=2, max_delay=300,
+                 dead_letter_exchange=None):
+        self.consumer = consumer
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_exchange = '%s.retry' % consumer.queue
+        self.dead_letter_exchange = (dead_letter_exchange if dead_letter_exchange is not None
+                                     else '%s.dead' % consumer.queue)
+        self._delay_queues = set()
+        self._retry_publisher = None
+        self._dead_letter_publisher = None
+        return super(RetryPolicy, self).__init__()
+    
+    def _publisher(self, exchange, **kwargs):
+        return Publisher(exchange=exchange, connection=self.consumer.connection, channel=self.consumer.channel,
+                         **kwargs)
+    
+    def delay_for(self, attempts):
+        """Returns the delay (in seconds) before retrying a message which has failed attempts times."""
+        return min(self.delay * self.backoff ** (attempts - 1), self.max_delay)
+    
+    def delay_queue(self, delay):
+        """Returns the name of the delay queue for the delay (in seconds), declaring it (and the
+           retry exchange) if need be."""
+        name = '%s.%d' % (self.retry_exchange, int(delay * 1000))
+        if name not in self._delay_queues:
+            if self._retry_publisher is None:
+                self._retry_publisher = self._publisher(self.retry_exchange)
+            Consumer(queue=name, exchange=self.retry_exchange, routing_key=name,
+                     connection=self.consumer.connection, channel=self.consumer.channel,
+                     queue_arguments={
+                         'x-dead-letter-exchange': '',
+                         'x-dead-letter-routing-key': self.consumer.queue,
+                     })
+            self._delay_queues.add(name)
+        return name
+    
+    def dead_letter_publisher(self):
+        if self._dead_letter_publisher is None:
+            self._dead_letter_publisher = self._publisher(self.dead_letter_exchange, exchange_type='fanout')
+            if self.dead_letter_exchange == '%s.dead' % self.consumer.queue:
+                # Somewhere for dead letters to go
+                Consumer(queue=self.dead_letter_exchange, exchange=self.dead_letter_exchange,
+                         connection=self.consumer.connection, channel=self.consumer.channel)
+        return self._dead_letter_publisher
+    
+    def retry(self, message, tb, retryable=True):
+        """Republishes a failed message, to be retried after a delay or (if it has run out of
+           attempts, or retryable is False) to the dead letter exchange, then acknowledges it.
+           Returns True if the message will be retried."""
+        properties = dict(message.properties)
+        headers = dict(properties.get('application_headers') or {})
+        attempts = headers.get(ATTEMPTS_HEADER, 0) + 1
+        headers[ATTEMPTS_HEADER] = attempts
+        headers.setdefault(ROUTING_KEY_HEADER, message.delivery_info.get('routing_key', ''))
+        properties['application_headers'] = headers
+        # Subclasses of Consumer whose decode() doesn't call up won't have kept the raw body
+        body = getattr(message, 'raw_body', message.body)
+        retrying = (retryable and attempts < self.max_attempts)
+        if getattr(message, 'claim_check', None):
+            # Acknowledging the message releases its reference to its blob, so a retried copy
+            # needs one of its own. Dead letters carry the (still encoded) body inline, since
+            # there's no telling whether anything will ever consume, and release, them.
+            store = claimcheck.get_store()
+            if retrying:
+                headers[claimcheck.HEADER] = ' '.join(store.retain(message.claim_check))
+            else:
+                body = store.open(message.claim_check)[:]
+        if not retrying:
+            # (including references to a blob which couldn't be opened, which would only make
+            # the dead letter undecodable too)
+            headers.pop(claimcheck.HEADER, None)
+        if retrying:
+            delay = self.delay_for(attempts)
+            queue = self.delay_queue(delay)
+            properties['expiration'] = str(int(delay * 1000))
+            logger.info('retrying message from %s in %ss (attempt %d of %d)', self.consumer.queue, delay, attempts, self.max_attempts)
+            self._retry_publisher.publish(body, routing_key=queue, **properties)
+        else:
+            properties.pop('expiration', None)
+            headers[ERROR_HEADER] = (tb.strip().splitlines() or [''])[-1][:1024]
+            logger.warning('dead-lettering message from %s after %d attempts', self.consumer.queue, attempts)
+            self.dead_letter_publisher().publish(body, routing_key=headers[ROUTING_KEY_HEADER], **properties)
+        self.consumer.acknowledge(message)
+        return retrying
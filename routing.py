@@ -0,0 +1,92 @@
+"""Dispatching messages to handlers by routing key, with AMQP topic exchange semantics.
+   
+   Routing keys and patterns are lists of words separated by dots. In a pattern, '*' matches
+   exactly one word and '#' matches zero or more, so 'order.*.cancelled' matches
+   'order.42.cancelled', and 'order.#' matches 'order', 'order.created' and
+   'order.42.cancelled'.
+   
+   A RoutingTable compiles its patterns into a trie keyed by word, so that matching a key
+   walks the key's words rather than trying each pattern in turn, and remembers the handlers
+   each key matched, so that a key which has been seen before is a single lookup. The same
+   patterns are the bindings a queue needs for the broker to route it everything the table
+   handles (see bindings())."""
+
+class _Node(object):
+    __slots__ = ('children', 'handlers')
+    
+    def __init__(self):
+        self.children = {} # word (or '*' or '#') -> _Node
+        self.handlers = [] # (position registered in, handler) tuples for patterns ending here
+
+class RoutingTable(object):
+    """Maps routing key patterns to handlers (which can be anything). routes is a sequence
+       of (pattern, handler) tuples to start with. Matched keys are cached; the cache is
+       emptied whenever it holds cache_size of them."""
+    def __init__(self, routes=(), cache_size=10000):
+        self.cache_size = cache_size
+        self.routes = []
+        self._root = _Node()
+        self._cache = {}
+        for pattern, handler in routes:
+            self.add(pattern, handler)
+        return super(RoutingTable, self).__init__()
+    
+    def add(self, pattern, handler):
+        """Registers a handler for the routing keys matching the pattern."""
+        node = self._root
+        for word in pattern.split('.'):
+            node = node.children.setdefault(word, _Node())
+        node.handlers.append((len(self.routes), handler))
+        self.routes.append((pattern, handler))
+        self._cache.clear()
+    
+    def match(self, routing_key):
+        """Returns a tuple of the handlers whose patterns match the routing key, in the order
+           they were registered (each handler only once, however many of its patterns match)."""
+        handlers = self._cache.get(routing_key)
+        if handlers is None:
+            found = []
+            _walk(self._root, routing_key.split('.'), 0, found)
+            handlers = []
+            for position, handler in sorted(found):
+                if handler not in handlers:
+                    handlers.append(handler)
+            handlers = tuple(handlers)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[routing_key] = handlers
+        return handlers
+    
+    def bindings(self):
+        """Returns the patterns a queue has to be bound to a topic exchange with, to receive
+           every message the table has a handler for. Patterns without wildcards which
+           another pattern already matches are left out."""
+        bindings = []
+        for pattern, handler in self.routes:
+            if pattern in bindings:
+                continue
+            words = pattern.split('.')
+            if '*' not in words and '#' not in words:
+                if [other for other, other_handler in self.routes
+                    if other != pattern and _matches(other, pattern)]:
+                    continue
+            bindings.append(pattern)
+        return bindings
+
+def _walk(node, words, i, found):
+    """Collects the handlers of the patterns under node which match words[i:]."""
+    following = node.children.get('#')
+    if following is not None:
+        # '#' swallows any number of words (including none)
+        for j in xrange(i, len(words) + 1):
+            _walk(following, words, j, found)
+    if i == len(words):
+        found.extend(node.handlers)
+        return
+    for word in (words[i], '*'):
+        child = node.children.get(word)
+        if child is not None:
+            _walk(child, words, i + 1, found)
+
+def _matches(pattern, routing_key):
+    return bool(RoutingTable([(pattern, None)], cache_size=0).match(routing_key))
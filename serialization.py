@@ -0,0 +1,95 @@
+"""Registry of codecs used to serialize message bodies, plus optional compression.
+   
+   Publishers stamp the content_type (and, when compressed, content_encoding) of each message,
+   which consumers use to pick the matching codec when decoding."""
+import cPickle
+import zlib
+
+from django.utils import simplejson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class DecodeError(ValueError):
+    """Raised when a message body can't (or mustn't) be decoded."""
+    pass
+
+class Codec(object):
+    """Serializes message bodies to and from strings. Codecs are looked up by name or by
+       content_type. Codecs which are only safe for data from trusted sources (e.g. pickle)
+       set trusted_only, and are refused by consumers that aren't marked as trusted."""
+    name = NotImplemented
+    content_type = NotImplemented
+    trusted_only = False
+    
+    def encode(self, body):
+        raise NotImplementedError
+    
+    def decode(self, data):
+        raise NotImplementedError
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+    
+    def encode(self, body):
+        return simplejson.dumps(body, separators=(',', ':'))
+    
+    def decode(self, data):
+        return simplejson.loads(data)
+
+class MsgPackCodec(Codec):
+    """Compact binary codec (only available if msgpack is installed)."""
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    
+    def encode(self, body):
+        return msgpack.packb(body)
+    
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    content_type = 'application/x-python-serialize'
+    trusted_only = True
+    
+    def encode(self, body):
+        return cPickle.dumps(body, cPickle.HIGHEST_PROTOCOL)
+    
+    def decode(self, data):
+        return cPickle.loads(data)
+
+_codecs = {}
+
+def register(codec):
+    """Registers a Codec instance, under both its name and its content type."""
+    _codecs[codec.name] = codec
+    _codecs[codec.content_type] = codec
+
+def get_codec(name):
+    """Returns the codec registered with the passed name or content type, or None if
+       there isn't one."""
+    return _codecs.get(name)
+
+register(JSONCodec())
+register(PickleCodec())
+if msgpack is not None:
+    register(MsgPackCodec())
+
+# Compression, keyed by content_encoding. Note that these names must not also be the names
+# of Python string codecs, or amqplib will try to 'decode' bodies with them on delivery.
+COMPRESSIONS = {
+    'deflate': (zlib.compress, zlib.decompress),
+}
+
+def compress(encoding, data):
+    return COMPRESSIONS[encoding][0](data)
+
+def decompress(encoding, data):
+    try:
+        return COMPRESSIONS[encoding][1](data)
+    except zlib.error, e:
+        raise DecodeError('could not decompress %s message body: %s' % (encoding, e))
@@ -0,0 +1,271 @@
+"""Running a ConsumerProcess in several forked worker processes, scaled to the queue's backlog.
+   
+   A Supervisor forks workers, each of which creates its own instance of the ConsumerProcess
+   subclass (and so its own connection: nothing opened before the fork is used afterwards,
+   see utils.fork) and runs it until told to stop. Workers which die are replaced.
+   
+   Every interval seconds, the supervisor checks the depth of the queue (and how many
+   consumers it has) with a passive queue_declare, and aims for one worker per
+   backlog_per_worker waiting messages, between min_workers and max_workers. Consumers
+   which aren't the supervisor's own (on other hosts, say) are taken to be draining the
+   backlog too. Workers are added as soon as they're needed, but removed only one per
+   interval, so that a briefly empty queue doesn't shed every worker. Workers which die are
+   replaced after a delay which doubles each time one dies soon after starting (as they all
+   will whilst the broker is down, say).
+   
+   Workers are stopped with SIGTERM, which lets them finish the message in hand; sending
+   the supervisor SIGTERM (or SIGINT) stops it and all its workers. From the command line:
+       
+       python -m hare.supervisor myapp.workers.OrderProcess --max-workers 8"""
+import atexit
+import errno
+import math
+import optparse
+import os
+import signal
+import sys
+import time
+import traceback
+from amqplib import client_0_8 as amqp
+
+from .utils.fork import after_fork
+from .utils.log import logger
+from .background import CONNECTION_ERRORS
+from .connection import AMQPConnection
+
+class Supervisor(object):
+    """Forks and supervises workers running process_class (a ConsumerProcess subclass), whose
+       run() is called with run_kwargs. max_workers defaults to the number of CPUs."""
+    # How often (in seconds) dead workers are looked for
+    poll_interval = 0.5
+    # How long (in seconds) workers are given to finish up once asked to stop, before
+    # they're killed
+    shutdown_timeout = 30
+    # A worker which dies is replaced after restart_delay seconds, doubled (up to
+    # max_restart_delay) for as long as workers keep dying within stable_after seconds of
+    # being started
+    restart_delay = 1
+    max_restart_delay = 60
+    stable_after = 30
+    
+    def __init__(self, process_class, min_workers=1, max_workers=None, backlog_per_worker=100,
+                 interval=5, run_kwargs=None):
+        self.process_class = process_class
+        self.queues = (sorted(process_class.queues) if process_class.queues else [process_class.queue])
+        self.name = ', '.join(self.queues) # for logging
+        self.min_workers = min_workers
+        self.max_workers = (max_workers if max_workers is not None else os.sysconf('SC_NPROCESSORS_ONLN'))
+        assert 1 <= self.min_workers <= self.max_workers, 'need 1 <= min_workers <= max_workers'
+        self.backlog_per_worker = backlog_per_worker
+        self.interval = interval
+        self.run_kwargs = (run_kwargs or {})
+        self.workers = [] # pids, oldest first
+        self.wanted = min_workers
+        self._retiring = [] # pids of workers which have been asked to stop
+        self._started = {} # pid -> when the worker was started
+        self._next_delay = None # (meaning restart_delay)
+        self._restart_at = 0 # when workers may next be started
+        self._stopping = False
+        self._connection = None
+        return super(Supervisor, self).__init__()
+    
+    def target(self, messages, consumers):
+        """Returns how many workers are wanted for a queue with the passed number of waiting
+           messages and consumers."""
+        wanted = int(math.ceil(messages / float(self.backlog_per_worker)))
+        # Each worker has a single consumer; any others are somebody else's
+        wanted -= max(consumers - len(self.workers) - len(self._retiring), 0)
+        return min(max(wanted, self.min_workers), self.max_workers)
+    
+    def sample(self):
+        """Returns the (message count, consumer count) of the queue, or None if the broker
+           couldn't be asked. For a process with several queues, the messages waiting on all
+           of them are counted, along with the consumers of the one with the most (since
+           each worker consumes from every queue)."""
+        messages = consumers = 0
+        try:
+            if self._connection is None:
+                self._connection = AMQPConnection(pooled=True)
+            for queue in self.queues:
+                name, count, consumer_count = self._connection.channel.queue_declare(queue=queue, passive=True)
+                messages += count
+                consumers = max(consumers, consumer_count)
+        except CONNECTION_ERRORS + (amqp.AMQPException,), e:
+            # (a channel error most likely means no worker has declared the queue yet)
+            logger.warning('failed to check the depth of %s (%s)', self.name, e)
+            self._disconnect()
+            return None
+        return messages, consumers
+    
+    def rescale(self):
+        """Samples the queue and adjusts the number of workers wanted to match."""
+        sample = self.sample()
+        if sample is None:
+            return
+        target = self.target(*sample)
+        if target < self.wanted:
+            target = self.wanted - 1
+        if target != self.wanted:
+            logger.info('scaling %s from %d to %d workers (%d messages waiting, %d consumers)',
+                        self.name, self.wanted, target, sample[0], sample[1])
+        self.wanted = target
+    
+    def spawn(self):
+        """Forks a new worker, returning its pid."""
+        pid = os.fork()
+        if pid == 0:
+            self._work() # never returns
+        self.workers.append(pid)
+        self._started[pid] = time.time()
+        logger.debug('started worker %d for %s', pid, self.name)
+        return pid
+    
+    def reap(self):
+        """Forgets about workers which have exited, returning their pids."""
+        reaped = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid == 0:
+                break
+            started = self._started.pop(pid, None)
+            if pid in self._retiring:
+                self._retiring.remove(pid)
+                reaped.append(pid)
+            elif pid in self.workers:
+                self.workers.remove(pid)
+                reaped.append(pid)
+                if not self._stopping:
+                    logger.error('worker %d for %s exited unexpectedly (status %d)', pid, self.name, status)
+                    self._back_off(started)
+        return reaped
+    
+    def _back_off(self, started):
+        """Holds off starting workers after one started at started has died."""
+        now = time.time()
+        if self._next_delay is None or (started is not None and now - started >= self.stable_after):
+            # (if it had been running happily, this is no crash loop)
+            self._next_delay = self.restart_delay
+        logger.info('restarting workers for %s in %ss', self.name, self._next_delay)
+        self._restart_at = now + self._next_delay
+        self._next_delay = min(self._next_delay * 2, self.max_restart_delay)
+    
+    def stop(self):
+        """Makes run() stop the workers and return (safe to call from a signal handler)."""
+        self._stopping = True
+    
+    def run(self):
+        """Supervises workers until stop() is called (or SIGTERM or SIGINT is received)."""
+        self._stopping = False
+        handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(signum, lambda signum, frame: self.stop())
+        try:
+            next_sample = time.time()
+            while not self._stopping:
+                self.reap()
+                if time.time() >= next_sample:
+                    self.rescale()
+                    next_sample = time.time() + self.interval
+                while (len(self.workers) < self.wanted and not self._stopping and
+                       time.time() >= self._restart_at):
+                    self.spawn()
+                while len(self.workers) > self.wanted:
+                    # The newest workers go first
+                    self._terminate(self.workers.pop())
+                time.sleep(self.poll_interval)
+        finally:
+            self.shutdown()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+    
+    def shutdown(self):
+        """Stops every worker, killing those which don't stop within shutdown_timeout."""
+        self._stopping = True
+        while self.workers:
+            self._terminate(self.workers.pop())
+        deadline = time.time() + self.shutdown_timeout
+        while self._retiring and time.time() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in self._retiring:
+            logger.warning('killing worker %d for %s, which did not stop in time', pid, self.name)
+            self._signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._retiring = []
+        self._disconnect()
+    
+    def _terminate(self, pid):
+        """Asks a worker which is no longer wanted to stop; it's reaped once it has."""
+        self._retiring.append(pid)
+        self._signal(pid, signal.SIGTERM)
+        logger.debug('stopping worker %d for %s', pid, self.name)
+    
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH: # already gone
+                raise
+    
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except CONNECTION_ERRORS + (amqp.AMQPException,):
+                pass
+            self._connection = None
+    
+    def _work(self):
+        """Runs a worker, in the freshly forked child process; never returns."""
+        status = 0
+        process = None
+        try:
+            # Until there's a process to stop, SIGTERM just kills the worker; SIGINT is left
+            # to the supervisor (it's sent to the whole process group from a terminal)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            after_fork()
+            process = self.process_class()
+            signal.signal(signal.SIGTERM, lambda signum, frame: process.stop())
+            # Blocking reads resume after the signal; select() still returns early
+            signal.siginterrupt(signal.SIGTERM, False)
+            kwargs = dict(self.run_kwargs)
+            kwargs.setdefault('idle_timeout', process.poll_interval)
+            process.run(**kwargs)
+        except:
+            logger.critical(traceback.format_exc())
+            status = 1
+        try:
+            if process is not None:
+                process.consumer.close()
+            # Things started in this process (such as the error reporter) are flushed by
+            # their exit functions; those inherited from the supervisor know to do nothing
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            # Not sys.exit(), which would unwind into the supervisor's frames
+            os._exit(status)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] package.module.ConsumerProcessSubclass')
+    parser.add_option('--min-workers', type='int', default=1)
+    parser.add_option('--max-workers', type='int', help='defaults to the number of CPUs')
+    parser.add_option('--backlog-per-worker', type='int', default=100, help='waiting messages per worker')
+    parser.add_option('--interval', type='float', default=5, help='seconds between queue depth checks')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a ConsumerProcess subclass is required')
+    module, name = args[0].rsplit('.', 1)
+    __import__(module)
+    process_class = getattr(sys.modules[module], name)
+    Supervisor(process_class, options.min_workers, options.max_workers, options.backlog_per_worker,
+               options.interval).run()
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,19 @@
 from .communication import MQCommunication
 from .identity_map import MQIdentityMap
+from .pool import MQPool
+from .serialization import Serialization
+from .metrics import Metrics
+from .broker import FakeBrokerTest
+from .reporting import Reporting
+from .retry import Retry
+from .batching import Batching
+from .outbox import Outbox
+from .background import Background
+from .supervisor import SupervisorTest
+from .multiplex import Multiplexing
+from .routing import Routing
+from .dedup import Dedup
+from .coalescing import Coalescing
+from .claimcheck import ClaimCheck
+from .executors import Executors
+from .log import Log
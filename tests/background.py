@@ -0,0 +1,214 @@
+import cPickle
+import os
+import socket
+import tempfile
+import time
+from amqplib import client_0_8 as amqp
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from .. import background
+from ..background import BackgroundPublisher, Spool
+from ..connection import AMQPConnection
+from ..consumer import Consumer
+from ..publisher import Publisher
+from ..utils.broker import FakeBroker
+
+def _signature(host):
+    return tuple(sorted({'host': host, 'userid': 'guest', 'password': 'guest', 'virtual_host': '/', 'insist': False}.items()))
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def _unreachable():
+    """Returns the signature of a broker address with nothing listening on it."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return _signature('127.0.0.1:%d' % port)
+
+class _FakeChannel(object):
+    """Refuses messages routed to 'refused', and loses the connection on 'down'."""
+    def __init__(self):
+        self.pending = []
+        self.published = []
+    
+    def channel(self):
+        return self
+    
+    def tx_select(self):
+        pass
+    
+    def basic_publish(self, message, exchange, routing_key):
+        if routing_key == 'refused':
+            raise amqp.AMQPChannelException(404, 'NOT_FOUND', (60, 40))
+        if routing_key == 'down':
+            raise socket.error('connection lost')
+        self.pending.append(message.body)
+    
+    def tx_commit(self):
+        self.published.extend(self.pending)
+    
+    def close(self):
+        self.pending = []
+
+class _FakePool(object):
+    def __init__(self, channel):
+        self.connection = channel
+    
+    def checkout(self):
+        return self.connection
+    
+    def checkin(self, connection):
+        pass
+
+class Background(TestCase):
+    """Tests the disk spool, and background publishing through a broker outage."""
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'test.spool')
+    
+    def test_spool(self):
+        spool = Spool(self.path, chunk_size=4096)
+        records = ['%d' % i * 100 for i in range(100)] # enough to grow the file
+        for record in records:
+            spool.append(record)
+        read, offset = spool.read(40)
+        self.assertEqual(records[:40], read)
+        spool.advance(offset)
+        spool.close()
+        # Unread records survive reopening
+        spool = Spool(self.path, chunk_size=4096)
+        read, offset = spool.read(1000)
+        self.assertEqual(records[40:], read)
+        spool.advance(offset)
+        self.failIf(spool)
+        spool.close()
+        self.failIf(os.path.exists(self.path))
+    
+    def test_outage(self):
+        # Find a port with nothing listening on it
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        signature = _signature('127.0.0.1:%d' % port)
+        publisher = BackgroundPublisher(signature, maxsize=5, retry_interval=0.05, spool_path=self.path)
+        sent = [str(i) for i in range(20)]
+        for body in sent:
+            publisher.submit('', '_hare_test_background', body, {})
+        # Everything is spooled (in order) when the publisher gives up...
+        self.assert_(_wait_for(lambda: os.path.exists(self.path)))
+        publisher.close()
+        self.assert_(os.path.exists(self.path))
+        
+        broker = FakeBroker(port=port).start()
+        try:
+            connection = AMQPConnection(host=broker.address)
+            consumer = Consumer(queue='_hare_test_background', exchange='amq.direct', connection=connection)
+            # ...and replayed by the next publisher to use the spool
+            publisher = BackgroundPublisher(signature, spool_path=self.path)
+            publisher.submit('', '_hare_test_background', 'new', {})
+            received = []
+            def receive():
+                received.extend(message.body for message in consumer)
+                return len(received) > len(sent)
+            self.assert_(_wait_for(receive))
+            self.assertEqual(sent + ['new'], received)
+            publisher.close()
+            consumer.destroy_queue()
+            connection.close()
+        finally:
+            broker.stop()
+        self.failIf(os.path.exists(self.path))
+    
+    def test_publisher_outage(self):
+        signature = _unreachable()
+        # (a long retry_interval, so that it only tries again once the next message arrives)
+        publisher = BackgroundPublisher(signature, retry_interval=60, spool_path=self.path)
+        background._publishers[signature] = publisher
+        old_host = getattr(settings, 'AMQP_HOST', None)
+        settings.AMQP_HOST = dict(signature)['host']
+        try:
+            # A Publisher can be created, and publish, without the broker...
+            exchange_publisher = Publisher(exchange='_hare_test_background', routing_key='test',
+                                           publish_in_background=True)
+            exchange_publisher.publish('a', exchange='', routing_key='_hare_test_background')
+        finally:
+            settings.AMQP_HOST = old_host
+        self.assert_(_wait_for(lambda: os.path.exists(self.path)))
+        
+        broker = FakeBroker(port=int(dict(signature)['host'].split(':')[1])).start()
+        try:
+            connection = AMQPConnection(host=broker.address)
+            consumer = Consumer(queue='_hare_test_background', exchange='amq.direct', connection=connection)
+            exchange_publisher.publish('b', exchange='', routing_key='_hare_test_background')
+            received = []
+            def receive():
+                received.extend(message.body for message in consumer)
+                return len(received) >= 2
+            self.assert_(_wait_for(receive))
+            self.assertEqual(['a', 'b'], received)
+            # ...and its exchange is declared by the background thread once the broker is back
+            connection.channel.exchange_declare(exchange='_hare_test_background', type='direct', passive=True)
+            publisher.close()
+            consumer.destroy_queue()
+            connection.close()
+        finally:
+            del background._publishers[signature]
+            broker.stop()
+    
+    def test_shared_spool(self):
+        # Two processes (or, here, publishers) with the same fixed spool path
+        signature = _unreachable()
+        first = BackgroundPublisher(signature, maxsize=0, retry_interval=0.05, spool_path=self.path)
+        second = BackgroundPublisher(signature, maxsize=0, retry_interval=0.05, spool_path=self.path)
+        first.submit('', '_hare_test_background', 'a', {})
+        second.submit('', '_hare_test_background', 'b', {})
+        self.assertEqual(self.path, first.spool_path)
+        self.assertEqual('%s.%d' % (self.path, os.getpid()), second.spool_path)
+        first.close()
+        second.close()
+        for path, body in ((self.path, 'a'), (second.spool_path, 'b')):
+            spool = Spool(path)
+            self.assertEqual([body], [cPickle.loads(record)[2] for record in spool.read(10)[0]])
+            spool.close(remove_if_empty=False)
+    
+    def test_close_timeout(self):
+        # A "broker" which accepts connections but never says anything, so publishing hangs
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        try:
+            publisher = BackgroundPublisher(_signature('127.0.0.1:%d' % sock.getsockname()[1]),
+                                            batch_size=2, spool_path=self.path)
+            for body in 'abc':
+                publisher.submit('', '_hare_test_background', body, {})
+            self.assert_(_wait_for(lambda: publisher._in_flight))
+            publisher.close(timeout=0.1)
+            self.assert_(publisher.isAlive())
+        finally:
+            sock.close()
+        # Once the publish fails, the thread leaves the (closed) spool alone
+        publisher.join(5)
+        self.failIf(publisher.isAlive())
+        # The batch in hand was spooled along with the rest
+        spool = Spool(self.path)
+        self.assertEqual(list('abc'), [cPickle.loads(record)[2] for record in spool.read(10)[0]])
+        spool.close(remove_if_empty=False)
+    
+    def test_partial_batch(self):
+        publisher = BackgroundPublisher(_unreachable(), spool_path=self.path)
+        channel = _FakeChannel()
+        publisher.pool = _FakePool(channel)
+        batch = [('', routing_key, body, {}) for routing_key, body in
+                 (('ok', 'a'), ('refused', 'b'), ('ok', 'c'), ('down', 'd'), ('ok', 'e'))]
+        self.assertRaises(socket.error, publisher._publish, batch)
+        # Once the batch was refused, its messages went one at a time until the connection
+        # was lost; only those which weren't published are left to retry
+        self.assertEqual(['a', 'c'], channel.published)
+        self.assertEqual(['d', 'e'], [record[2] for record in batch])
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.db import connection
+from django.test.testcases import TransactionTestCase
+
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_batch_queue'
+    consumer_args = {'exchange': '_hare_test_batch', 'routing_key': 'test'}
+    batch_size = 8
+    error_reporter = NullReporter()
+    
+    def __init__(self):
+        self.batches = []
+        super(Worker, self).__init__()
+    
+    def process_batch(self, messages):
+        self.batches.append([message.body for message in messages])
+        return super(Worker, self).process_batch(messages)
+    
+    def process_message(self, message):
+        if message.body == 'bad':
+            raise ValueError('bad message')
+        connection.cursor().execute('INSERT INTO hare_test_batch (body) VALUES (%s)', [message.body])
+
+class Batching(TransactionTestCase):
+    """Tests processing batches of messages in database transactions (which, unlike TestCase,
+       TransactionTestCase lets actually commit)."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        connection.cursor().execute('CREATE TABLE hare_test_batch (body varchar(10))')
+        self.publisher = JSONPublisher(exchange='_hare_test_batch', routing_key='test')
+        self.worker = Worker()
+    
+    def tearDown(self):
+        self.worker.consumer.destroy_queue()
+        self.publisher.destroy_exchange()
+        connection.cursor().execute('DROP TABLE hare_test_batch')
+    
+    def committed(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT body FROM hare_test_batch ORDER BY body')
+        return [row[0] for row in cursor.fetchall()]
+    
+    def test_batches(self):
+        sent = [str(i) for i in range(10, 26)]
+        self.publisher.publish_many(sent)
+        self.worker.run(limit=16)
+        self.assertEqual([sent[:8], sent[8:]], self.worker.batches)
+        self.assertEqual(sent, self.committed())
+        self.assertRaises(IndexError, self.worker.consumer.pop) # all acknowledged
+    
+    def test_bisection(self):
+        sent = ['1', '2', '3', 'bad', '5', '6', '7', '8']
+        self.publisher.publish_many(sent)
+        self.worker.run(limit=8)
+        self.assertEqual(sent, self.worker.batches[0])
+        self.assertEqual(['1', '2', '3', '5', '6', '7', '8'], self.committed())
+        # The bad message ended up in a batch of its own
+        self.assert_(['bad'] in self.worker.batches)
+    
+    def test_failures_keep_window(self):
+        # Failed messages are left unacknowledged, but mustn't use up the prefetch window
+        self.worker.batch_size = 2
+        self.publisher.publish_many(['bad', 'bad', '1', '2'])
+        self.worker.run(limit=4)
+        self.assertEqual(['1', '2'], self.committed())
@@ -0,0 +1,45 @@
+from django.test.testcases import TestCase
+
+from ..connection import AMQPConnection
+from ..consumer import Consumer
+from ..publisher import Publisher
+from ..utils.broker import FakeBroker, _topic_match
+
+class FakeBrokerTest(TestCase):
+    """Tests the fake broker against amqplib, on a broker of its own."""
+    def setUp(self):
+        self.broker = FakeBroker().start()
+        self.connection = AMQPConnection(host=self.broker.address)
+    
+    def tearDown(self):
+        self.connection.close()
+        self.broker.stop()
+    
+    def test_topic_match(self):
+        self.assert_(_topic_match('a.*.c'.split('.'), 'a.b.c'.split('.')))
+        self.assert_(_topic_match('a.#'.split('.'), ['a']))
+        self.assert_(_topic_match('#.c'.split('.'), 'a.b.c'.split('.')))
+        self.failIf(_topic_match('a.*'.split('.'), 'a.b.c'.split('.')))
+    
+    def test_topic_routing(self):
+        publisher = Publisher(exchange='_hare_test_topic', exchange_type='topic', connection=self.connection)
+        consumer = Consumer(exchange='_hare_test_topic', queue='_hare_test_orders',
+                            routing_key='orders.#', connection=self.connection)
+        publisher.publish('created', routing_key='orders.created')
+        publisher.publish('ignored', routing_key='users.created')
+        self.assertEqual('created', consumer.pop().body)
+        self.assertRaises(IndexError, consumer.pop)
+    
+    def test_prefetch(self):
+        publisher = Publisher(exchange='_hare_test_qos', connection=self.connection)
+        consumer = Consumer(exchange='_hare_test_qos', queue='_hare_test_qos', prefetch_count=2,
+                            connection=self.connection)
+        publisher.publish_many(['a', 'b', 'c'])
+        received = []
+        for message in consumer.message_iterator(idle_timeout=0.1):
+            if message is None:
+                break
+            received.append(message)
+        # The third message isn't delivered until one of the first two is acked
+        self.assertEqual(['a', 'b'], [message.body for message in received])
+        consumer.acknowledge_batch(received)
@@ -0,0 +1,181 @@
+import mmap
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from .. import claimcheck, retry
+from ..consumer import Consumer, JSONConsumer
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher, Publisher
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_claimcheck_worker'
+    consumer_args = {'exchange': '_hare_test_claimcheck', 'routing_key': 'worker'}
+    max_attempts = 3
+    retry_delay = 0.05
+    error_reporter = NullReporter()
+    failures = 1
+    
+    def __init__(self):
+        self.attempts = []
+        super(Worker, self).__init__()
+    
+    def process_message(self, message):
+        self.attempts.append(len(message.body['data']))
+        if len(self.attempts) <= self.failures:
+            raise ValueError('failed')
+
+class DeadWorker(Worker):
+    max_attempts = 1
+
+def _files(store):
+    """Returns the names of the files (and directories) in the store."""
+    names = []
+    for directory, subdirectories, files in os.walk(store.path):
+        names.extend(subdirectories + files)
+    return sorted(names)
+
+class ClaimCheck(TestCase):
+    """Tests the blob store's reference counting, and passing large bodies through it."""
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self._old_path = getattr(settings, 'HARE_CLAIM_CHECK_PATH', None)
+        settings.HARE_CLAIM_CHECK_PATH = self.path
+        self.store = claimcheck.get_store()
+    
+    def tearDown(self):
+        settings.HARE_CLAIM_CHECK_PATH = self._old_path
+        shutil.rmtree(self.path)
+    
+    def test_store(self):
+        refs = self.store.put('x' * 100, references=2)
+        self.assertEqual(4, len(_files(self.store))) # the directory, the blob and the references
+        body = self.store.open(refs)
+        self.assert_(isinstance(body, mmap.mmap))
+        self.assertEqual('x' * 100, body[:])
+        self.store.release(refs[:1])
+        self.assertEqual('x' * 100, self.store.open(refs)[:]) # through the other reference
+        self.store.release(refs[1:])
+        self.assertEqual([], _files(self.store))
+        self.assertRaises(claimcheck.MissingBlob, self.store.open, refs)
+        self.assertEqual('', self.store.open(self.store.put('')))
+    
+    def test_invalid_references(self):
+        fd, victim = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            outside = os.path.relpath(victim, os.path.join(self.path, '..'))
+            digest = 'a' * 40
+            for ref in (outside, '../' + digest + '.1.1', digest + '.1.1/../x', digest + '.1.1\n', digest):
+                for method in (self.store.open, self.store.retain, self.store.release):
+                    self.assertRaises(claimcheck.InvalidReference, method, [ref])
+            # Nor does a message naming one get anywhere
+            publisher = Publisher(exchange='_hare_test_claimcheck', routing_key='evil')
+            consumer = Consumer(queue='_hare_test_claimcheck_evil', exchange='_hare_test_claimcheck', routing_key='evil')
+            publisher.publish('', application_headers={claimcheck.HEADER: outside})
+            self.assertRaises(claimcheck.InvalidReference, consumer.pop)
+            consumer.destroy_queue()
+            self.assert_(os.path.exists(victim))
+        finally:
+            os.unlink(victim)
+    
+    def test_publish(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_claimcheck', routing_key='test', claim_check_threshold=1000)
+        consumer = JSONConsumer(queue='_hare_test_claimcheck_queue', exchange='_hare_test_claimcheck', routing_key='test')
+        large = {'data': 'x' * 5000}
+        publisher.publish({'data': 'small'})
+        publisher.publish(large)
+        message = consumer.pop()
+        self.assertEqual({'data': 'small'}, message.body)
+        self.assert_(claimcheck.references(message) is None)
+        consumer.acknowledge(message)
+        message = consumer.pop()
+        self.assertEqual('', message.raw_body)
+        self.assertEqual(large, message.body)
+        self.assertNotEqual([], _files(self.store))
+        consumer.acknowledge(message)
+        self.assertEqual([], _files(self.store))
+        consumer.destroy_queue()
+    
+    def test_failed_publish(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = Publisher(exchange='_hare_test_claimcheck_missing', force_no_declare=True,
+                              claim_check_threshold=1000)
+        self.assertRaises(Exception, publisher.publish_many, ['x' * 5000, 'y' * 5000], transactional=True)
+        # Nothing was published, so nothing is left referring to the blobs
+        self.assertEqual([], _files(self.store))
+        publisher.close()
+    
+    def test_raw_body(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = Publisher(exchange='_hare_test_claimcheck', routing_key='raw', claim_check_threshold=1000)
+        consumer = Consumer(queue='_hare_test_claimcheck_raw', exchange='_hare_test_claimcheck', routing_key='raw')
+        publisher.publish('y' * 5000)
+        message = consumer.pop()
+        # Mapped in from the blob, rather than copied
+        self.assert_(isinstance(message.body, mmap.mmap))
+        self.assertEqual('y' * 5000, message.body[:])
+        consumer.acknowledge(message)
+        consumer.destroy_queue()
+    
+    def test_no_ack(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = Publisher(exchange='_hare_test_claimcheck', routing_key='no_ack', claim_check_threshold=1000)
+        consumer = Consumer(queue='_hare_test_claimcheck_no_ack', exchange='_hare_test_claimcheck', routing_key='no_ack')
+        publisher.publish('z' * 5000)
+        for message in consumer.message_iterator(no_ack=True, limit=1):
+            # Released as soon as it was decoded, but still readable
+            self.assertEqual([], _files(self.store))
+            self.assertEqual('z' * 5000, message.body[:])
+        consumer.destroy_queue()
+    
+    def test_retry(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_claimcheck', routing_key='worker', claim_check_threshold=1000)
+        worker = Worker()
+        publisher.publish({'data': 'z' * 5000})
+        worker.run(limit=2)
+        # The retried copy had a reference of its own, which was released in turn
+        self.assertEqual([5000, 5000], worker.attempts)
+        self.assertEqual([], _files(self.store))
+    
+    def test_dead_letter(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_claimcheck', routing_key='worker', claim_check_threshold=1000)
+        worker = DeadWorker()
+        publisher.publish({'data': 'z' * 5000})
+        worker.run(limit=1)
+        # The dead letter carries its body itself, so nothing is left in the store
+        self.assertEqual([], _files(self.store))
+        dead = JSONConsumer(queue='_hare_test_claimcheck_worker.dead', force_no_declare=True)
+        message = dead.pop()
+        dead.acknowledge(message)
+        self.assertEqual({'data': 'z' * 5000}, message.body)
+        self.assert_(claimcheck.references(message) is None)
+    
+    def test_undecodable(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_claimcheck', routing_key='worker', claim_check_threshold=1000)
+        worker = Worker()
+        publisher.publish({'data': 'z' * 5000})
+        for name in os.listdir(self.path): # (as a sweep of the store might)
+            shutil.rmtree(os.path.join(self.path, name))
+        publisher.publish('', application_headers={claimcheck.HEADER: '../../etc/passwd'})
+        # Neither gets as far as process_message, nor stops the worker; both are dead-lettered
+        # straight away
+        worker.run(limit=2)
+        self.assertEqual([], worker.attempts)
+        dead = Consumer(queue='_hare_test_claimcheck_worker.dead', force_no_declare=True)
+        errors = []
+        # (read raw, since there's no body left to decode)
+        for message in iter(lambda: dead.channel.basic_get(dead.queue), None):
+            dead.acknowledge(message)
+            headers = message.properties['application_headers']
+            self.assert_(claimcheck.HEADER not in headers)
+            errors.append(headers[retry.ERROR_HEADER].split(':')[0])
+        self.assertEqual(['MissingBlob', 'InvalidReference'], errors)
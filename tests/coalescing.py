@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_coalescing_queue'
+    consumer_args = {'exchange': '_hare_test_coalescing', 'routing_key': 'test'}
+    coalesce_window = 0.2
+    
+    def __init__(self):
+        self.processed = []
+        super(Worker, self).__init__()
+    
+    def coalesce_key(self, message):
+        return message.body['entity']
+    
+    def process_message(self, message):
+        self.processed.append((message.body['entity'], message.body['version']))
+
+class FailingWorker(Worker):
+    error_reporter = NullReporter()
+    
+    def process_message(self, message):
+        if message.body['entity'] == 'b':
+            raise ValueError('failed')
+        return super(FailingWorker, self).process_message(message)
+
+class MergingWorker(Worker):
+    def process_coalesced(self, key, messages):
+        self.processed.append((key, [message.body['version'] for message in messages]))
+
+class Coalescing(TestCase):
+    """Tests collapsing bursts of messages about the same thing."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        self.publisher = JSONPublisher(exchange='_hare_test_coalescing', routing_key='test')
+    
+    def publish(self):
+        updates = [('a', 1), ('b', 1), ('a', 2), (None, 1), ('a', 3), ('b', 2), (None, 2)]
+        self.publisher.publish_many([{'entity': entity, 'version': version} for entity, version in updates])
+        return len(updates)
+    
+    def test_latest(self):
+        worker = Worker()
+        multi_acks = []
+        acknowledge_batch = worker.consumer.acknowledge_batch
+        def counting_acknowledge_batch(messages):
+            multi_acks.append(len(messages))
+            acknowledge_batch(messages)
+        worker.consumer.acknowledge_batch = counting_acknowledge_batch
+        worker.run(limit=self.publish())
+        self.assertEqual([('a', 3), ('b', 2), (None, 1), (None, 2)], worker.processed)
+        self.assertEqual([7], multi_acks)
+        self.assertRaises(IndexError, worker.consumer.pop)
+    
+    def test_merged(self):
+        worker = MergingWorker()
+        worker.run(limit=self.publish())
+        self.assertEqual([('a', [1, 2, 3]), ('b', [1, 2]), (None, [1]), (None, [2])], worker.processed)
+        self.assertRaises(IndexError, worker.consumer.pop)
+    
+    def test_failure(self):
+        worker = FailingWorker()
+        updates = [('a', 1), ('b', 1), ('c', 1), ('a', 2)]
+        self.publisher.publish_many([{'entity': entity, 'version': version} for entity, version in updates])
+        self.assertRaises(ValueError, worker.run, fault_tolerant=False, limit=len(updates))
+        self.assertEqual([('a', 2)], worker.processed)
+        # Only a's messages were acknowledged; b's and c's come back once the channel closes
+        worker.consumer.close()
+        consumer = Worker().consumer
+        messages = list(consumer)
+        consumer.acknowledge_batch(messages)
+        self.assertEqual([('b', 1), ('c', 1)], [(message.body['entity'], message.body['version']) for message in messages])
+    
+    def test_failures_keep_window(self):
+        # Failed messages are left unacknowledged, but mustn't use up the prefetch window
+        worker = FailingWorker()
+        worker.coalesce_max = 2
+        updates = [('b', 1), ('b', 2), ('a', 1), ('c', 1)]
+        self.publisher.publish_many([{'entity': entity, 'version': version} for entity, version in updates])
+        worker.run(limit=len(updates))
+        self.assertEqual([('a', 1), ('c', 1)], worker.processed)
+        # (b's messages come back once the channel closes)
+        worker.consumer.close()
+        consumer = Worker().consumer
+        consumer.acknowledge_batch(list(consumer))
+    
+    def test_prefetch_reset(self):
+        worker = Worker()
+        worker.run(limit=self.publish())
+        # (so that closing the consumer puts the channel back the way it was)
+        self.assertEqual(Worker.coalesce_max, worker.consumer.prefetch_count)
@@ -1,4 +1,6 @@
 # encoding: utf-8
+import threading
+import time
 import uuid
 
 from django.conf import settings
@@ -30,3 +32,48 @@ class MQCommunication(TestCase):
         self.publisher.publish(sent)
         received = self.consumer.pop()
         self.assertEqual(sent, received.body)
+    
+    def test_batch_iterator(self):
+        sent = [unicode(uuid.uuid4()) for i in range(25)]
+        for body in sent:
+            self.publisher.publish(body)
+        self.consumer.qos(10)
+        batches = []
+        for batch in self.consumer.batch_iterator(size=10, max_wait=0.5, limit=25):
+            # Acknowledge as we go, otherwise the prefetch window never reopens
+            self.consumer.acknowledge_batch(batch)
+            batches.append(batch)
+        self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+        self.assertEqual(sent, [message.body for batch in batches for message in batch])
+    
+    def test_publish_many(self):
+        for transactional in (False, True):
+            sent = [unicode(uuid.uuid4()) for i in range(50)]
+            self.assertEqual(50, self.publisher.publish_many(sent, transactional=transactional, batch_size=20))
+            self.assertEqual(sent, [message.body for message in self.consumer])
+    
+    def test_idle_timeout_shared_connection(self):
+        # Deliveries for another channel on the same connection mustn't hold up the timeout
+        other = Consumer(exchange='_hare_test', queue='_hare_test_other', routing_key='other',
+                         connection=self.consumer.connection, channel=self.consumer.connection.new_channel())
+        self.publisher.publish('first', routing_key='other')
+        others = other.message_iterator(idle_timeout=1)
+        self.assertEqual('first', others.next().body) # (so that the other queue is being consumed)
+        messages = self.consumer.message_iterator(idle_timeout=0.2)
+        # (published from another thread, which has a connection of its own, so that the
+        # delivery arrives whilst this one is waiting)
+        def publish():
+            publisher = Publisher(exchange='_hare_test', routing_key='other')
+            publisher.publish('second')
+            publisher.close()
+        timer = threading.Timer(0.05, publish)
+        timer.start()
+        started = time.time()
+        self.assert_(messages.next() is None)
+        self.assert_(time.time() - started < 1)
+        messages.close()
+        timer.join()
+        # The other channel still gets its delivery
+        self.assertEqual('second', others.next().body)
+        others.close()
+        other.destroy_queue()
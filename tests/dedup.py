@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer_process import ConsumerProcess
+from ..dedup import DjangoCache, MemoryCache, SQLiteCache, new_message_id
+from ..publisher import JSONPublisher
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_dedup_queue'
+    consumer_args = {'exchange': '_hare_test_dedup', 'routing_key': 'test'}
+    
+    def __init__(self, dedup_cache):
+        self.dedup_cache = dedup_cache
+        self.processed = []
+        super(Worker, self).__init__()
+    
+    def process_message(self, message):
+        self.processed.append(message.body['id'])
+
+class ManualWorker(Worker):
+    auto_ack = False
+    
+    def process_message(self, message):
+        super(ManualWorker, self).process_message(message)
+        self.consumer.acknowledge(message)
+
+class Dedup(TestCase):
+    """Tests the dedup caches, and skipping messages which have already been processed."""
+    def test_memory(self):
+        cache = MemoryCache(max_size=2, ttl=0.1)
+        cache.add('a')
+        cache.add('b')
+        self.assert_('a' in cache) # ...making b the least recently used
+        cache.add('c')
+        self.assert_('b' not in cache)
+        self.assert_('a' in cache and 'c' in cache)
+        time.sleep(0.15)
+        self.assert_('a' not in cache)
+    
+    def test_backends(self):
+        path = os.path.join(tempfile.mkdtemp(), 'dedup.db')
+        SQLiteCache(path).add('a')
+        # Another process (or worker) sharing the file knows about it, whatever it has in memory
+        cache = MemoryCache(backend=SQLiteCache(path))
+        self.assert_('a' in cache)
+        self.assert_('b' not in cache)
+        cache.add('b')
+        self.assert_('b' in SQLiteCache(path))
+        expired = SQLiteCache(path, ttl=-1)
+        expired.add('c')
+        self.assert_('c' not in expired)
+        os.unlink(path)
+        cache = DjangoCache()
+        self.assert_(u'caf\xe9' not in cache)
+        cache.add(u'caf\xe9')
+        self.assert_(u'caf\xe9' in cache)
+    
+    def test_message_ids(self):
+        ids = set(new_message_id() for i in range(1000))
+        self.assertEqual(1000, len(ids))
+    
+    def test_skip_duplicates(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_dedup', routing_key='test', stamp_message_ids=True)
+        worker = Worker(MemoryCache())
+        publisher.publish({'id': 1})
+        publisher.publish({'id': 2})
+        publisher.publish({'id': 1}, message_id='redelivered')
+        publisher.publish({'id': 1}, message_id='redelivered')
+        worker.run(limit=4)
+        self.assertEqual([1, 2, 1], worker.processed)
+        self.assertRaises(IndexError, worker.consumer.pop) # the duplicate was acknowledged, too
+    
+    def test_skip_duplicates_without_auto_ack(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_dedup', routing_key='test')
+        worker = ManualWorker(MemoryCache())
+        publisher.publish({'id': 1}, message_id='once')
+        publisher.publish({'id': 1}, message_id='once')
+        worker.run(limit=2)
+        self.assertEqual([1], worker.processed)
+        # The duplicate was acknowledged anyway, so isn't requeued when the channel closes
+        worker.consumer.close()
+        self.assertRaises(IndexError, Worker(MemoryCache()).consumer.pop)
@@ -0,0 +1,130 @@
+import errno
+import fcntl
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer import JSONConsumer
+from ..consumer_process import ConsumerProcess, HandlerError
+from ..publisher import JSONPublisher
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_executor_queue'
+    consumer_args = {'exchange': '_hare_test_executor', 'routing_key': 'test'}
+    error_reporter = NullReporter()
+    # Where handlers (which may run in child processes) record what they've processed
+    path = None
+    
+    def process_message(self, message):
+        if message.body.get('fail'):
+            raise ValueError('failed %r' % message.body)
+        if message.body.get('unimplemented'):
+            raise NotImplementedError
+        if message.body.get('sleep'):
+            time.sleep(message.body['sleep'])
+        if message.body.get('forward'):
+            # Publishing over the default connection, as handlers usually do
+            publisher = JSONPublisher(exchange='_hare_test_executor', routing_key='forwarded')
+            publisher.publish({'id': message.body['id']})
+            publisher.close()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, '%d\n' % message.body['id'])
+        finally:
+            os.close(fd)
+
+def _processed():
+    with open(Worker.path) as f:
+        return sorted(int(line) for line in f)
+
+class Executors(TestCase):
+    """Tests running handlers on thread and process pools."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        fd, Worker.path = tempfile.mkstemp()
+        os.close(fd)
+        self.publisher = JSONPublisher(exchange='_hare_test_executor', routing_key='test')
+        self.worker = Worker()
+    
+    def tearDown(self):
+        os.unlink(Worker.path)
+        self.worker.consumer.destroy_queue()
+    
+    def _test_process(self, executor):
+        self.publisher.publish_many([{'id': i} for i in range(20)])
+        self.worker.run(limit=20, executor=executor, concurrency=4)
+        self.assertEqual(range(20), _processed())
+        self.assertRaises(IndexError, self.worker.consumer.pop) # all acknowledged
+    
+    def _test_errors(self, executor, error):
+        self.publisher.publish({'id': 1, 'fail': True})
+        self.assertRaises(error, self.worker.run, fault_tolerant=False, limit=1,
+                          executor=executor, concurrency=2)
+        # (left unacknowledged, to be redelivered)
+        self.worker.consumer.close()
+        self.worker = Worker()
+        self.publisher.publish({'id': 2, 'unimplemented': True})
+        self.assertRaises(NotImplementedError, self.worker.run, limit=2, executor=executor, concurrency=2)
+    
+    def _test_poison(self, executor):
+        # Failed messages are left unacknowledged, but mustn't use up the prefetch window
+        self.publisher.publish_many([{'id': i, 'fail': i in (0, 1)} for i in range(6)])
+        self.worker.run(limit=6, executor=executor, concurrency=2)
+        self.assertEqual(range(2, 6), _processed())
+    
+    def test_thread(self):
+        self._test_process('thread')
+    
+    def test_thread_publishing(self):
+        self._test_publishing('thread')
+    
+    def _test_publishing(self, executor):
+        forwarded = JSONConsumer(exchange='_hare_test_executor', queue='_hare_test_executor_forwarded',
+                                 routing_key='forwarded')
+        self.publisher.publish_many([{'id': i, 'forward': True} for i in range(40)])
+        self.worker.run(limit=40, executor=executor, concurrency=4)
+        self.assertEqual(range(40), _processed())
+        self.assertEqual(range(40), sorted(message.body['id'] for message in forwarded))
+        forwarded.destroy_queue()
+    
+    def test_process(self):
+        self._test_process('process')
+    
+    def test_process_publishing(self):
+        self._test_publishing('process')
+    
+    def test_thread_poison(self):
+        self._test_poison('thread')
+    
+    def test_process_poison(self):
+        self._test_poison('process')
+    
+    def test_thread_errors(self):
+        self._test_errors('thread', ValueError)
+    
+    def test_thread_shutdown(self):
+        self.publisher.publish_many([{'id': 1, 'sleep': 0.2}, {'id': 2, 'fail': True}])
+        self.assertRaises(ValueError, self.worker.run, fault_tolerant=False, limit=2,
+                          executor='thread', concurrency=2)
+        # The slow handler finishes after the pool's pipe has been closed, and mustn't write
+        # to whatever has its file descriptors by then
+        read_fd, write_fd = os.pipe()
+        try:
+            fcntl.fcntl(read_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+            time.sleep(0.4)
+            try:
+                os.read(read_fd, 1)
+            except OSError, e:
+                self.assertEqual(errno.EAGAIN, e.errno)
+            else:
+                self.fail('something was written to the pipe')
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+    
+    def test_process_errors(self):
+        self._test_errors('process', HandlerError)
@@ -0,0 +1,10 @@
+"""Things shared by the tests."""
+
+class NullReporter(object):
+    """An error reporter (see the reporting module) which drops every report, for
+       ConsumerProcesses whose handlers fail on purpose."""
+    def report(self, message, tb, fault_tolerant):
+        pass
+    
+    def flush(self, timeout=None):
+        pass
@@ -1,3 +1,5 @@
+import threading
+
 from django.conf import settings
 from django.test.testcases import TestCase
 
@@ -21,3 +23,14 @@ class MQIdentityMap(TestCase):
         connection4 = AMQPConnection(host='127.0.0.1:5672')
         self.assertEqual(id(connection3.connection), id(connection4.connection))
         self.assertNotEqual(id(connection1.connection), id(connection3.connection))
+    
+    def test_threads(self):
+        # Threads never share a connection (they'd all be reading the same socket)
+        connection1 = AMQPConnection()
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(AMQPConnection()))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(id(connection1.connection), id(connections[0].connection))
+        connection1.close()
+        connections[0].close()
@@ -0,0 +1,50 @@
+import logging
+
+from django.test.testcases import TestCase
+
+from ..utils.log import QueueHandler
+
+class _Target(logging.Handler):
+    """Keeps the records it's handed, and what it made of them."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.output = []
+    
+    def emit(self, record):
+        self.records.append(record)
+        self.output.append(self.format(record))
+
+class Log(TestCase):
+    """Tests shipping log records from a background thread."""
+    def test_queue_handler(self):
+        parent = logging.getLogger('_hare_test_log')
+        parent.propagate = False
+        logger = logging.getLogger('_hare_test_log.child')
+        target, upstream = _Target(), _Target()
+        handler = QueueHandler(target)
+        logger.addHandler(handler)
+        parent.addHandler(upstream)
+        try:
+            details = {'id': 1}
+            try:
+                raise ValueError('bad')
+            except ValueError:
+                logger.error('failed %r', details, exc_info=True)
+            details['id'] = 2 # (after the record was queued)
+            handler.close()
+        finally:
+            logger.removeHandler(handler)
+            parent.removeHandler(upstream)
+        # The queued record was formatted when it was logged, traceback and all
+        [record] = target.records
+        self.assertEqual(None, record.args)
+        self.assertEqual(None, record.exc_info)
+        self.assert_(record.msg.startswith("failed {'id': 1}\nTraceback"))
+        self.assert_(record.msg.endswith('ValueError: bad'))
+        self.assertEqual([record.msg], target.output)
+        # ...but handlers further up the chain got the original, traceback included
+        [record] = upstream.records
+        self.assertEqual(ValueError, record.exc_info[0])
+        self.assertEqual('failed %r', record.msg)
+        self.assert_(upstream.output[0].endswith('ValueError: bad'))
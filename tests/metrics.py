@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from .. import metrics
+from ..consumer import JSONConsumer
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_metrics_queue'
+    consumer_args = {'exchange': '_hare_test_metrics', 'routing_key': 'test'}
+    error_reporter = NullReporter()
+    
+    def process_message(self, message):
+        if message.body['id'] == 0:
+            raise ValueError('failed')
+
+class Metrics(TestCase):
+    """Tests the in-process metric aggregates, and that publishing and consuming record them."""
+    def test_registry(self):
+        registry = metrics.Registry()
+        registry.incr('published', 'exchange')
+        registry.incr('published', 'exchange', 9)
+        for i in range(100):
+            registry.observe('handler_time', 'queue', 0.001)
+        registry.observe('handler_time', 'queue', 1.0)
+        snapshot = registry.snapshot(reset=True)
+        self.assertEqual(10, snapshot['counters'][('published', 'exchange')])
+        summary = snapshot['histograms'][('handler_time', 'queue')]
+        self.assertEqual(101, summary['count'])
+        self.assertEqual(1.0, summary['max'])
+        # Percentiles are bucket upper bounds, so within a factor of two
+        self.assert_(0.001 <= summary['p50'] <= 0.002)
+        self.assertEqual({'counters': {}, 'histograms': {}}, registry.snapshot())
+    
+    def test_disabled(self):
+        metrics.disable()
+        self.failIf(metrics.enabled)
+        metrics.enable()
+        self.assert_(metrics.enabled)
+        metrics.disable()
+    
+    def test_call_sites(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_metrics', routing_key='test')
+        consumer = JSONConsumer(queue='_hare_test_metrics_queue', exchange='_hare_test_metrics', routing_key='test')
+        metrics.enable()
+        try:
+            metrics.registry.snapshot(reset=True)
+            publisher.publish({'id': 1})
+            publisher.publish_many([{'id': i} for i in range(2, 6)])
+            consumer.acknowledge(consumer.pop())
+            messages = []
+            for message in consumer.message_iterator(limit=4):
+                messages.append(message)
+            # A multi-ack counts every message it acknowledges, not just the one passed
+            consumer.acknowledge(messages[2], multiple=True)
+            consumer.acknowledge_batch(messages[3:])
+            publisher.publish({'id': 0})
+            Worker().run(limit=1)
+            counters = metrics.registry.snapshot(reset=True)['counters']
+        finally:
+            metrics.disable()
+        self.assertEqual(6, counters[('published', '_hare_test_metrics')])
+        self.assertEqual(6, counters[('delivered', '_hare_test_metrics_queue')])
+        self.assertEqual(5, counters[('acked', '_hare_test_metrics_queue')])
+        self.assertEqual(1, counters[('failed', '_hare_test_metrics_queue')])
+        consumer.destroy_queue()
@@ -0,0 +1,78 @@
+import collections
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer import Consumer, MultiConsumer, _wait
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+
+class Worker(ConsumerProcess):
+    queues = {
+        '_hare_test_multi_orders': {'exchange': '_hare_test_multi', 'routing_key': 'orders',
+                                    'handler': 'process_order', 'weight': 2},
+        '_hare_test_multi_refunds': {'exchange': '_hare_test_multi', 'routing_key': 'refunds',
+                                     'prefetch_count': 2},
+    }
+    
+    def __init__(self):
+        self.seen = []
+        super(Worker, self).__init__()
+    
+    def process_order(self, message):
+        self.seen.append(('order', message.body['id']))
+    
+    def process_message(self, message):
+        self.seen.append(('refund', message.body['id']))
+
+class Multiplexing(TestCase):
+    """Tests consuming from several queues over one channel."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        self.publisher = JSONPublisher(exchange='_hare_test_multi')
+    
+    def test_weights(self):
+        multi = MultiConsumer()
+        heavy = multi.add('_hare_test_multi_heavy', exchange='_hare_test_multi', routing_key='heavy', weight=3)
+        light = multi.add('_hare_test_multi_light', exchange='_hare_test_multi', routing_key='light')
+        queues = dict((queue.name, queue) for queue in multi._queues)
+        for queue in queues.values():
+            queue.buffer = collections.deque(range(100))
+        picks = [multi._next().name for i in range(40)]
+        self.assertEqual(30, picks.count(heavy.queue))
+        self.assertEqual(10, picks.count(light.queue))
+        # Turns are interleaved, rather than taken in runs
+        self.assertEqual([heavy.queue, heavy.queue, light.queue, heavy.queue], picks[:4])
+        # A queue with nothing waiting is skipped
+        queues[heavy.queue].buffer.clear()
+        self.assertEqual([light.queue] * 3, [multi._next().name for i in range(3)])
+        multi.close()
+    
+    def test_prefetch(self):
+        multi = MultiConsumer()
+        multi.add('_hare_test_multi_one', exchange='_hare_test_multi', routing_key='one', prefetch_count=1)
+        multi.add('_hare_test_multi_five', exchange='_hare_test_multi', routing_key='five', prefetch_count=5)
+        self.publisher.publish_many([{'id': i} for i in range(10)], routing_key='one')
+        self.publisher.publish_many([{'id': i} for i in range(10)], routing_key='five')
+        multi._start_consuming(no_ack=False)
+        try:
+            while _wait(multi.channel, 0.2):
+                pass
+            self.assertEqual([('_hare_test_multi_five', 5), ('_hare_test_multi_one', 1)],
+                             sorted((queue.name, len(queue.buffer)) for queue in multi._queues))
+        finally:
+            multi._stop_consuming(no_ack=False)
+        for queue in ('_hare_test_multi_one', '_hare_test_multi_five'):
+            Consumer(queue=queue, force_no_declare=True, connection=multi.connection).destroy_queue()
+        multi.close()
+    
+    def test_process(self):
+        worker = Worker()
+        self.publisher.publish_many([{'id': i} for i in range(3)], routing_key='orders')
+        self.publisher.publish_many([{'id': i} for i in range(3)], routing_key='refunds')
+        worker.run(limit=6)
+        self.assertEqual([('order', i) for i in range(3)], [seen for seen in worker.seen if seen[0] == 'order'])
+        self.assertEqual([('refund', i) for i in range(3)], [seen for seen in worker.seen if seen[0] == 'refund'])
+        for consumer in worker.consumer.consumers.values():
+            self.assertRaises(IndexError, consumer.pop) # all acknowledged
+        worker.consumer.close()
@@ -0,0 +1,128 @@
+import socket
+import time
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.test.testcases import TestCase
+
+from ..consumer import Consumer
+from ..middleware import OutboxMiddleware
+from ..publisher import Publisher
+from ..utils.db import transaction
+
+class _FlakyPublisher(Publisher):
+    """A Publisher which can't reach the broker (in the foreground)."""
+    def publish_many(self, bodies, transactional=False, **kwargs):
+        if transactional:
+            raise socket.error('broker unreachable')
+        return super(_FlakyPublisher, self).publish_many(bodies, **kwargs)
+
+class Outbox(TestCase):
+    """Tests that messages published in transactions and requests wait for them to finish."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        self.publisher = Publisher(exchange='_hare_test_outbox', routing_key='test')
+        self.consumer = Consumer(exchange='_hare_test_outbox', queue='_hare_test_outbox_queue', routing_key='test')
+    
+    def tearDown(self):
+        self.consumer.destroy_queue()
+        self.publisher.destroy_exchange()
+    
+    def received(self):
+        return [message.body for message in self.consumer]
+    
+    def test_commit(self):
+        with transaction():
+            self.publisher.publish('a')
+            self.publisher.publish_many(['b', 'c'])
+            Publisher(exchange='_hare_test_outbox', routing_key='test', publish_on_commit=False).publish('now')
+            self.assertEqual(['now'], self.received())
+        self.assertEqual(['a', 'b', 'c'], self.received())
+    
+    def test_rollback(self):
+        try:
+            with transaction():
+                self.publisher.publish('a')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([], self.received())
+    
+    def test_nested(self):
+        with transaction():
+            self.publisher.publish('a')
+            with transaction():
+                self.publisher.publish('b')
+            # The inner block committed the outer one's changes too
+            self.assertEqual(['a', 'b'], self.received())
+            self.publisher.publish('c')
+            try:
+                with transaction():
+                    self.publisher.publish('d')
+                    raise ValueError
+            except ValueError:
+                pass
+            # ...and rolling back the inner block rolled them back
+            self.publisher.publish('e')
+            self.assertEqual([], self.received())
+        self.assertEqual(['e'], self.received())
+    
+    def test_nested_rollback(self):
+        # Once the inner block has committed, the outer one failing can't undo it
+        try:
+            with transaction():
+                with transaction():
+                    self.publisher.publish('a')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(['a'], self.received())
+        # Nor can the request it's part of
+        middleware = OutboxMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        with transaction():
+            self.publisher.publish('b')
+        self.publisher.publish('c')
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, HttpResponse(status=500))
+        self.assertEqual(['b'], self.received())
+    
+    def test_middleware(self):
+        middleware = OutboxMiddleware()
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.publisher.publish('a')
+        self.assertEqual([], self.received())
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(['a'], self.received())
+        
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.publisher.publish('b')
+        middleware.process_exception(request, ValueError())
+        middleware.process_response(request, HttpResponse(status=500))
+        self.assertEqual([], self.received())
+    
+    def test_failed_flush(self):
+        # The transaction has committed, so a failure to publish doesn't come out of it...
+        with transaction():
+            _FlakyPublisher(exchange='_hare_test_outbox', routing_key='test').publish('a')
+        # ...and the message goes out from the background instead
+        deadline = time.time() + 5
+        received = []
+        while not received and time.time() < deadline:
+            time.sleep(0.05)
+            received = self.received()
+        self.assertEqual(['a'], received)
+    
+    def test_leaked_outbox(self):
+        middleware = OutboxMiddleware()
+        middleware.process_request(HttpRequest())
+        self.publisher.publish('a')
+        # (process_response never ran for that request)
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.publisher.publish('b')
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(['b'], self.received())
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..connection import AMQPConnection
+from ..pool import ConnectionPool, PoolTimeout
+
+class MQPool(TestCase):
+    """Tests that pooled `AMQPConnection`s borrow connections exclusively from a bounded pool."""
+    def setUp(self):
+        self.assert_(getattr(settings, 'ENABLE_MQ', False), 'settings.ENABLE_MQ must be True to run message queue tests')
+    
+    def test_checkout(self):
+        connection1 = AMQPConnection(pooled=True)
+        connection2 = AMQPConnection(pooled=True)
+        self.assert_(connection1.pool is connection2.pool)
+        self.assertNotEqual(id(connection1.connection), id(connection2.connection))
+        # A checked in connection (and its channel) is reused by the next borrower
+        channel = connection1.channel
+        connection1.close()
+        connection3 = AMQPConnection(pooled=True)
+        self.assertEqual(id(connection1.connection), id(connection3.connection))
+        self.assertEqual(id(channel), id(connection3.channel))
+        connection2.close()
+        connection3.close()
+    
+    def test_exhaustion(self):
+        connection = AMQPConnection(pooled=True)
+        connection.close()
+        pool = ConnectionPool(connection.connection_signature, max_size=1, timeout=0.1)
+        connection = pool.checkout()
+        self.assertRaises(PoolTimeout, pool.checkout)
+        pool.checkin(connection)
+        self.assertEqual(id(connection), id(pool.checkout()))
+        stats = pool.stats()
+        self.assertEqual(3, stats['checkouts'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['waits'])
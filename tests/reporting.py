@@ -0,0 +1,73 @@
+import time
+import traceback
+
+from django.core import mail
+from django.test.testcases import TestCase
+from django.test.utils import override_settings
+
+from .. import reporting
+
+def _fail(value):
+    raise ValueError(value)
+
+def _traceback(value):
+    try:
+        _fail(value)
+    except ValueError:
+        return traceback.format_exc()
+
+class _ListSink(object):
+    def __init__(self):
+        self.digests = []
+    
+    def send(self, digest):
+        self.digests.append(digest)
+
+class Reporting(TestCase):
+    """Tests error aggregation and rate limiting (no broker needed)."""
+    def test_fingerprint(self):
+        # The same failure with different data is the same error
+        self.assertEqual(reporting.fingerprint(_traceback(1)), reporting.fingerprint(_traceback(2)))
+        try:
+            _fail(1)
+        except ValueError:
+            other = traceback.format_exc()
+        self.assertNotEqual(reporting.fingerprint(_traceback(1)), reporting.fingerprint(other))
+    
+    def test_aggregation(self):
+        sink = _ListSink()
+        reporter = reporting.ErrorReporter(sink, window=60, interval=60)
+        for i in range(5):
+            reporter.report('message %d' % i, _traceback(i), True)
+        reporter.report('other', _traceback(None).replace('ValueError', 'KeyError'), True)
+        time.sleep(0.1)
+        self.assertEqual([], sink.digests) # still within the window
+        reporter.flush(5)
+        self.assertEqual([1, 5], sorted(digest.count for digest in sink.digests))
+        self.assert_('message 0' in [digest.message for digest in sink.digests])
+        reporter.close()
+    
+    def test_rate_limit(self):
+        sink = _ListSink()
+        reporter = reporting.ErrorReporter(sink, window=0, interval=60)
+        reporter.report('first', _traceback(1), True)
+        for i in range(50):
+            if sink.digests:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(sink.digests))
+        reporter.report('second', _traceback(2), True)
+        reporter.report('third', _traceback(3), True)
+        time.sleep(0.1)
+        self.assertEqual(1, len(sink.digests))
+        reporter.close()
+        self.assertEqual(2, sink.digests[1].count)
+        self.assertEqual('second', sink.digests[1].message)
+    
+    @override_settings(ADMINS=(('Admin', 'admin@example.com'),))
+    def test_mail_admins(self):
+        reporter = reporting.ErrorReporter(window=0, interval=0)
+        reporter.report({'id': 1}, _traceback(1), False)
+        reporter.close()
+        self.assertEqual(1, len(mail.outbox))
+        self.assert_('IS NOT' in mail.outbox[0].body)
@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer import JSONConsumer
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from .. import retry
+from .helpers import NullReporter
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_retry_queue'
+    consumer_args = {'exchange': '_hare_test_retry', 'routing_key': 'test'}
+    max_attempts = 3
+    retry_delay = 0.05
+    error_reporter = NullReporter()
+    
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = []
+        super(Worker, self).__init__()
+    
+    def process_message(self, message):
+        self.attempts.append(message.body)
+        if len(self.attempts) <= self.failures:
+            raise ValueError('failed %r' % message.body)
+
+class Retry(TestCase):
+    """Tests retrying failed messages through the delay queues, and dead-lettering them."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        self.publisher = JSONPublisher(exchange='_hare_test_retry', routing_key='test')
+    
+    def test_delays(self):
+        policy = retry.RetryPolicy(Worker(0).consumer, 10, delay=1, backoff=2, max_delay=5)
+        self.assertEqual([1, 2, 4, 5], [policy.delay_for(attempts) for attempts in range(1, 5)])
+    
+    def test_retry_policy(self):
+        worker = Worker(0)
+        self.assert_(worker.retry_policy is worker.retry_policies['_hare_test_retry_queue'])
+        worker.retry_policy = None
+        self.assertEqual({}, worker.retry_policies)
+    
+    def test_retry(self):
+        worker = Worker(failures=2)
+        self.publisher.publish({'id': 1})
+        worker.run(limit=3, executor='thread', concurrency=2)
+        self.assertEqual([{'id': 1}] * 3, worker.attempts)
+        self.assertRaises(IndexError, worker.consumer.pop) # acknowledged
+    
+    def test_dead_letter(self):
+        worker = Worker(failures=3)
+        self.publisher.publish({'id': 2})
+        worker.run(limit=3)
+        dead = JSONConsumer(queue='_hare_test_retry_queue.dead', force_no_declare=True)
+        message = dead.pop()
+        dead.acknowledge(message)
+        self.assertEqual({'id': 2}, message.body)
+        headers = message.properties['application_headers']
+        self.assertEqual(3, headers[retry.ATTEMPTS_HEADER])
+        self.assertEqual('test', headers[retry.ROUTING_KEY_HEADER])
+        self.assert_(headers[retry.ERROR_HEADER].startswith('ValueError'))
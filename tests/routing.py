@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from ..routing import RoutingTable
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_routing_queue'
+    consumer_args = {'exchange': '_hare_test_routing'}
+    routes = [
+        ('order.created', 'created'),
+        ('order.*.cancelled', 'cancelled'),
+        ('order.#', 'audit'),
+    ]
+    
+    def __init__(self):
+        self.calls = []
+        super(Worker, self).__init__()
+    
+    def created(self, message):
+        self.calls.append(('created', message.body['id']))
+    
+    def cancelled(self, message):
+        self.calls.append(('cancelled', message.body['id']))
+    
+    def audit(self, message):
+        self.calls.append(('audit', message.body['id']))
+
+class Routing(TestCase):
+    """Tests matching routing keys against topic patterns, and dispatching on them."""
+    def test_match(self):
+        table = RoutingTable([
+            ('a.b', 1),
+            ('a.*', 2),
+            ('a.#', 3),
+            ('#.c', 4),
+            ('*.b.#', 5),
+            ('a.b', 6),
+        ])
+        self.assertEqual((1, 2, 3, 5, 6), table.match('a.b'))
+        self.assertEqual((3,), table.match('a')) # '#' matches no words, too
+        self.assertEqual((3, 4, 5), table.match('a.b.c'))
+        self.assertEqual((4,), table.match('c'))
+        self.assertEqual((), table.match('b'))
+        self.assertEqual((3, 4, 5), table.match('a.b.c')) # (cached)
+        table.add('b', 7)
+        self.assertEqual((7,), table.match('b'))
+    
+    def test_bindings(self):
+        self.assertEqual(['order.*.cancelled', 'order.#'], Worker.routing_table().bindings())
+        self.assertEqual(['a.b', 'c'], RoutingTable([('a.b', 1), ('c', 2), ('a.b', 3)]).bindings())
+    
+    def test_dispatch(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        publisher = JSONPublisher(exchange='_hare_test_routing', exchange_type='topic')
+        worker = Worker()
+        publisher.publish({'id': 1}, routing_key='order.created')
+        publisher.publish({'id': 2}, routing_key='order.7.cancelled')
+        publisher.publish({'id': 3}, routing_key='order.shipped')
+        publisher.publish({'id': 4}, routing_key='invoice.created') # not bound
+        worker.run(limit=3)
+        self.assertEqual([('created', 1), ('audit', 1), ('cancelled', 2), ('audit', 2), ('audit', 3)],
+                         worker.calls)
+        self.assertRaises(IndexError, worker.consumer.pop)
@@ -0,0 +1,37 @@
+from amqplib import client_0_8 as amqp
+
+from django.test.testcases import TestCase
+
+from .. import serialization
+from ..consumer import Consumer, JSONConsumer
+
+class Serialization(TestCase):
+    """Tests the codec registry, and that consumers pick codecs from message properties."""
+    def consumer(self, cls=Consumer, **kwargs):
+        # No broker needed; the consumer is only used for decoding
+        return cls(queue='_hare_test_codecs', connection=object(), channel=object(), force_no_declare=True, **kwargs)
+    
+    def test_round_trip(self):
+        body = {'id': 1, 'tags': [u'a', u'b']}
+        for name in ('json', 'pickle', 'msgpack'):
+            codec = serialization.get_codec(name)
+            if codec is None:
+                continue # optional dependency isn't installed
+            self.assertEqual(body, codec.decode(codec.encode(body)))
+            self.assert_(serialization.get_codec(codec.content_type) is codec)
+    
+    def test_decode_by_content_type(self):
+        data = serialization.compress('deflate', serialization.get_codec('json').encode([1, 2, 3]))
+        message = amqp.Message(data, content_type='application/json', content_encoding='deflate')
+        self.assertEqual([1, 2, 3], self.consumer().decode(message).body)
+    
+    def test_fallback_codec(self):
+        # Messages from publishers which don't set content_type are decoded with the default
+        self.assertEqual({'a': 1}, self.consumer(JSONConsumer).decode(amqp.Message('{"a": 1}')).body)
+        self.assertEqual('{"a": 1}', self.consumer().decode(amqp.Message('{"a": 1}')).body)
+    
+    def test_untrusted_pickle(self):
+        codec = serialization.get_codec('pickle')
+        message = amqp.Message(codec.encode(1), content_type=codec.content_type)
+        self.assertRaises(serialization.DecodeError, self.consumer().decode, message)
+        self.assertEqual(1, self.consumer(trusted=True).decode(message).body)
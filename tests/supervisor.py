@@ -0,0 +1,91 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.test.testcases import TestCase
+
+from ..consumer_process import ConsumerProcess
+from ..publisher import JSONPublisher
+from ..supervisor import Supervisor
+
+class Worker(ConsumerProcess):
+    queue = '_hare_test_supervisor_queue'
+    consumer_args = {'exchange': '_hare_test_supervisor', 'routing_key': 'test', 'prefetch_count': 1}
+    # Where the workers (which are separate processes) record what they've processed
+    path = None
+    
+    def process_message(self, message):
+        time.sleep(0.01)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, '%d %d\n' % (os.getpid(), message.body['id']))
+        finally:
+            os.close(fd)
+
+class Broken(Worker):
+    def __init__(self):
+        raise ValueError('cannot start')
+
+def _processed():
+    with open(Worker.path) as f:
+        return [line.split() for line in f]
+
+class SupervisorTest(TestCase):
+    """Tests scaling to the queue depth, and draining a queue with forked workers."""
+    def setUp(self):
+        self.assert_(settings.ENABLE_MQ, 'settings.ENABLE_MQ must be True to run message queue tests')
+        fd, Worker.path = tempfile.mkstemp()
+        os.close(fd)
+    
+    def tearDown(self):
+        os.unlink(Worker.path)
+    
+    def test_target(self):
+        supervisor = Supervisor(Worker, min_workers=1, max_workers=4, backlog_per_worker=10)
+        self.assertEqual(1, supervisor.target(0, 0))
+        self.assertEqual(3, supervisor.target(25, 0))
+        self.assertEqual(4, supervisor.target(1000, 0))
+        # Consumers other than the supervisor's workers take their share
+        supervisor.workers = [1, 2]
+        self.assertEqual(2, supervisor.target(25, 3))
+        self.assertEqual(1, supervisor.target(25, 5))
+    
+    def test_drain(self):
+        publisher = JSONPublisher(exchange='_hare_test_supervisor', routing_key='test')
+        Worker() # declares the queue
+        publisher.publish_many([{'id': i} for i in range(60)])
+        supervisor = Supervisor(Worker, min_workers=1, max_workers=3, backlog_per_worker=10, interval=0.1)
+        supervisor.poll_interval = 0.05
+        spawned = []
+        spawn = supervisor.spawn
+        supervisor.spawn = lambda: spawned.append(spawn())
+        def stop_when_drained():
+            deadline = time.time() + 20
+            while len(_processed()) < 60 and time.time() < deadline:
+                time.sleep(0.05)
+            supervisor.stop()
+        watcher = threading.Thread(target=stop_when_drained)
+        watcher.start()
+        supervisor.run()
+        watcher.join()
+        processed = _processed()
+        self.assertEqual(range(60), sorted(int(id) for pid, id in processed))
+        self.assert_(1 <= len(spawned) <= 3)
+        self.assertEqual([], supervisor.workers)
+    
+    def test_restart_backoff(self):
+        supervisor = Supervisor(Broken, min_workers=1, max_workers=1, interval=60)
+        supervisor.poll_interval = 0.01
+        supervisor.restart_delay = 0.1
+        spawned = []
+        spawn = supervisor.spawn
+        supervisor.spawn = lambda: spawned.append(spawn())
+        stopper = threading.Timer(1, supervisor.stop)
+        stopper.start()
+        supervisor.run()
+        stopper.join()
+        # Restarted after 0.1, 0.2 and 0.4 seconds (give or take), rather than every poll
+        self.assert_(2 <= len(spawned) <= 5, spawned)
+        self.assert_(supervisor._next_delay >= 0.8)
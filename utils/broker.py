@@ -0,0 +1,766 @@
+"""A small in-process AMQP 0-8 broker, for running Hare's tests and benchmarks without RabbitMQ.
+   
+   It speaks just enough of the protocol for amqplib's client: the connection and channel
+   lifecycle, access requests, direct, fanout and topic exchanges, queues and bindings,
+   basic.qos/consume/cancel/publish/get/ack/reject/recover and tx, plus message TTLs
+   (per-message expiration and x-message-ttl) and dead-lettering (x-dead-letter-exchange and
+   x-dead-letter-routing-key) of expired and rejected messages. Everything is kept in
+   memory. To point Hare at one, start it from your (test) settings module:
+       
+       from hare.utils.broker import FakeBroker
+       ENABLE_MQ = True
+       AMQP_HOST = FakeBroker().start().address
+   
+   This module deliberately doesn't depend on Django, so that it can be imported from a
+   settings module."""
+from __future__ import with_statement
+
+import collections
+import itertools
+import Queue
+import socket
+import SocketServer
+import struct
+import threading
+from amqplib.client_0_8.basic_message import Message
+from amqplib.client_0_8.serialization import AMQPReader, AMQPWriter
+
+FRAME_METHOD, FRAME_HEADER, FRAME_BODY, FRAME_HEARTBEAT = 1, 2, 3, 8
+FRAME_END = '\xce'
+FRAME_MAX = 131072
+
+# The flag bit of the expiration property, in the first property flags short
+EXPIRATION_FLAG = 1 << 8
+
+# Reply codes
+NOT_FOUND = 404
+PRECONDITION_FAILED = 406
+NO_ROUTE = 312
+
+class ChannelError(Exception):
+    """Raised by method handlers to close the channel with a reply code."""
+    def __init__(self, code, text):
+        self.code = code
+        self.text = text
+        return super(ChannelError, self).__init__(code, text)
+
+class _Message(object):
+    """A message sitting in a queue. properties are the raw property flags and list from the
+       content header frame, which are passed through untouched."""
+    __slots__ = ('properties', 'body', 'exchange', 'routing_key', 'redelivered')
+    
+    def __init__(self, properties, body, exchange, routing_key, redelivered=False):
+        self.properties = properties
+        self.body = body
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.redelivered = redelivered
+
+class _Queue(object):
+    def __init__(self, name, exclusive_to=None, auto_delete=False, arguments=None):
+        self.name = name
+        self.exclusive_to = exclusive_to # the connection an exclusive queue belongs to
+        self.auto_delete = auto_delete
+        self.arguments = (arguments or {})
+        self.messages = collections.deque()
+        self.consumers = [] # rotated for round-robin delivery
+
+class _Consumer(object):
+    __slots__ = ('tag', 'queue', 'channel', 'no_ack', 'prefetch_count', 'unacked')
+    
+    def __init__(self, tag, queue, channel, no_ack, prefetch_count=0):
+        self.tag = tag
+        self.queue = queue
+        self.channel = channel
+        self.no_ack = no_ack
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+    
+    def has_capacity(self):
+        return self.no_ack or (self.channel.has_capacity() and
+                               (not self.prefetch_count or self.unacked < self.prefetch_count))
+
+class _Channel(object):
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.id = channel_id
+        self.delivery_tags = itertools.count(1)
+        self.unacked = collections.OrderedDict() # delivery tag -> (queue name, _Message)
+        self.consumers = {} # consumer tag -> _Consumer
+        self.deliveries = {} # delivery tag -> the _Consumer an unacknowledged message went to
+        # As with RabbitMQ, a global basic.qos limits the whole channel, and any other
+        # limits each consumer started on the channel afterwards
+        self.prefetch_count = 0
+        self.consumer_prefetch_count = 0
+        self.closing = False
+        self.transactional = False
+        self.tx_publishes = []
+        self.tx_acks = []
+    
+    def has_capacity(self):
+        return not self.prefetch_count or len(self.unacked) < self.prefetch_count
+
+def _expiration(properties):
+    """Returns a message's expiration (TTL) in milliseconds, or None if it hasn't got one."""
+    if not struct.unpack('>H', properties[:2])[0] & EXPIRATION_FLAG:
+        return None # don't bother parsing the properties
+    content = Message()
+    content._load_properties(properties)
+    return int(content.properties['expiration'])
+
+def _without_expiration(properties):
+    content = Message()
+    content._load_properties(properties)
+    content.properties.pop('expiration', None)
+    return content._serialize_properties()
+
+def _topic_match(pattern, words):
+    """Matches a list of routing key words against a list of binding pattern words, where
+       '*' matches exactly one word and '#' matches zero or more."""
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_topic_match(pattern[1:], words[i:]) for i in xrange(len(words) + 1))
+    if not words:
+        return False
+    return (pattern[0] == '*' or pattern[0] == words[0]) and _topic_match(pattern[1:], words[1:])
+
+class FakeBroker(object):
+    """The broker's state, and the TCP server that accepts client connections. All state is
+       guarded by a single lock; frames destined for clients are queued up and written by a
+       thread per connection, so no socket I/O ever happens with the lock held."""
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.RLock()
+        self.exchanges = {'': 'direct', 'amq.direct': 'direct', 'amq.fanout': 'fanout', 'amq.topic': 'topic'}
+        self.bindings = {} # exchange name -> list of (queue name, routing key) tuples
+        self.queues = {}
+        self.connections = set()
+        self._names = itertools.count(1)
+        self._server = _Server((host, port), _Connection)
+        self._server.broker = self
+        self._thread = None
+        return super(FakeBroker, self).__init__()
+    
+    @property
+    def address(self):
+        """The broker's address, as a 'host:port' string (suitable for AMQP_HOST)."""
+        return '%s:%d' % self._server.server_address
+    
+    def start(self):
+        """Starts accepting connections on a background thread, returning the broker."""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='hare-fake-broker')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        """Stops accepting connections and disconnects every client."""
+        self._server.shutdown()
+        self._server.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.disconnect()
+    
+    def generate_name(self, prefix):
+        return '%s-%d' % (prefix, self._names.next())
+    
+    # --- Routing and delivery (the lock must be held) --- #
+    
+    def get_queue(self, name):
+        if name not in self.queues:
+            raise ChannelError(NOT_FOUND, 'no queue %r' % name)
+        return self.queues[name]
+    
+    def route(self, exchange, routing_key):
+        """Returns the names of the queues a message published to the exchange with the
+           routing key should end up in."""
+        if exchange not in self.exchanges:
+            raise ChannelError(NOT_FOUND, 'no exchange %r' % exchange)
+        if exchange == '':
+            # The default exchange routes directly to the queue named by the routing key
+            return ([routing_key] if routing_key in self.queues else [])
+        exchange_type = self.exchanges[exchange]
+        names = []
+        for queue, key in self.bindings.get(exchange, ()):
+            if queue in names:
+                continue
+            if (exchange_type == 'fanout' or
+                (exchange_type == 'direct' and key == routing_key) or
+                (exchange_type == 'topic' and _topic_match(key.split('.'), routing_key.split('.')))):
+                names.append(queue)
+        return names
+    
+    def publish(self, message):
+        """Routes a message to its queues, returning the number of queues it was routed to."""
+        names = self.route(message.exchange, message.routing_key)
+        for name in names:
+            queue = self.queues[name]
+            queue.messages.append(message)
+            self.expire_later(queue, message)
+            self.dispatch(queue)
+        return len(names)
+    
+    def expire_later(self, queue, message):
+        """Arranges for a message with a TTL (its own, or the queue's) to expire if it is still
+           waiting in the queue by then."""
+        ttls = [ttl for ttl in (_expiration(message.properties), queue.arguments.get('x-message-ttl'))
+                if ttl is not None]
+        if not ttls:
+            return
+        timer = threading.Timer(min(ttls) / 1000.0, self.expire, (queue.name, message))
+        timer.daemon = True
+        timer.start()
+    
+    def expire(self, queue_name, message):
+        with self.lock:
+            queue = self.queues.get(queue_name)
+            if queue is None or message not in queue.messages:
+                return # already delivered, or gone
+            queue.messages.remove(message)
+            self.dead_letter(queue, message)
+    
+    def dead_letter(self, queue, message):
+        """Republishes an expired or rejected message to the queue's dead letter exchange (if
+           it has one), minus its expiration."""
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            return
+        routing_key = queue.arguments.get('x-dead-letter-routing-key', message.routing_key)
+        properties = message.properties
+        if _expiration(properties) is not None:
+            properties = _without_expiration(properties)
+        try:
+            self.publish(_Message(properties, message.body, exchange, routing_key))
+        except ChannelError:
+            pass # the exchange doesn't exist, so the message is dropped
+    
+    def dispatch(self, queue):
+        """Delivers waiting messages to the queue's consumers, round-robin, for as long as
+           any consumer has room in its prefetch window."""
+        while queue.messages:
+            for i, consumer in enumerate(queue.consumers):
+                if consumer.has_capacity():
+                    break
+            else:
+                return
+            queue.consumers.append(queue.consumers.pop(i))
+            message = queue.messages.popleft()
+            channel = consumer.channel
+            tag = channel.delivery_tags.next()
+            if not consumer.no_ack:
+                channel.unacked[tag] = (queue.name, message)
+                channel.deliveries[tag] = consumer
+                consumer.unacked += 1
+            args = AMQPWriter()
+            args.write_shortstr(consumer.tag)
+            args.write_longlong(tag)
+            args.write_bit(message.redelivered)
+            args.write_shortstr(message.exchange)
+            args.write_shortstr(message.routing_key)
+            channel.connection.send_method(channel.id, (60, 60), args.getvalue(), message)
+    
+    def requeue(self, queue_name, messages):
+        """Puts messages back at the front of their queue (in their original order)."""
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            return
+        for message in reversed(messages):
+            message.redelivered = True
+            queue.messages.appendleft(message)
+        self.dispatch(queue)
+    
+    def settle(self, channel, delivery_tag, multiple):
+        """Removes acknowledged messages from the channel's unacknowledged messages,
+           returning them as a list of (queue name, _Message) tuples."""
+        if multiple:
+            tags = [tag for tag in channel.unacked if delivery_tag == 0 or tag <= delivery_tag]
+        elif delivery_tag in channel.unacked:
+            tags = [delivery_tag]
+        else:
+            raise ChannelError(PRECONDITION_FAILED, 'unknown delivery tag %r' % delivery_tag)
+        for tag in tags:
+            consumer = channel.deliveries.pop(tag, None)
+            if consumer is not None:
+                consumer.unacked -= 1
+        return [channel.unacked.pop(tag) for tag in tags]
+    
+    def redispatch(self, channel):
+        """Delivers messages to the channel's consumers once its prefetch window opens up."""
+        for name in set(consumer.queue for consumer in channel.consumers.values()):
+            if name in self.queues:
+                self.dispatch(self.queues[name])
+    
+    def remove_consumer(self, channel, tag):
+        consumer = channel.consumers.pop(tag, None)
+        if consumer is None:
+            return
+        queue = self.queues.get(consumer.queue)
+        if queue is not None:
+            queue.consumers.remove(consumer)
+            if queue.auto_delete and not queue.consumers:
+                self.delete_queue(queue.name)
+    
+    def delete_queue(self, name):
+        queue = self.queues.pop(name)
+        for consumer in list(queue.consumers):
+            consumer.channel.consumers.pop(consumer.tag, None)
+        for exchange, bindings in self.bindings.items():
+            self.bindings[exchange] = [binding for binding in bindings if binding[0] != name]
+        return len(queue.messages)
+    
+    def release_channel(self, channel):
+        """Cleans up after a channel which has closed: its consumers are cancelled, and any
+           messages it never acknowledged are requeued."""
+        for tag in list(channel.consumers):
+            self.remove_consumer(channel, tag)
+        unacked = collections.defaultdict(list)
+        for name, message in channel.unacked.itervalues():
+            unacked[name].append(message)
+        channel.unacked.clear()
+        channel.deliveries.clear()
+        for name, messages in unacked.iteritems():
+            self.requeue(name, messages)
+
+class _Server(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Connection(SocketServer.BaseRequestHandler):
+    """Handles a single client connection."""
+    def setup(self):
+        # Like RabbitMQ, don't hold back small frames (acks, and the deliveries refilling a
+        # prefetch window) waiting for delayed ACKs
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.broker = self.server.broker
+        self.channels = {}
+        self.frame_max = FRAME_MAX
+        self._read_buffer = ''
+        self._outgoing = Queue.Queue()
+        self._writer = threading.Thread(target=self._write_frames, name='hare-fake-broker-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        with self.broker.lock:
+            self.broker.connections.add(self)
+    
+    def finish(self):
+        with self.broker.lock:
+            self.broker.connections.discard(self)
+            for channel in self.channels.values():
+                self.broker.release_channel(channel)
+            for queue in self.broker.queues.values():
+                if queue.exclusive_to is self:
+                    self.broker.delete_queue(queue.name)
+        # Flush anything still queued (e.g. a close_ok) before the socket is closed
+        self._outgoing.put(None)
+        self._writer.join(5)
+    
+    def disconnect(self):
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    
+    # --- Framing --- #
+    
+    def _read(self, n):
+        while len(self._read_buffer) < n:
+            data = self.request.recv(65536)
+            if not data:
+                raise EOFError
+            self._read_buffer += data
+        result, self._read_buffer = self._read_buffer[:n], self._read_buffer[n:]
+        return result
+    
+    def _read_frame(self):
+        frame_type, channel_id, size = struct.unpack('>BHI', self._read(7))
+        payload = self._read(size)
+        if self._read(1) != FRAME_END:
+            raise EOFError('bad frame end')
+        return frame_type, channel_id, payload
+    
+    def _write_frames(self):
+        while True:
+            data = self._outgoing.get()
+            if data is None:
+                return
+            try:
+                self.request.sendall(data)
+            except socket.error:
+                return
+    
+    def send_method(self, channel_id, method_sig, args='', message=None):
+        """Queues a method (and its content, if any) to be written to the client."""
+        payload = struct.pack('>HH', *method_sig) + args
+        frames = [struct.pack('>BHI', FRAME_METHOD, channel_id, len(payload)), payload, FRAME_END]
+        if message is not None:
+            header = struct.pack('>HHQ', method_sig[0], 0, len(message.body)) + message.properties
+            frames.extend([struct.pack('>BHI', FRAME_HEADER, channel_id, len(header)), header, FRAME_END])
+            chunk_size = self.frame_max - 8
+            for i in xrange(0, len(message.body), chunk_size):
+                chunk = message.body[i:i + chunk_size]
+                frames.extend([struct.pack('>BHI', FRAME_BODY, channel_id, len(chunk)), chunk, FRAME_END])
+        self._outgoing.put(''.join(frames))
+    
+    def handle(self):
+        try:
+            if not self._read(8).startswith('AMQP'):
+                return
+            args = AMQPWriter()
+            args.write_octet(8)
+            args.write_octet(0)
+            args.write_table({'product': 'hare fake broker'})
+            args.write_longstr('AMQPLAIN PLAIN')
+            args.write_longstr('en_US')
+            self.send_method(0, (10, 10), args.getvalue())
+            while True:
+                frame_type, channel_id, payload = self._read_frame()
+                if frame_type == FRAME_HEARTBEAT:
+                    continue
+                if frame_type != FRAME_METHOD:
+                    return # content frames are only expected straight after basic.publish
+                method_sig = struct.unpack('>HH', payload[:4])
+                content = None
+                if method_sig == (60, 40):
+                    content = self._read_content()
+                if not self._handle_method(channel_id, method_sig, AMQPReader(payload[4:]), content):
+                    return
+        except (EOFError, socket.error):
+            return
+    
+    def _read_content(self):
+        """Reads the header and body frames following a content-bearing method, returning a
+           (properties, body) tuple."""
+        frame_type, channel_id, payload = self._read_frame()
+        body_size = struct.unpack('>HHQ', payload[:12])[2]
+        properties = payload[12:]
+        parts, received = [], 0
+        while received < body_size:
+            frame_type, channel_id, chunk = self._read_frame()
+            parts.append(chunk)
+            received += len(chunk)
+        return properties, ''.join(parts)
+    
+    def _handle_method(self, channel_id, method_sig, args, content):
+        """Handles a method from the client, returning False once the connection is closed."""
+        if channel_id == 0:
+            return self._handle_connection_method(method_sig, args)
+        channel = self.channels.get(channel_id)
+        if method_sig == (20, 10):
+            self.channels[channel_id] = _Channel(self, channel_id)
+            self.send_method(channel_id, (20, 11))
+            return True
+        if channel is None:
+            return True
+        if channel.closing:
+            # Everything but the acknowledgement of the close is discarded
+            if method_sig in ((20, 40), (20, 41)):
+                self._close_channel(channel)
+            return True
+        handler = self._METHODS.get(method_sig)
+        if handler is None:
+            return True
+        try:
+            with self.broker.lock:
+                handler(self, channel, args, content)
+        except ChannelError, e:
+            with self.broker.lock:
+                self.broker.release_channel(channel)
+            channel.closing = True
+            reply = AMQPWriter()
+            reply.write_short(e.code)
+            reply.write_shortstr(e.text)
+            reply.write_short(method_sig[0])
+            reply.write_short(method_sig[1])
+            self.send_method(channel_id, (20, 40), reply.getvalue())
+        return True
+    
+    def _handle_connection_method(self, method_sig, args):
+        if method_sig == (10, 11): # start_ok
+            reply = AMQPWriter()
+            reply.write_short(0)
+            reply.write_long(FRAME_MAX)
+            reply.write_short(0)
+            self.send_method(0, (10, 30), reply.getvalue())
+        elif method_sig == (10, 31): # tune_ok
+            args.read_short()
+            self.frame_max = (args.read_long() or FRAME_MAX)
+        elif method_sig == (10, 40): # open
+            reply = AMQPWriter()
+            reply.write_shortstr('')
+            self.send_method(0, (10, 41), reply.getvalue())
+        elif method_sig == (10, 60): # close
+            self.send_method(0, (10, 61))
+            return False
+        elif method_sig == (10, 61): # close_ok
+            return False
+        return True
+    
+    def _close_channel(self, channel):
+        with self.broker.lock:
+            self.broker.release_channel(channel)
+        del self.channels[channel.id]
+    
+    # --- Channel method handlers (called with the broker lock held) --- #
+    
+    def channel_flow(self, channel, args, content):
+        reply = AMQPWriter()
+        reply.write_bit(args.read_bit())
+        self.send_method(channel.id, (20, 21), reply.getvalue())
+    
+    def channel_close(self, channel, args, content):
+        self.broker.release_channel(channel)
+        del self.channels[channel.id]
+        self.send_method(channel.id, (20, 41))
+    
+    def access_request(self, channel, args, content):
+        reply = AMQPWriter()
+        reply.write_short(1)
+        self.send_method(channel.id, (30, 11), reply.getvalue())
+    
+    def exchange_declare(self, channel, args, content):
+        args.read_short() # ticket
+        exchange = args.read_shortstr()
+        exchange_type = args.read_shortstr()
+        passive = args.read_bit()
+        args.read_bit() # durable
+        args.read_bit() # auto_delete
+        args.read_bit() # internal
+        nowait = args.read_bit()
+        if exchange not in self.broker.exchanges:
+            if passive:
+                raise ChannelError(NOT_FOUND, 'no exchange %r' % exchange)
+            if exchange_type not in ('direct', 'fanout', 'topic'):
+                raise ChannelError(PRECONDITION_FAILED, 'unsupported exchange type %r' % exchange_type)
+            self.broker.exchanges[exchange] = exchange_type
+        elif not passive and self.broker.exchanges[exchange] != exchange_type:
+            raise ChannelError(PRECONDITION_FAILED, 'cannot redeclare exchange %r as %r' % (exchange, exchange_type))
+        if not nowait:
+            self.send_method(channel.id, (40, 11))
+    
+    def exchange_delete(self, channel, args, content):
+        args.read_short() # ticket
+        exchange = args.read_shortstr()
+        args.read_bit() # if_unused
+        nowait = args.read_bit()
+        if exchange not in self.broker.exchanges:
+            raise ChannelError(NOT_FOUND, 'no exchange %r' % exchange)
+        del self.broker.exchanges[exchange]
+        self.broker.bindings.pop(exchange, None)
+        if not nowait:
+            self.send_method(channel.id, (40, 21))
+    
+    def queue_declare(self, channel, args, content):
+        args.read_short() # ticket
+        name = args.read_shortstr()
+        passive = args.read_bit()
+        args.read_bit() # durable
+        exclusive = args.read_bit()
+        auto_delete = args.read_bit()
+        nowait = args.read_bit()
+        arguments = args.read_table()
+        if name not in self.broker.queues:
+            if passive:
+                raise ChannelError(NOT_FOUND, 'no queue %r' % name)
+            name = (name or self.broker.generate_name('amq.gen'))
+            self.broker.queues[name] = _Queue(name, (self if exclusive else None), auto_delete, arguments)
+        queue = self.broker.queues[name]
+        if not nowait:
+            reply = AMQPWriter()
+            reply.write_shortstr(name)
+            reply.write_long(len(queue.messages))
+            reply.write_long(len(queue.consumers))
+            self.send_method(channel.id, (50, 11), reply.getvalue())
+    
+    def queue_bind(self, channel, args, content):
+        args.read_short() # ticket
+        queue = self.broker.get_queue(args.read_shortstr()).name
+        exchange = args.read_shortstr()
+        routing_key = args.read_shortstr()
+        nowait = args.read_bit()
+        if exchange not in self.broker.exchanges:
+            raise ChannelError(NOT_FOUND, 'no exchange %r' % exchange)
+        bindings = self.broker.bindings.setdefault(exchange, [])
+        if (queue, routing_key) not in bindings:
+            bindings.append((queue, routing_key))
+        if not nowait:
+            self.send_method(channel.id, (50, 21))
+    
+    def queue_unbind(self, channel, args, content):
+        args.read_short() # ticket
+        queue = args.read_shortstr()
+        exchange = args.read_shortstr()
+        routing_key = args.read_shortstr()
+        bindings = self.broker.bindings.get(exchange, [])
+        if (queue, routing_key) in bindings:
+            bindings.remove((queue, routing_key))
+        self.send_method(channel.id, (50, 51))
+    
+    def queue_purge(self, channel, args, content):
+        args.read_short() # ticket
+        queue = self.broker.get_queue(args.read_shortstr())
+        nowait = args.read_bit()
+        count = len(queue.messages)
+        queue.messages.clear()
+        if not nowait:
+            reply = AMQPWriter()
+            reply.write_long(count)
+            self.send_method(channel.id, (50, 31), reply.getvalue())
+    
+    def queue_delete(self, channel, args, content):
+        args.read_short() # ticket
+        name = self.broker.get_queue(args.read_shortstr()).name
+        args.read_bit() # if_unused
+        args.read_bit() # if_empty
+        nowait = args.read_bit()
+        count = self.broker.delete_queue(name)
+        if not nowait:
+            reply = AMQPWriter()
+            reply.write_long(count)
+            self.send_method(channel.id, (50, 41), reply.getvalue())
+    
+    def basic_qos(self, channel, args, content):
+        args.read_long() # prefetch_size
+        prefetch_count = args.read_short()
+        if args.read_bit(): # global
+            channel.prefetch_count = prefetch_count
+        else:
+            channel.consumer_prefetch_count = prefetch_count
+        self.send_method(channel.id, (60, 11))
+        self.broker.redispatch(channel)
+    
+    def basic_consume(self, channel, args, content):
+        args.read_short() # ticket
+        queue = self.broker.get_queue(args.read_shortstr())
+        tag = (args.read_shortstr() or self.broker.generate_name('amq.ctag'))
+        args.read_bit() # no_local
+        no_ack = args.read_bit()
+        args.read_bit() # exclusive
+        nowait = args.read_bit()
+        if tag in channel.consumers:
+            raise ChannelError(PRECONDITION_FAILED, 'consumer tag %r already in use' % tag)
+        consumer = _Consumer(tag, queue.name, channel, no_ack, channel.consumer_prefetch_count)
+        channel.consumers[tag] = consumer
+        queue.consumers.append(consumer)
+        if not nowait:
+            reply = AMQPWriter()
+            reply.write_shortstr(tag)
+            self.send_method(channel.id, (60, 21), reply.getvalue())
+        self.broker.dispatch(queue)
+    
+    def basic_cancel(self, channel, args, content):
+        tag = args.read_shortstr()
+        nowait = args.read_bit()
+        self.broker.remove_consumer(channel, tag)
+        if not nowait:
+            reply = AMQPWriter()
+            reply.write_shortstr(tag)
+            self.send_method(channel.id, (60, 31), reply.getvalue())
+    
+    def basic_publish(self, channel, args, content):
+        args.read_short() # ticket
+        exchange = args.read_shortstr()
+        routing_key = args.read_shortstr()
+        mandatory = args.read_bit()
+        message = _Message(content[0], content[1], exchange, routing_key)
+        if channel.transactional:
+            self.broker.route(exchange, routing_key) # check the exchange exists now
+            channel.tx_publishes.append(message)
+        elif not self.broker.publish(message) and mandatory:
+            reply = AMQPWriter()
+            reply.write_short(NO_ROUTE)
+            reply.write_shortstr('NO_ROUTE')
+            reply.write_shortstr(exchange)
+            reply.write_shortstr(routing_key)
+            self.send_method(channel.id, (60, 50), reply.getvalue(), message)
+    
+    def basic_get(self, channel, args, content):
+        args.read_short() # ticket
+        queue = self.broker.get_queue(args.read_shortstr())
+        no_ack = args.read_bit()
+        if not queue.messages:
+            reply = AMQPWriter()
+            reply.write_shortstr('')
+            self.send_method(channel.id, (60, 72), reply.getvalue())
+            return
+        message = queue.messages.popleft()
+        tag = channel.delivery_tags.next()
+        if not no_ack:
+            channel.unacked[tag] = (queue.name, message)
+        reply = AMQPWriter()
+        reply.write_longlong(tag)
+        reply.write_bit(message.redelivered)
+        reply.write_shortstr(message.exchange)
+        reply.write_shortstr(message.routing_key)
+        reply.write_long(len(queue.messages))
+        self.send_method(channel.id, (60, 71), reply.getvalue(), message)
+    
+    def basic_ack(self, channel, args, content):
+        delivery_tag = args.read_longlong()
+        multiple = args.read_bit()
+        if channel.transactional:
+            channel.tx_acks.append((delivery_tag, multiple))
+            return
+        self.broker.settle(channel, delivery_tag, multiple)
+        self.broker.redispatch(channel)
+    
+    def basic_reject(self, channel, args, content):
+        delivery_tag = args.read_longlong()
+        requeue = args.read_bit()
+        for name, message in self.broker.settle(channel, delivery_tag, False):
+            if requeue:
+                self.broker.requeue(name, [message])
+            elif name in self.broker.queues:
+                self.broker.dead_letter(self.broker.queues[name], message)
+        self.broker.redispatch(channel)
+    
+    def basic_recover(self, channel, args, content):
+        unacked = channel.unacked.values()
+        channel.unacked.clear()
+        for consumer in channel.deliveries.values():
+            consumer.unacked = 0
+        channel.deliveries.clear()
+        for name, message in unacked:
+            self.broker.requeue(name, [message])
+    
+    def tx_select(self, channel, args, content):
+        channel.transactional = True
+        self.send_method(channel.id, (90, 11))
+    
+    def tx_commit(self, channel, args, content):
+        publishes, channel.tx_publishes = channel.tx_publishes, []
+        acks, channel.tx_acks = channel.tx_acks, []
+        for message in publishes:
+            self.broker.publish(message)
+        for delivery_tag, multiple in acks:
+            self.broker.settle(channel, delivery_tag, multiple)
+        self.broker.redispatch(channel)
+        self.send_method(channel.id, (90, 21))
+    
+    def tx_rollback(self, channel, args, content):
+        channel.tx_publishes, channel.tx_acks = [], []
+        self.send_method(channel.id, (90, 31))
+    
+    _METHODS = {
+        (20, 20): channel_flow,
+        (20, 40): channel_close,
+        (30, 10): access_request,
+        (40, 10): exchange_declare,
+        (40, 20): exchange_delete,
+        (50, 10): queue_declare,
+        (50, 20): queue_bind,
+        (50, 30): queue_purge,
+        (50, 40): queue_delete,
+        (50, 50): queue_unbind,
+        (60, 10): basic_qos,
+        (60, 20): basic_consume,
+        (60, 30): basic_cancel,
+        (60, 40): basic_publish,
+        (60, 70): basic_get,
+        (60, 80): basic_ack,
+        (60, 90): basic_reject,
+        (60, 100): basic_recover,
+        (90, 10): tx_select,
+        (90, 20): tx_commit,
+        (90, 30): tx_rollback,
+    }
@@ -3,27 +3,50 @@ import contextlib
 
 from django.db import transaction as dj_transaction
 
+from .. import outbox
+
 @contextlib.contextmanager
 def transaction():
     """Context manager for executing something in the context of a database
        transaction. A transaction is started and the nested block executed. If
        no exceptions are raised, the transaction is committed. Otherwise, the
-       transaction is rolled back and the exception re-raised."""
+       transaction is rolled back and the exception re-raised.
+       
+       Messages published in the nested block are buffered, and only published
+       once the transaction has committed (or dropped if it is rolled back); see
+       the outbox module. Since Django commits or rolls back the whole database
+       transaction at the end of every block, even a nested one, so does the
+       outbox: the messages published since the last commit go out (or are
+       dropped) whenever any block ends."""
+    box = outbox.current()
+    outermost = (box is None or not box.transactional)
+    if outermost:
+        box = outbox.begin(transactional=True)
     try:
-        dj_transaction.enter_transaction_management()
-        dj_transaction.managed(True)
         try:
-            yield
-        except:
-            # The nested block threw an exception, roll back
-            if dj_transaction.is_dirty():
-                dj_transaction.rollback()
-            raise
-        else:
-            # The nested block succeeded, commit
-            if dj_transaction.is_dirty():
-                dj_transaction.commit()
-    finally:
-        # Must always leave transaction management, even in the case
-        # of an exception
-        dj_transaction.leave_transaction_management()
+            dj_transaction.enter_transaction_management()
+            dj_transaction.managed(True)
+            try:
+                yield
+            except:
+                # The nested block threw an exception, roll back
+                if dj_transaction.is_dirty():
+                    dj_transaction.rollback()
+                raise
+            else:
+                # The nested block succeeded, commit
+                if dj_transaction.is_dirty():
+                    dj_transaction.commit()
+        finally:
+            # Must always leave transaction management, even in the case
+            # of an exception
+            dj_transaction.leave_transaction_management()
+    except:
+        box.drop()
+        if outermost:
+            outbox.rollback()
+        raise
+    # Only now that the transaction has committed can its messages go out
+    box.flush()
+    if outermost:
+        outbox.commit()
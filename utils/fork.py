@@ -0,0 +1,16 @@
+"""Starting forked child processes off with connections of their own."""
+from django.db import connections
+
+from ..connection import AMQPConnection
+from ..pool import ConnectionPool
+from .. import metrics
+
+def after_fork():
+    """Makes sure a freshly forked child process uses none of its parent's connections (to the
+       AMQP server or the database), which would otherwise be shared by both processes."""
+    AMQPConnection.reset_after_fork()
+    ConnectionPool.reset_after_fork()
+    metrics.reset_after_fork()
+    for connection in connections.all():
+        # Dropped rather than closed, which would close the parent's, too
+        connection.connection = None
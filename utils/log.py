@@ -2,18 +2,89 @@
    
    If the setting HARE_LOGGER is defined in your settings.py file, then that logger will
    be used for Hare to log to. Otherwise, a logger which logs to syslog is created, whose
-   destination can be optionally controlled by the SYSLOG_ADDRESS setting."""
+   destination can be optionally controlled by the SYSLOG_ADDRESS setting, and whose level
+   by the HARE_LOG_LEVEL setting (INFO by default). Records are handed to syslog from a
+   background thread, so logging never blocks on the syslog socket.
+   
+   Hare only ever logs with lazy arguments (logger.debug('... %r', x)), so nothing is
+   formatted unless the record is actually going to be emitted."""
+import atexit
+import copy
 import logging
+import os
+import Queue
+import threading
 from logging.handlers import SysLogHandler
 
 from django.conf import settings
 
+class QueueHandler(logging.Handler):
+    """A handler which passes records on to the target handler from a background thread. If
+       the queue fills up (because the target can't keep up), records are dropped rather than
+       blocking the caller; the number dropped is kept in the dropped attribute.
+       
+       Threads don't survive a fork, so a forked child process gets a new queue and thread
+       the first time it logs."""
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._start()
+    
+    def _start(self):
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.maxsize)
+        self._thread = threading.Thread(target=self._drain, name='hare-log')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def prepare(self, record):
+        # The message has to be formatted now, since its arguments (and any traceback) may
+        # have changed or gone by the time the background thread gets to it. A copy is
+        # queued, so that handlers further up the chain still see the original.
+        record = copy.copy(record)
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+    
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+    
+    def _drain(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+    
+    def close(self):
+        """Stops the background thread once it has passed on any records already queued."""
+        if self._thread.isAlive():
+            self.queue.put(None)
+            self._thread.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
 if hasattr(settings, 'HARE_LOGGER'):
     # Use the logger defined in settings.py
     logger = settings.HARE_LOGGER
 else:
     # Create a new one
     logger = logging.getLogger('hare')
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(getattr(settings, 'HARE_LOG_LEVEL', logging.INFO))
     address = getattr(settings, 'SYSLOG_ADDRESS', '/dev/log')
-    logger.addHandler(SysLogHandler(address))
+    handler = QueueHandler(SysLogHandler(address))
+    logger.addHandler(handler)
+    atexit.register(handler.close)